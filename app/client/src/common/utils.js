@@ -95,7 +95,7 @@ export const copyToClipboard = (textToCopy) => {
 /**
  * Gets the URL for a specific video quality
  * @param {string} videoId - The video ID
- * @param {string} quality - Quality ('720p', '1080p', or 'original')
+ * @param {string} quality - Quality (a rendition like '720p', or 'original')
  * @param {string} extension - Video file extension (e.g., '.mp4', '.mkv')
  * @returns {string} Video URL
  */
@@ -104,7 +104,7 @@ export const getVideoUrl = (videoId, quality, extension) => {
   const codecs = getClientSupportedCodecs(videoId).join(',')
 
   // Always use the stream API regardless of environment
-  if (quality === '720p' || quality === '1080p') {
+  if (/^\d{3,4}p$/.test(quality)) {
     return `${URL}/api/stream?id=${videoId}&quality=${quality}&codecs=${encodeURIComponent(codecs)}&codec_try=0`
   }
 
@@ -115,37 +115,33 @@ export const getVideoUrl = (videoId, quality, extension) => {
   return `${URL}/api/stream?id=${videoId}&codecs=${encodeURIComponent(codecs)}&codec_try=0`
 }
 
+/**
+ * Lists the transcoded qualities of a video, smallest first
+ * Older servers only send the has_720p and has_1080p flags
+ * @param {Object} videoInfo - Video info object containing its renditions
+ * @returns {Array} Quality labels like '720p'
+ */
+export const getVideoQualities = (videoInfo) => {
+  if (Array.isArray(videoInfo?.renditions)) {
+    return [...videoInfo.renditions].sort((a, b) => a.height - b.height).map((r) => r.quality)
+  }
+  return [videoInfo?.has_720p && '720p', videoInfo?.has_1080p && '1080p'].filter(Boolean)
+}
+
 /**
  * Generates video sources array for Video.js player with quality options
- * Defaults to original quality, with 720p and 1080p as alternatives
+ * Defaults to original quality, with the transcoded renditions as alternatives
  * @param {string} videoId - The video ID
- * @param {Object} videoInfo - Video info object containing has_720p, has_1080p flags
+ * @param {Object} videoInfo - Video info object containing its renditions
  * @param {string} extension - Video file extension (e.g., '.mp4', '.mkv')
  * @returns {Array} Array of video sources for Video.js
  */
 export const getVideoSources = (videoId, videoInfo, extension) => {
-  const sources = []
-
-  const has720p = videoInfo?.has_720p
-  const has1080p = videoInfo?.has_1080p
-
-  // Add 720p
-  if (has720p) {
-    sources.push({
-      src: getVideoUrl(videoId, '720p', extension),
-      type: 'video/mp4',
-      label: '720p',
-    })
-  }
-
-  // Add 1080p
-  if (has1080p) {
-    sources.push({
-      src: getVideoUrl(videoId, '1080p', extension),
-      type: 'video/mp4',
-      label: '1080p',
-    })
-  }
+  const sources = getVideoQualities(videoInfo).map((quality) => ({
+    src: getVideoUrl(videoId, quality, extension),
+    type: 'video/mp4',
+    label: quality,
+  }))
 
   // Add original quality - always selected by default
   sources.push({
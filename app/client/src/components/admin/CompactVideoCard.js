@@ -5,7 +5,7 @@ import VisibilityIcon from '@mui/icons-material/Visibility'
 import EditIcon from '@mui/icons-material/Edit'
 import LinkIcon from '@mui/icons-material/Link'
 import { CopyToClipboard } from 'react-copy-to-clipboard'
-import { getPublicWatchUrl, getServedBy, getUrl, toHHMMSS, useDebounce, getVideoUrl } from '../../common/utils'
+import { getPublicWatchUrl, getServedBy, getUrl, toHHMMSS, useDebounce, getVideoUrl, getVideoQualities } from '../../common/utils'
 import VideoService from '../../services/VideoService'
 import _ from 'lodash'
 import UpdateDetailsModal from '../modal/UpdateDetailsModal'
@@ -112,16 +112,15 @@ const CompactVideoCard = ({ video, openVideoHandler, alertHandler, cardWidth, au
     video.info?.width && video.info?.height ? cardWidth * (video.info.height / video.info.width) : cardWidth / 1.77
 
   const getPreviewVideoUrl = () => {
-    // Prefer 720p if available, else 1080p, else original
-    const has720p = video.info?.has_720p
-    const has1080p = video.info?.has_1080p
+    // Prefer 720p if available, else the smallest rendition, else original
+    const qualities = getVideoQualities(video.info)
 
-    if (has720p) {
+    if (qualities.includes('720p')) {
       return getVideoUrl(video.video_id, '720p', video.extension)
     }
 
-    if (has1080p) {
-      return getVideoUrl(video.video_id, '1080p', video.extension)
+    if (qualities.length) {
+      return getVideoUrl(video.video_id, qualities[0], video.extension)
     }
 
     // Fall back to original
@@ -259,6 +258,10 @@ const CompactVideoCard = ({ video, openVideoHandler, alertHandler, cardWidth, au
             )}
             <img
               src={`${URL}/api/video/poster?id=${video.video_id}`}
+              srcSet={[320, 640, 1280]
+                .map((size) => `${URL}/api/video/poster?id=${video.video_id}&size=${size} ${size}w`)
+                .join(', ')}
+              sizes={`${cardWidth}px`}
               alt=""
               style={{
                 width: cardWidth,
@@ -13,6 +13,24 @@ qualitySelectorPlugin(videojs)
 // Tolerance threshold for checking if player is already at the desired start time (in seconds)
 const SEEK_TOLERANCE_SECONDS = 0.5
 
+const parseVttTime = (t) => t.split(':').reduce((total, part) => total * 60 + parseFloat(part), 0)
+
+// Cues of a seek preview WebVTT file, each pointing at a thumbnail region (#xywh=x,y,w,h) of a sprite sheet
+const parseSeekPreview = (text, baseUrl) =>
+  text
+    .split(/\r?\n\r?\n/)
+    .map((block) => {
+      const lines = block.trim().split(/\r?\n/)
+      const timing = lines.findIndex((line) => line.includes('-->'))
+      if (timing < 0 || !lines[timing + 1]) return null
+      const [start, end] = lines[timing].split('-->').map((t) => parseVttTime(t.trim()))
+      const url = new URL(lines[timing + 1].trim(), baseUrl)
+      const [x, y, w, h] = (url.hash.match(/xywh=([\d,]+)/)?.[1] || '').split(',').map(Number)
+      url.hash = ''
+      return { start, end, url: url.toString(), x, y, w, h }
+    })
+    .filter((cue) => cue && cue.w && cue.h)
+
 const VideoJSPlayer = ({
   sources,
   poster,
@@ -238,6 +256,55 @@ const VideoJSPlayer = ({
     }
   }, [durationHint])
 
+  // Show the thumbnail of the hovered time above the seek bar, when the server has a seek preview for this video
+  useEffect(() => {
+    const player = playerRef.current
+    if (!player || !videoId) return
+    let cancelled = false
+    let cleanup = () => {}
+    const vttUrl = `${getUrl()}/api/video/${videoId}/seek-preview.vtt`
+    fetch(vttUrl)
+      .then((res) => (res.ok ? res.text() : null))
+      .then((text) => {
+        if (cancelled || !text || player.isDisposed()) return
+        const cues = parseSeekPreview(text, vttUrl)
+        const seekBar = player.getChild('controlBar')?.getChild('progressControl')?.getChild('seekBar')
+        const mouseTimeDisplay = seekBar?.getChild('mouseTimeDisplay')
+        if (!cues.length || !mouseTimeDisplay) return
+        // Follows the cursor along with the time tooltip it sits above
+        const thumbnail = document.createElement('div')
+        Object.assign(thumbnail.style, {
+          position: 'absolute',
+          bottom: 'calc(100% + 2.4em)',
+          backgroundRepeat: 'no-repeat',
+          border: '1px solid rgba(255, 255, 255, 0.3)',
+          pointerEvents: 'none',
+        })
+        mouseTimeDisplay.el().appendChild(thumbnail)
+        const onMouseMove = (event) => {
+          const time = seekBar.calculateDistance(event) * player.duration()
+          const cue = cues.find((c) => time < c.end) || cues[cues.length - 1]
+          Object.assign(thumbnail.style, {
+            width: `${cue.w}px`,
+            height: `${cue.h}px`,
+            left: `${-cue.w / 2}px`,
+            backgroundImage: `url("${cue.url}")`,
+            backgroundPosition: `-${cue.x}px -${cue.y}px`,
+          })
+        }
+        seekBar.on('mousemove', onMouseMove)
+        cleanup = () => {
+          if (!seekBar.isDisposed()) seekBar.off('mousemove', onMouseMove)
+          thumbnail.remove()
+        }
+      })
+      .catch(() => {})
+    return () => {
+      cancelled = true
+      cleanup()
+    }
+  }, [videoId])
+
   // Dispose the Video.js player when the functional component unmounts
   useEffect(() => {
     const player = playerRef.current
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measures time-to-first-frame of an MP4 with its moov box at the end, before and after a faststart copy.
+
+A test recording is generated with ffmpeg (which writes moov last, like most recorders), and a faststart
+copy is made of it with util.create_faststart_copy. Both are served over HTTP with Range support and a
+fixed delay per request to stand in for network round trips, the way /api/video serves them. ffmpeg then
+opens each URL and decodes the first frame, like a player starting playback. The time this takes, the
+number of requests and the bytes transferred are reported.
+
+Usage, from app/server with the server requirements installed and ffmpeg on the PATH:
+
+    python benchmarks/faststart_ttff.py --duration 120 --rtt 80
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+class RangeHandler(BaseHTTPRequestHandler):
+    root = None
+    rtt = 0
+    requests = []
+
+    def do_GET(self):
+        time.sleep(self.rtt)
+        path = self.root / self.path.lstrip('/')
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            try:
+                while sent < end - start + 1:
+                    chunk = f.read(min(256 * 1024, end - start + 1 - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # Players drop the connection as soon as they have what they need
+                pass
+        RangeHandler.requests.append((self.path, start, sent))
+
+    def log_message(self, *args):
+        pass
+
+def time_to_first_frame(url, repeat):
+    best = None
+    for _ in range(repeat):
+        RangeHandler.requests = []
+        s = time.perf_counter()
+        sp.run(['ffmpeg', '-v', 'error', '-i', url, '-frames:v', '1', '-f', 'null', '-'], check=True)
+        elapsed = time.perf_counter() - s
+        if best is None or elapsed < best[0]:
+            best = (elapsed, len(RangeHandler.requests), sum(r[2] for r in RangeHandler.requests))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=int, default=120, help="Length of the test recording in seconds")
+    parser.add_argument("--rtt", type=float, default=50, help="Delay added to every request, in milliseconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    from fireshare import util, mp4
+
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-faststart-"))
+    try:
+        original = workdir / "recording.mp4"
+        copy = workdir / "recording-faststart.mp4"
+        sp.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30', '-f', 'lavfi', '-i', 'sine',
+                '-t', str(args.duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', str(original)], check=True)
+        assert mp4.is_faststart(original) is False, "ffmpeg wrote the test recording with moov first"
+        assert util.create_faststart_copy(original, copy), "could not create the faststart copy"
+
+        RangeHandler.root = workdir
+        RangeHandler.rtt = args.rtt / 1000
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        before = time_to_first_frame(f"{base}/{original.name}", args.repeat)
+        after = time_to_first_frame(f"{base}/{copy.name}", args.repeat)
+        server.shutdown()
+        size = original.stat().st_size
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.duration}s 720p recording, {size / 1024 / 1024:.1f} MiB, {args.rtt:.0f} ms per request")
+    print(f"{'':>12} {'first frame (s)':>16} {'requests':>9} {'bytes read':>12}")
+    print(f"{'moov at end':>12} {before[0]:>16.3f} {before[1]:>9} {before[2]:>12,}")
+    print(f"{'faststart':>12} {after[0]:>16.3f} {after[1]:>9} {after[2]:>12,}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Compares serialising the video listing with and without parsing VideoInfo.info.
+
+A throwaway database is filled with videos whose info column holds a realistically sized
+ffprobe blob. The listing is then serialised the way /api/videos does it, once with the
+serializer from before the media columns were added (which json.loads the blob twice per
+video to work out the frame rate) and once with the current VideoInfo.json().
+
+Usage, from app/server with the server requirements installed:
+
+    python benchmarks/listing_serialization.py --videos 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+FAKE_STREAMS = [
+    {"index": 0, "codec_name": "h264", "codec_type": "video", "width": 1920, "height": 1080, "pix_fmt": "yuv420p",
+     "r_frame_rate": "60/1", "duration": "120.0", "bit_rate": "12000000", "tags": {"handler_name": "VideoHandler" * 20}},
+] + [
+    {"index": i, "codec_name": "aac", "codec_type": "audio", "sample_rate": "48000", "channels": 2,
+     "duration": "120.0", "tags": {"handler_name": "SoundHandler" * 20}}
+    for i in range(1, 4)
+]
+
+def legacy_info_json(vi):
+    """VideoInfo.json() as it was before the media columns, frame rate included"""
+    def vcodec():
+        info = json.loads(vi.info) if vi.info else None
+        return [i for i in info if i["codec_type"] == "video"][0] if info else None
+    framerate = None
+    if vcodec():
+        frn, frd = vcodec().get("r_frame_rate", "").split("/")
+        framerate = round(float(frn)/float(frd))
+    return {
+        "title": vi.title,
+        "description": vi.description,
+        "private": vi.private,
+        "width": vi.width,
+        "height": vi.height,
+        "duration": round(vi.duration) if vi.duration else 0,
+        "framerate": framerate,
+        # the flags were columns then, they are rendition rows now and listed along with them
+        "renditions": [r.json() for r in vi.renditions],
+        "has_720p": any(r.height == 720 for r in vi.renditions),
+        "has_1080p": any(r.height == 1080 for r in vi.renditions)
+    }
+
+def legacy_video_json(v):
+    return {
+        "video_id": v.video_id,
+        "extension": v.extension,
+        "path": v.path,
+        "available": v.available,
+        "info": legacy_info_json(v.info),
+    }
+
+def populate(db, Video, VideoInfo, count):
+    from fireshare import util
+    blob = json.dumps(FAKE_STREAMS)
+    columns = util.media_columns(FAKE_STREAMS, None, ".mp4")
+    db.session.execute(Video.__table__.insert(), [
+        {"video_id": f"{i:032x}", "extension": ".mp4", "path": f"folder-{i // 100:04d}/clip-{i:06d}.mp4", "available": True}
+        for i in range(count)])
+    db.session.execute(VideoInfo.__table__.insert(), [
+        dict(columns, video_id=f"{i:032x}", title=f"clip-{i:06d}", info=blob, duration=120.0, width=1920, height=1080, private=False)
+        for i in range(count)])
+    db.session.commit()
+
+def best_of(fn, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        s = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - s
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--videos", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-listing-"))
+    try:
+        for name in ("data", "videos", "processed"):
+            (workdir / name).mkdir()
+        os.environ["DATA_DIRECTORY"] = str(workdir / "data")
+        os.environ["VIDEO_DIRECTORY"] = str(workdir / "videos")
+        os.environ["PROCESSED_DIRECTORY"] = str(workdir / "processed")
+
+        from fireshare import create_app, db
+        from fireshare.models import Video, VideoInfo
+
+        with create_app().app_context():
+            db.create_all()
+            populate(db, Video, VideoInfo, args.videos)
+            videos = Video.query.all()
+
+            before, before_json = best_of(lambda: [legacy_video_json(v) for v in videos], args.repeat)
+            after, after_json = best_of(lambda: [v.json() for v in videos], args.repeat)
+            assert before_json == after_json, "the serializers disagree"
+
+            before_total, _ = best_of(lambda: [legacy_video_json(v) for v in Video.query.all()], args.repeat)
+            after_total, _ = best_of(lambda: [v.json() for v in Video.query.all()], args.repeat)
+
+        print(f"serialising {args.videos:,} videos")
+        print(f"{'':>22} {'before (s)':>11} {'after (s)':>10} {'speedup':>8}")
+        print(f"{'json() only':>22} {before:>11.3f} {after:>10.3f} {before / after:>7.1f}x")
+        print(f"{'query + json()':>22} {before_total:>11.3f} {after_total:>10.3f} {before_total / after_total:>7.1f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
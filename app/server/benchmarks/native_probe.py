@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Compares reading video metadata with ffprobe against the in-process MP4/MOV parser.
+
+A mixed corpus is generated with ffmpeg: plain and faststart H.264 MP4s, HEVC and MPEG-4 MOVs, and
+fragmented MP4s and WebMs that the native parser leaves to ffprobe. Every file is probed once with a
+plain ffprobe run, which is what util.get_media_info did on every cache miss, and once through
+util.get_media_info with its in-memory cache cleared. The fields fireshare stores are checked to agree.
+
+Usage, from app/server with the server requirements installed and ffmpeg/ffprobe on the PATH:
+
+    python benchmarks/native_probe.py --files 20
+    python benchmarks/native_probe.py --corpus /videos
+"""
+import argparse
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+VARIANTS = {
+    "h264.mp4": ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"],
+    "faststart.mp4": ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-movflags", "+faststart"],
+    "hevc.mov": ["-c:v", "libx265", "-preset", "ultrafast", "-tag:v", "hvc1", "-x265-params", "log-level=error", "-c:a", "aac"],
+    "mpeg4.mov": ["-c:v", "mpeg4", "-c:a", "libmp3lame"],
+    "fragmented.mp4": ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-movflags", "frag_keyframe+empty_moov"],
+    "vp9.webm": ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-c:a", "libopus"],
+}
+RATES = ["24", "25", "30", "30000/1001", "60"]
+
+def generate(corpus, files):
+    for i in range(files):
+        name, args = list(VARIANTS.items())[i % len(VARIANTS)]
+        rate = RATES[i % len(RATES)]
+        cmd = ["ffmpeg", "-v", "error", "-y",
+               "-f", "lavfi", "-i", f"testsrc=size=320x240:rate={rate}", "-f", "lavfi", "-i", "sine=r=48000",
+               "-t", str(1 + i % 4), "-pix_fmt", "yuv420p", *args, str(corpus / f"{i:04d}-{name}")]
+        sp.run(cmd, check=True)
+
+def summary(data):
+    if not data:
+        return None
+    video = next((s for s in data["streams"] if s.get("codec_type") == "video"), {})
+    return (video.get("codec_name"), video.get("width"), video.get("height"), video.get("r_frame_rate"),
+            round(float(data["format"].get("duration", 0)), 1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=30, help="Size of the generated corpus")
+    parser.add_argument("--corpus", type=Path, default=None, help="Probe the videos in this folder instead of generating some")
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    from fireshare import util, mp4
+    from fireshare.constants import SUPPORTED_FILE_EXTENSIONS
+
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-probe-"))
+    try:
+        if args.corpus:
+            corpus = args.corpus
+        else:
+            corpus = workdir
+            print(f"generating {args.files} videos...")
+            generate(corpus, args.files)
+        paths = sorted(p for p in corpus.rglob("*") if p.is_file() and p.suffix.lower() in SUPPORTED_FILE_EXTENSIONS)
+
+        s = time.perf_counter()
+        before = [util.run_ffprobe(p) for p in paths]
+        ffprobe_time = time.perf_counter() - s
+
+        after = []
+        s = time.perf_counter()
+        for p in paths:
+            util._PROBE_MEMO.clear()
+            streams = util.get_media_info(p)
+            after.append(util._PROBE_MEMO[util.probe_key(p)] if streams is not None else None)
+        native_time = time.perf_counter() - s
+        native = sum(1 for p in paths if p.suffix.lower() in mp4.NATIVE_PROBE_EXTENSIONS and mp4.probe(p) is not None)
+
+        mismatches = [(p, summary(b), summary(a)) for p, b, a in zip(paths, before, after) if summary(b) != summary(a)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"probed {len(paths):,} videos, {native:,} natively and {len(paths) - native:,} with ffprobe")
+    print(f"{'':>18} {'total (s)':>10} {'per file (ms)':>14}")
+    print(f"{'ffprobe':>18} {ffprobe_time:>10.3f} {ffprobe_time / len(paths) * 1000:>14.2f}")
+    print(f"{'get_media_info':>18} {native_time:>10.3f} {native_time / len(paths) * 1000:>14.2f}")
+    print(f"speedup {ffprobe_time / native_time:.1f}x")
+    for p, b, a in mismatches:
+        print(f"mismatch {p.name}: ffprobe {b} native {a}")
+
+if __name__ == "__main__":
+    main()
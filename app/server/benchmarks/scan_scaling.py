@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Measures how `fireshare scan-videos` scales with library size.
+
+For each library size a throwaway data/video/processed tree is created with that many
+small synthetic video files. The benchmark then times:
+
+  - initial:  first scan of the library, every file is new
+  - rescan:   scan with nothing changed (what the scheduled bulk-import does every few minutes)
+  - full:     rescan with --full, rehashing every file
+
+Before the rescans every VideoInfo row is given a realistically sized ffprobe blob so the
+cost of loading it (or not) shows up in the numbers.
+
+Usage, from app/server with the server requirements installed:
+
+    python benchmarks/scan_scaling.py --sizes 1000 5000 10000 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+FAKE_PROBE = json.dumps([
+    {"index": i, "codec_name": "h264", "codec_type": "video", "width": 1920, "height": 1080,
+     "r_frame_rate": "60/1", "duration": "120.0", "tags": {"handler_name": "VideoHandler" * 20}}
+    for i in range(8)
+])
+
+def build_library(root: Path, count: int, file_size: int):
+    for i in range(count):
+        folder = root / f"folder-{i // 100:04d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"clip-{i:06d}.mp4").write_bytes(os.urandom(file_size))
+
+def run_command(command, *args):
+    s = time.time()
+    command.main(args=list(args), standalone_mode=False)
+    return time.time() - s
+
+def bench(count: int, file_size: int):
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-bench-"))
+    try:
+        for name in ("data", "videos", "processed"):
+            (workdir / name).mkdir()
+        os.environ["DATA_DIRECTORY"] = str(workdir / "data")
+        os.environ["VIDEO_DIRECTORY"] = str(workdir / "videos")
+        os.environ["PROCESSED_DIRECTORY"] = str(workdir / "processed")
+
+        from fireshare import create_app, db
+        from fireshare.cli import init_db, scan_videos
+        from fireshare.models import VideoInfo
+
+        build_library(workdir / "videos", count, file_size)
+        run_command(init_db)
+
+        timing = {"initial": run_command(scan_videos)}
+        with create_app().app_context():
+            db.session.query(VideoInfo).update({"info": FAKE_PROBE, "duration": 120.0, "width": 1920, "height": 1080})
+            db.session.commit()
+        timing["rescan"] = run_command(scan_videos)
+        timing["full"] = run_command(scan_videos, "--full")
+        return timing
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2500, 5000, 10000])
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="bytes per synthetic video file")
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+
+    print(f"{'videos':>8} {'initial (s)':>12} {'rescan (s)':>11} {'full (s)':>9} {'rescan files/s':>15}")
+    for count in args.sizes:
+        t = bench(count, args.file_size)
+        print(f"{count:>8,} {t['initial']:>12.2f} {t['rescan']:>11.2f} {t['full']:>9.2f} {count / t['rescan']:>15,.0f}")
+
+if __name__ == "__main__":
+    main()
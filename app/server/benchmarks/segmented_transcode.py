@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compares the wall-clock time of transcoding a long video in one ffmpeg process against encoding it in parallel segments.
+
+A test recording is generated with ffmpeg, with a keyframe every --gop seconds like a game capture. It is then
+transcoded to 720p twice with util.transcode_video_quality: as one ffmpeg process, the way transcode_videos always
+did, and cut at keyframes into --segment second pieces encoded by --workers processes (TRANSCODE_SEGMENT_SECONDS
+and TRANSCODE_SEGMENT_WORKERS). The wall time, the CPU time of the ffmpeg processes (user + system, from getrusage
+of the children) and the frame count of both outputs are reported. Run it on a CPU-only machine, the segments
+are only used with CPU encoders.
+
+Both runs use the H.264 CPU encoder, at --preset instead of the default medium to keep the benchmark short.
+
+Usage, from app/server with the server requirements installed and ffmpeg on the PATH:
+
+    python benchmarks/segmented_transcode.py --duration 300 --segment 30 --workers 8
+"""
+import argparse
+import os
+import re
+import resource
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(fn):
+    cpu, wall = children_cpu(), time.perf_counter()
+    assert fn(), "the transcode failed"
+    return children_cpu() - cpu, time.perf_counter() - wall
+
+def count_frames(path):
+    out = sp.run(['ffmpeg', '-hide_banner', '-i', str(path), '-map', '0:v:0', '-f', 'null', '-'], capture_output=True, text=True).stderr
+    return int(re.findall(r'frame=\s*(\d+)', out)[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=int, default=300, help="Length of the test recording in seconds")
+    parser.add_argument("--height", type=int, default=1080, help="Height of the test recording")
+    parser.add_argument("--gop", type=int, default=2, help="Seconds between the keyframes of the test recording")
+    parser.add_argument("--segment", type=int, default=30, help="Length of the segments in seconds")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of segments encoded at once")
+    parser.add_argument("--preset", default="veryfast", help="libx264 preset of the transcodes")
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    from fireshare import util
+
+    encoder = next(e for e in util._get_encoder_candidates(False) if e['video_codec'] == 'libx264')
+    util._working_encoder_cache['cpu'] = dict(encoder, extra_args=['-preset', args.preset, '-crf', '23'])
+
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-segments-"))
+    try:
+        source = workdir / "recording.mp4"
+        width = args.height * 16 // 9 // 2 * 2
+        sp.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size={width}x{args.height}:rate=60',
+                '-f', 'lavfi', '-i', 'sine', '-t', str(args.duration), '-c:v', 'libx264', '-preset', 'ultrafast',
+                '-g', str(args.gop * 60), '-c:a', 'aac', str(source)], check=True)
+        single, segmented = workdir / "single-720p.mp4", workdir / "segmented-720p.mp4"
+
+        before = measure(lambda: util.transcode_video_quality(source, single, 720))
+        after = measure(lambda: util.transcode_video_quality(source, segmented, 720, segment_seconds=args.segment, workers=args.workers))
+        frames = count_frames(single), count_frames(segmented)
+        sizes = single.stat().st_size, segmented.stat().st_size
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.duration}s {width}x{args.height}@60 recording to 720p with libx264 -preset {args.preset}, "
+          f"{os.cpu_count()} CPU(s), {args.segment}s segments on {args.workers} worker(s)")
+    print(f"{'':>12} {'wall (s)':>9} {'CPU (s)':>9} {'frames':>7} {'size (MiB)':>11}")
+    print(f"{'single':>12} {before[1]:>9.2f} {before[0]:>9.2f} {frames[0]:>7} {sizes[0] / 1024 / 1024:>11.1f}")
+    print(f"{'segmented':>12} {after[1]:>9.2f} {after[0]:>9.2f} {frames[1]:>7} {sizes[1] / 1024 / 1024:>11.1f}")
+    print(f"speedup {before[1] / after[1]:.2f}x")
+
+if __name__ == "__main__":
+    main()
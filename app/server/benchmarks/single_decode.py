@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compares the CPU time of deriving a new video's files with separate ffmpeg runs against one run that decodes it once.
+
+A test recording taller than 1080p is generated with ffmpeg. Its poster, seek preview, 1080p and 720p renditions
+(and with --boomerang its boomerang preview) are then created twice: with the separate util calls bulk_import
+makes, each of which decodes the source again, and with util.derive_video, which splits one decode between them.
+The CPU time of the ffmpeg processes (user + system, from getrusage of the children) and the wall time are reported.
+
+Both runs use the H.264 CPU encoder, at --preset instead of the default medium to keep the benchmark short.
+
+Usage, from app/server with the server requirements installed and ffmpeg on the PATH:
+
+    python benchmarks/single_decode.py --duration 30 --height 1440
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(fn):
+    cpu, wall = children_cpu(), time.perf_counter()
+    fn()
+    return children_cpu() - cpu, time.perf_counter() - wall
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=int, default=30, help="Length of the test recording in seconds")
+    parser.add_argument("--height", type=int, default=1440, help="Height of the test recording, above 1080 so both renditions are made")
+    parser.add_argument("--preset", default="veryfast", help="libx264 preset of the renditions")
+    parser.add_argument("--boomerang", action="store_true", help="Also create the boomerang preview (VP9, slow)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    from fireshare import util
+
+    encoder = next(e for e in util._get_encoder_candidates(False) if e['video_codec'] == 'libx264')
+    util._working_encoder_cache['cpu'] = dict(encoder, extra_args=['-preset', args.preset, '-crf', '23'])
+    interval, poster_second = 5, 0
+
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-derive-"))
+    try:
+        source = workdir / "recording.mp4"
+        width = args.height * 16 // 9 // 2 * 2
+        sp.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size={width}x{args.height}:rate=60',
+                '-f', 'lavfi', '-i', 'sine', '-t', str(args.duration), '-c:v', 'libx264', '-preset', 'ultrafast',
+                '-g', '120', '-c:a', 'aac', str(source)], check=True)
+        separate, single = workdir / "separate", workdir / "single"
+        separate.mkdir()
+        single.mkdir()
+
+        def separate_calls():
+            util.create_poster(source, separate / "poster.jpg", poster_second)
+            util.create_seek_preview(source, separate, args.duration, 16/9, interval)
+            util.transcode_video_quality(source, separate / "vid-1080p.mp4", 1080)
+            util.transcode_video_quality(source, separate / "vid-720p.mp4", 720)
+            if args.boomerang:
+                util.create_boomerang_preview(source, separate / "boomerang-preview.webm")
+
+        def single_decode():
+            written = util.derive_video(source, single, "vid", args.duration, (1080, 720), poster_second=poster_second,
+                                        seek_preview_interval=interval, aspect=16/9, boomerang=args.boomerang)
+            assert len(written) == 4 + args.boomerang, f"derive_video only wrote {written}"
+
+        before = measure(separate_calls)
+        after = measure(single_decode)
+        for name in ("vid-1080p.mp4", "vid-720p.mp4"):
+            assert (separate / name).exists() and (single / name).exists(), f"{name} is missing"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.duration}s {width}x{args.height}@60 recording, renditions with libx264 -preset {args.preset}")
+    print(f"{'':>16} {'CPU (s)':>9} {'wall (s)':>9}")
+    print(f"{'separate calls':>16} {before[0]:>9.2f} {before[1]:>9.2f}")
+    print(f"{'single decode':>16} {after[0]:>9.2f} {after[1]:>9.2f}")
+    print(f"CPU saved {1 - after[0] / before[0]:.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Compares the old glob based file collection in scan_videos with util.walk_video_files.
+
+A synthetic tree is built with a mix of videos, chunked upload parts, transcoded variants and
+non-video files (thumbnails, sidecars, recordings metadata) spread over nested folders. Both
+approaches are timed collecting the same information: the importable video files plus their
+ctime and mtime.
+
+Usage, from app/server with the server requirements installed:
+
+    python benchmarks/walk_scaling.py --files 100000
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SUPPORTED_FILE_EXTENSIONS = ['.mp4', '.mov', '.webm']
+CHUNK_FILE_PATTERN = re.compile(r'\.part\d{4}$')
+TRANSCODE_PATTERN = re.compile(r'-(?:720p|1080p)\.mp4$', re.IGNORECASE)
+
+# name template -> share of the tree
+FILE_MIX = [
+    ("clip-{i}.mp4", 0.30),
+    ("clip-{i}.mov", 0.05),
+    ("clip-{i}-720p.mp4", 0.05),
+    ("clip-{i}-1080p.mp4", 0.05),
+    ("upload-{i}.part0001", 0.05),
+    ("clip-{i}.jpg", 0.25),
+    ("clip-{i}.json", 0.15),
+    ("clip-{i}.txt", 0.10),
+]
+
+def build_tree(root: Path, count: int, per_dir: int):
+    names = []
+    for template, share in FILE_MIX:
+        names += [template] * int(share * 100)
+    for i in range(count):
+        folder = root / f"game-{i // (per_dir * 10):03d}" / f"session-{i // per_dir:05d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / names[i % len(names)].format(i=i)).touch()
+
+def glob_collect(videos_path: Path):
+    """The collection step of scan_videos before the walker was introduced"""
+    all_files = [f for f in videos_path.glob('**/*')
+                 if f.is_file() and f.suffix.lower() in SUPPORTED_FILE_EXTENSIONS]
+    result = []
+    for f in all_files:
+        if CHUNK_FILE_PATTERN.search(f.name) or TRANSCODE_PATTERN.search(f.name):
+            continue
+        path = str(f.relative_to(videos_path))
+        result.append((path, os.path.getctime(f"{videos_path}/{path}"), os.path.getmtime(f"{videos_path}/{path}")))
+    return result
+
+def walk_collect(videos_path: Path):
+    from fireshare.util import walk_video_files
+    return [(str(f.relative_to(videos_path)), st.st_ctime, st.st_mtime) for f, st in walk_video_files(videos_path)]
+
+def best_of(fn, arg, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        s = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - s
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=100000, help="total files in the synthetic tree")
+    parser.add_argument("--per-dir", type=int, default=50, help="files per leaf directory")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault("FS_LOGLEVEL", "WARNING")
+    workdir = Path(tempfile.mkdtemp(prefix="fireshare-walk-"))
+    try:
+        build_tree(workdir, args.files, args.per_dir)
+        glob_time, glob_result = best_of(glob_collect, workdir, args.repeat)
+        walk_time, walk_result = best_of(walk_collect, workdir, args.repeat)
+        assert sorted(glob_result) == sorted(walk_result), "walker and glob disagree on the set of videos"
+        print(f"tree: {args.files:,} files, {len(walk_result):,} importable videos")
+        print(f"{'glob':>8}: {glob_time:.3f}s")
+        print(f"{'scandir':>8}: {walk_time:.3f}s ({glob_time / walk_time:.1f}x)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -82,6 +82,14 @@ def create_app(init_schedule=False):
     app.config['ENABLE_TRANSCODING'] = os.getenv('ENABLE_TRANSCODING', '').lower() in ('true', '1', 'yes')
     app.config['TRANSCODE_GPU'] = os.getenv('TRANSCODE_GPU', '').lower() in ('true', '1', 'yes')
     app.config['TRANSCODE_TIMEOUT'] = int(os.getenv('TRANSCODE_TIMEOUT', '7200'))  # Default: 2 hours
+    # Number of videos `fireshare worker` transcodes at once. 0 transcodes during the import instead of queueing jobs
+    app.config['TRANSCODE_WORKERS'] = max(int(os.getenv('TRANSCODE_WORKERS', '0')), 0)
+    # CPU transcodes of videos at least twice this long are cut at keyframes into segments of about this many seconds,
+    # which TRANSCODE_SEGMENT_WORKERS ffmpeg processes encode in parallel. 0 encodes every video in one process
+    app.config['TRANSCODE_SEGMENT_SECONDS'] = max(int(os.getenv('TRANSCODE_SEGMENT_SECONDS', '0')), 0)
+    app.config['TRANSCODE_SEGMENT_WORKERS'] = max(int(os.getenv('TRANSCODE_SEGMENT_WORKERS', str(os.cpu_count() or 1))), 1)
+    # Remux MP4/MOVs with their moov box at the end into faststart copies in derived/ and serve those instead
+    app.config['ENABLE_FASTSTART'] = os.getenv('ENABLE_FASTSTART', '').lower() in ('true', '1', 'yes')
     # Comma-separated whitelist of logical video codecs the server is allowed to transcode to
     # Supported values: H264, HEVC, MPEG2, MPEG4, VC1, VP8, VP9, AV1
     # Default: only H264 enabled
@@ -93,6 +101,30 @@ def create_app(init_schedule=False):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['INIT_SCHEDULE'] = init_schedule
     app.config['MINUTES_BETWEEN_VIDEO_SCANS'] = int(os.getenv('MINUTES_BETWEEN_VIDEO_SCANS', '5'))
+    # Number of threads used to hash new or changed files during a scan
+    app.config['SCAN_HASH_WORKERS'] = max(int(os.getenv('SCAN_HASH_WORKERS', '4')), 1)
+    # Fingerprint used for the ids of newly found videos: 'header' (first 16mb) or 'sampled' (head, middle and tail blocks)
+    # Existing videos keep the id and scheme they were imported with
+    id_scheme = os.getenv('VIDEO_ID_SCHEME', 'header').strip().lower()
+    if id_scheme not in ('header', 'sampled'):
+        logger.warning(f"Unknown VIDEO_ID_SCHEME '{id_scheme}', using 'header'")
+        id_scheme = 'header'
+    app.config['VIDEO_ID_SCHEME'] = id_scheme
+    # Comma-separated folders, relative to the video directory, that scans should not descend into
+    app.config['SCAN_EXCLUDE_DIRS'] = [d.strip().strip('/') for d in os.getenv('SCAN_EXCLUDE_DIRS', '').split(',') if d.strip().strip('/')]
+    # Import new videos as they are written using inotify instead of waiting for the next scheduled scan
+    app.config['ENABLE_WATCHER'] = os.getenv('ENABLE_WATCHER', '').lower() in ('true', '1', 'yes')
+    app.config['WATCH_SETTLE_SECONDS'] = int(os.getenv('WATCH_SETTLE_SECONDS', '10'))
+    # Number of ffprobe processes run at once when reading the metadata of new videos
+    app.config['PROBE_WORKERS'] = max(int(os.getenv('PROBE_WORKERS', '4')), 1)
+    app.config['PROBE_TIMEOUT'] = int(os.getenv('PROBE_TIMEOUT', '120'))
+    # Files ffprobe can't read yet (e.g. still recording) are retried with exponential backoff starting at PROBE_RETRY_SECONDS
+    app.config['PROBE_MAX_ATTEMPTS'] = max(int(os.getenv('PROBE_MAX_ATTEMPTS', '8')), 1)
+    app.config['PROBE_RETRY_SECONDS'] = max(int(os.getenv('PROBE_RETRY_SECONDS', '60')), 1)
+    # Number of ffmpeg processes extracting posters at once
+    app.config['POSTER_WORKERS'] = max(int(os.getenv('POSTER_WORKERS', '4')), 1)
+    # Seconds between the thumbnails shown when hovering the player's seek bar, 0 disables them
+    app.config['SEEK_PREVIEW_INTERVAL'] = max(int(os.getenv('SEEK_PREVIEW_INTERVAL', '5')), 0)
     app.config['WARNINGS'] = []
 
     if (app.config['ADMIN_PASSWORD'] and app.config['ADMIN_USERNAME'] == "admin") and app.config["DISABLE_ADMINCREATE"] == False:
@@ -120,6 +152,22 @@ def create_app(init_schedule=False):
             logger.info(f"Creating subpath directory at {str(subpath.absolute())}")
             subpath.mkdir(parents=True, exist_ok=True)
 
+    # Extra video directories as comma-separated id=path pairs, e.g. "disk2=/mnt/disk2/clips,disk3=/mnt/disk3/clips"
+    # VIDEO_DIRECTORY is always the 'main' root and is where uploads are saved
+    from .constants import MAIN_LIBRARY_ROOT
+    library_roots = {MAIN_LIBRARY_ROOT: paths['video']}
+    for entry in os.getenv('VIDEO_LIBRARY_ROOTS', '').split(','):
+        if not entry.strip():
+            continue
+        root_id, _, root_path = [s.strip() for s in entry.partition('=')]
+        if not root_id or not root_path or len(root_id) > 64 or root_id in library_roots:
+            logger.warning(f"Ignoring invalid or duplicate VIDEO_LIBRARY_ROOTS entry '{entry.strip()}', expected a unique id=path")
+            continue
+        library_roots[root_id] = Path(root_path)
+        if not library_roots[root_id].is_dir():
+            logger.warning(f"Library root {root_id} at {root_path} is not a directory, it will be skipped until it is available")
+    app.config['LIBRARY_ROOTS'] = library_roots
+
     update_config(paths['data'] / 'config.json')
 
     db.init_app(app)
@@ -159,7 +207,8 @@ def create_app(init_schedule=False):
     if init_schedule:
         from .schedule import init_schedule
         init_schedule(app.config['SCHEDULED_JOBS_DATABASE_URI'],
-            app.config['MINUTES_BETWEEN_VIDEO_SCANS'])
+            app.config['MINUTES_BETWEEN_VIDEO_SCANS'], app.config['ENABLE_WATCHER'],
+            app.config['TRANSCODE_WORKERS'] if app.config['ENABLE_TRANSCODING'] else 0)
 
     with app.app_context():
         # db.create_all()
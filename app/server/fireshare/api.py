@@ -7,7 +7,7 @@ from subprocess import Popen
 import subprocess as sp
 import signal
 from textwrap import indent
-from flask import Blueprint, render_template, request, Response, jsonify, current_app, send_file, redirect
+from flask import Blueprint, render_template, request, Response, jsonify, current_app, send_file, send_from_directory, redirect
 from flask_login import current_user, login_required
 from flask_cors import CORS
 from sqlalchemy.sql import text
@@ -16,9 +16,9 @@ import time
 from werkzeug.utils import secure_filename
 
 
-from . import db, logger
-from .models import Video, VideoInfo, VideoView
-from .constants import SUPPORTED_FILE_TYPES
+from . import db, logger, util
+from .models import Video, VideoInfo, VideoView, FileIndex, MetadataRetry, ProbeCache, TranscodeJob, Rendition
+from .constants import SUPPORTED_FILE_TYPES, POSTER_WIDTHS, POSTER_FORMATS
 
 templates_path = os.environ.get('TEMPLATE_PATH') or 'templates'
 api = Blueprint('api', __name__, template_folder=templates_path)
@@ -44,18 +44,30 @@ def _rate_limited(key: str, limit: int, window_s: int) -> bool:
     _rate_limit_store[key] = bucket
     return len(bucket) > limit
 
+def get_rendition_path(id, quality):
+    """
+    The transcoded file of a video at a quality like "480p", or None if the video has no such rendition on disk
+    """
+    match = re.fullmatch(r'(\d{3,4})p', quality or '')
+    if not match:
+        return None
+    rendition = Rendition.query.filter_by(video_id=id, height=int(match.group(1))).first()
+    if not rendition:
+        return None
+    path = current_app.config['PATHS']["processed"] / rendition.path
+    return path if path.exists() else None
+
 def get_video_path(id, subid=None, quality=None):
     video = Video.query.filter_by(video_id=id).first()
     if not video:
         raise Exception(f"No video found for {id}")
     paths = current_app.config['PATHS']
 
-    # Handle quality variants (720p, 1080p)
-    if quality and quality in ['720p', '1080p']:
-        # Check if the transcoded version exists
-        derived_path = paths["processed"] / "derived" / id / f"{id}-{quality}.mp4"
-        if derived_path.exists():
-            return str(derived_path)
+    # Handle quality variants (the renditions of the transcode ladder)
+    if quality and quality != 'original':
+        rendition_path = get_rendition_path(id, quality)
+        if rendition_path:
+            return str(rendition_path)
         # Fall back to original if quality doesn't exist
         logger.warning(f"Requested quality {quality} for video {id} not found, falling back to original")
 
@@ -118,6 +130,60 @@ def get_warnings():
         else:
             return jsonify(warnings)
 
+@api.route('/api/admin/metadata-queue', methods=["GET"])
+@login_required
+def get_metadata_queue():
+    """Files whose metadata could not be read, either waiting for a retry (pending) or given up on (failed)"""
+    status = request.args.get('status')
+    if status and status not in (MetadataRetry.PENDING, MetadataRetry.FAILED):
+        return jsonify({"error": "Invalid status parameter"}), 400
+    query = db.session.query(MetadataRetry, Video.root_id, Video.path).outerjoin(Video, Video.video_id == MetadataRetry.video_id)
+    if status:
+        query = query.filter(MetadataRetry.status == status)
+    entries = [dict(entry.json(), root_id=root_id, path=path) for entry, root_id, path in query.order_by(MetadataRetry.status, MetadataRetry.next_attempt_at)]
+    return jsonify({"files": entries})
+
+_TRANSCODE_JOB_STATUSES = (TranscodeJob.QUEUED, TranscodeJob.RUNNING, TranscodeJob.DONE, TranscodeJob.FAILED, TranscodeJob.CANCELLED)
+
+@api.route('/api/admin/transcode-jobs', methods=["GET"])
+@login_required
+def get_transcode_jobs():
+    """The transcode queue, running and queued jobs first in the order they are worked on"""
+    status = request.args.get('status')
+    if status and status not in _TRANSCODE_JOB_STATUSES:
+        return jsonify({"error": "Invalid status parameter"}), 400
+    query = db.session.query(TranscodeJob, VideoInfo.title).outerjoin(VideoInfo, VideoInfo.video_id == TranscodeJob.video_id)
+    if status:
+        query = query.filter(TranscodeJob.status == status)
+    order = db.case({TranscodeJob.RUNNING: 0, TranscodeJob.QUEUED: 1}, value=TranscodeJob.status, else_=2)
+    jobs = query.order_by(order, TranscodeJob.priority.desc(), TranscodeJob.queued_at, TranscodeJob.id)
+    return jsonify({"jobs": [dict(job.json(), title=title) for job, title in jobs]})
+
+@api.route('/api/admin/transcode-jobs/<video_id>', methods=["POST"])
+@login_required
+def queue_transcode_job(video_id):
+    """Queues a video ahead of the library backlog, also when its last job failed or was cancelled"""
+    if not VideoInfo.query.filter_by(video_id=video_id).first():
+        return Response(status=404, response='A video with that id does not exist.')
+    job = TranscodeJob.enqueue(video_id, TranscodeJob.PRIORITY_NEW, regenerate=bool(request.args.get('regenerate')), retry=True)
+    if not job:
+        return Response(status=409, response='The video is already being transcoded.')
+    db.session.commit()
+    return jsonify(job.json())
+
+@api.route('/api/admin/transcode-jobs/<video_id>/cancel', methods=["POST"])
+@login_required
+def cancel_transcode_job(video_id):
+    """Cancels a queued job, or a running one, whose worker then stops its transcode within a few seconds"""
+    job = TranscodeJob.query.filter_by(video_id=video_id).first()
+    if not job:
+        return Response(status=404, response='No transcode job exists for that video.')
+    if job.status not in (TranscodeJob.QUEUED, TranscodeJob.RUNNING):
+        return Response(status=409, response=f'The transcode job is already {job.status}.')
+    job.finish(TranscodeJob.CANCELLED)
+    db.session.commit()
+    return jsonify(job.json())
+
 @api.route('/api/manual/scan')
 @login_required
 def manual_scan():
@@ -221,16 +287,24 @@ def delete_video(id):
         logging.info(f"Deleting video: {video.video_id}")
 
         paths = current_app.config['PATHS']
-        file_path = paths['video'] / video.path
+        root_path = current_app.config['LIBRARY_ROOTS'].get(video.root_id)
+        file_path = root_path / video.path if root_path else None
         link_path = paths['processed'] / 'video_links' / f"{id}{video.extension}"
         derived_path = paths['processed'] / 'derived' / id
 
         VideoInfo.query.filter_by(video_id=id).delete()
+        Rendition.query.filter_by(video_id=id).delete()
+        # A running job's worker stops its transcode once the job is gone
+        TranscodeJob.query.filter_by(video_id=id).delete()
         Video.query.filter_by(video_id=id).delete()
+        FileIndex.query.filter_by(video_id=id).delete()
+        MetadataRetry.query.filter_by(video_id=id).delete()
+        if file_path:
+            ProbeCache.query.filter_by(path=os.path.realpath(file_path)).delete()
         db.session.commit()
 
         try:
-            if file_path.exists():
+            if file_path and file_path.exists():
                 file_path.unlink()
                 logging.info(f"Deleted video file: {file_path}")
             if link_path.exists() or link_path.is_symlink():
@@ -274,13 +348,54 @@ def handle_video_details(id):
 
 @api.route('/api/video/poster', methods=['GET'])
 def get_video_poster():
+    """
+    The poster of a video. With `size` (a width in pixels) or `format` (avif, webp or jpg) one of its resized copies
+    is served instead: the smallest one at least `size` wide, in `format` or else the best format the Accept header allows.
+    """
     video_id = request.args['id']
     webm_poster_path = Path(current_app.config["PROCESSED_DIRECTORY"], "derived", video_id, "boomerang-preview.webm")
     jpg_poster_path = Path(current_app.config["PROCESSED_DIRECTORY"], "derived", video_id, "poster.jpg")
     if request.args.get('animated'):
         return send_file(webm_poster_path, mimetype='video/webm')
-    else:
+    size = request.args.get('size', type=int)
+    fmt = request.args.get('format', '').lower()
+    if not size and not fmt:
         return send_file(jpg_poster_path, mimetype='image/jpg')
+    if fmt and fmt not in POSTER_FORMATS and fmt not in ('jpg', 'jpeg'):
+        return Response(status=400, response=f"Unsupported poster format {fmt}")
+
+    if fmt:
+        formats = [fmt] if fmt in POSTER_FORMATS else []
+    else:
+        # Only formats the client names explicitly, browsers that can't decode AVIF still send */*
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+        formats = [f for f, mimetype in POSTER_FORMATS.items() if mimetype in accepted]
+    # Anything wider than the largest copy gets the full size poster
+    widths = [w for w in sorted(POSTER_WIDTHS) if w >= size] if size else [max(POSTER_WIDTHS)]
+    response = None
+    for f in formats:
+        path = next((p for p in (util.poster_variant_path(jpg_poster_path, w, f) for w in widths) if p.exists()), None)
+        if path:
+            response = send_file(path, mimetype=POSTER_FORMATS[f])
+            break
+    if response is None:
+        response = send_file(jpg_poster_path, mimetype='image/jpg')
+    if not fmt:
+        response.headers['Vary'] = 'Accept'
+    return response
+
+@api.route('/api/video/<video_id>/seek-preview.vtt', methods=['GET'])
+def get_video_seek_preview(video_id):
+    """The WebVTT index of a video's seek preview thumbnails, its cues point at regions of the sprite sheets below"""
+    derived_root = Path(current_app.config["PROCESSED_DIRECTORY"], "derived")
+    vtt_path, _ = util.seek_preview_paths(Path(video_id))
+    return send_from_directory(derived_root, str(vtt_path), mimetype='text/vtt')
+
+@api.route('/api/video/<video_id>/seek-preview/<name>', methods=['GET'])
+def get_video_seek_preview_sheet(video_id, name):
+    derived_root = Path(current_app.config["PROCESSED_DIRECTORY"], "derived")
+    _, sheets_path = util.seek_preview_paths(Path(video_id))
+    return send_from_directory(derived_root, str(sheets_path / name))
 
 @api.route('/api/video/view', methods=['POST'])
 def add_video_view():
@@ -521,7 +636,7 @@ def upload_videoChunked():
 def get_video():
     video_id = request.args.get('id')
     subid = request.args.get('subid')
-    quality = request.args.get('quality')  # Support quality parameter (720p, 1080p)
+    quality = request.args.get('quality')  # Support quality parameter (a rendition like 720p)
     video_path = get_video_path(video_id, subid, quality)
     file_size = os.stat(video_path).st_size
     start = 0
@@ -744,10 +859,8 @@ def stream_video():
 
     # If there is already a derived quality-specific mp4, prefer it; otherwise prefer the codec-specific stream cache
     preferred_mp4 = None
-    if quality in ('720p', '1080p'):
-        candidate = derived_dir / f"{video_id}-{quality}.mp4"
-        if candidate.exists():
-            preferred_mp4 = candidate
+    if quality and quality != 'original':
+        preferred_mp4 = get_rendition_path(video_id, quality)
     if preferred_mp4 is None:
         # Prefer new codec-specific cache, else fall back to legacy cache name for backward compatibility
         if out_path.exists():
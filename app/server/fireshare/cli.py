@@ -4,16 +4,21 @@ import json
 import click
 from datetime import datetime
 from flask import current_app, request
-from fireshare import create_app, db, util, logger
-from fireshare.models import User, Video, VideoInfo
+from fireshare import create_app, db, util, mp4, logger
+from fireshare.models import User, Video, VideoInfo, FileIndex, MetadataRetry, ProbeCache, TranscodeJob, Rendition
 from werkzeug.security import generate_password_hash
 from pathlib import Path
-from sqlalchemy import func
+from sqlalchemy import func, or_, and_
+from concurrent.futures import ThreadPoolExecutor
 import time
 import requests
 import re
+import glob
+import signal
+import socket
+import subprocess as sp
 
-from .constants import SUPPORTED_FILE_EXTENSIONS
+from .constants import SUPPORTED_FILE_EXTENSIONS, CHUNK_FILE_PATTERN, TRANSCODE_PATTERN, MAIN_LIBRARY_ROOT, POSTER_WIDTHS
 
 def send_discord_webhook(webhook_url=None, video_url=None):
     payload = {
@@ -42,6 +47,209 @@ def get_public_watch_url(video_id, config, host):
     else:
         return print("--Unable to post to Discord--\nPlease check that your DOMAIN env variable is set correctly or that you have a shareable link domain set in your Admin settings.")
 
+# Rows written per transaction when syncing metadata
+METADATA_BATCH_SIZE = 200
+# Upper bound for the backoff between attempts at reading a file ffprobe failed on
+PROBE_MAX_RETRY_DELAY = 6 * 60 * 60
+# Running transcode jobs whose worker hasn't sent a heartbeat for this long are put back in the queue
+TRANSCODE_JOB_STALE_SECONDS = 120
+# Times a job is started before it is failed, for videos that keep taking their transcode process down
+TRANSCODE_JOB_MAX_ATTEMPTS = 3
+
+def relocate_video(video_id, old_path, path, old_extension, extension, root_id=MAIN_LIBRARY_ROOT):
+    """
+    Re-points an existing video at its file's new location, keeping its id and everything derived from it
+    """
+    paths = current_app.config['PATHS']
+    video_links = paths["processed"] / "video_links"
+    logger.info(f"Video {video_id} moved from {old_path} to {root_id}:{path}, updating its location")
+    db.session.query(Video).filter_by(video_id=video_id).update({ "root_id": root_id, "path": path, "extension": extension, "available": True }, synchronize_session=False)
+    if old_extension != extension:
+        old_link = video_links / (video_id + old_extension)
+        if os.path.lexists(old_link):
+            old_link.unlink()
+    src = Path((current_app.config['LIBRARY_ROOTS'][root_id] / path).absolute())
+    util.link_video(util.video_link_source(paths["processed"], video_id, extension, src), video_links / (video_id + extension), replace=True)
+
+def resolve_library_file(path, root_id=None):
+    """
+    Returns (root_id, root path, file) for a path relative to a library root, or an absolute path inside one.
+    Relative paths without a root_id are relative to the main root.
+    """
+    roots = current_app.config['LIBRARY_ROOTS']
+    if root_id:
+        return root_id, roots[root_id], roots[root_id] / path
+    if Path(path).is_absolute():
+        # The deepest root wins in case one root is nested inside another
+        for rid, root_path in sorted(roots.items(), key=lambda r: len(r[1].absolute().parts), reverse=True):
+            absolute_root = root_path.absolute()
+            if Path(path) == absolute_root or absolute_root in Path(path).parents:
+                return rid, root_path, root_path / Path(path).relative_to(absolute_root)
+    return MAIN_LIBRARY_ROOT, roots[MAIN_LIBRARY_ROOT], roots[MAIN_LIBRARY_ROOT] / path
+
+def load_rendition_ladder():
+    """
+    The enabled rungs of the rendition ladder in config.json as (height, min_duration), tallest first
+    """
+    with open(current_app.config['PATHS']['data'] / "config.json") as config_file:
+        return util.rendition_ladder(json.load(config_file))
+
+def missing_renditions(vi, derived_path, ladder, regenerate=False):
+    """
+    Heights of the ladder's renditions a video should have but doesn't, all of them with regenerate
+    """
+    return [h for h in util.rendition_heights(ladder, vi.height, vi.duration)
+            if regenerate or not util.rendition_path(derived_path, vi.video_id, h).exists()]
+
+def record_rendition(video_id, height, processed_root):
+    """
+    Adds or refreshes the rendition row of a video's transcoded file at a height, with the codec and bitrate it was written with
+    """
+    path = util.rendition_path(Path(processed_root, "derived", video_id), video_id, height)
+    data = util.run_probe(path, timeout=60) or {}
+    columns = util.media_columns(data.get('streams'), data.get('format'), path.suffix)
+    return Rendition.put(video_id, height, str(path.relative_to(processed_root)), path.stat().st_size,
+                         columns['video_codec'], columns['bitrate'])
+
+def sync_renditions(vi, processed_root):
+    """
+    Matches a video's rendition rows to its transcoded files: files of any height without a row get one, rows whose
+    file is gone are removed, and rows from before the ladder (which have no size) are probed
+    """
+    derived_path = Path(processed_root, "derived", vi.video_id)
+    known = {r.height: r for r in Rendition.query.filter_by(video_id=vi.video_id)}
+    on_disk = set()
+    if derived_path.is_dir():
+        for f in derived_path.glob(f"{glob.escape(vi.video_id)}-*p.mp4"):
+            match = re.fullmatch(rf"{re.escape(vi.video_id)}-(\d{{3,4}})p\.mp4", f.name)
+            if match:
+                on_disk.add(int(match.group(1)))
+    for height in on_disk:
+        if height not in known or known[height].size is None:
+            record_rendition(vi.video_id, height, processed_root)
+    for height, rendition in known.items():
+        if height not in on_disk:
+            logger.info(f"Removing the {rendition.quality} rendition of {vi.video_id}, its file is gone")
+            db.session.delete(rendition)
+
+def segmented_transcode(vi, use_gpu):
+    """
+    Whether a video is long enough to be transcoded in parallel segments, see TRANSCODE_SEGMENT_SECONDS
+    """
+    segment_seconds = current_app.config['TRANSCODE_SEGMENT_SECONDS']
+    return bool(segment_seconds and not use_gpu and current_app.config['TRANSCODE_SEGMENT_WORKERS'] > 1
+                and (vi.duration or 0) >= 2 * segment_seconds)
+
+def hash_files(files, workers, hash_workers):
+    """
+    Video ids of a list of (path, id scheme), in the same order and None for any file that could not be read
+    """
+    ids = [None] * len(files)
+    by_scheme = {}
+    for i, (_, scheme) in enumerate(files):
+        by_scheme.setdefault(scheme, []).append(i)
+    for scheme, indexes in by_scheme.items():
+        paths = [files[i][0] for i in indexes]
+        if workers > 1:
+            hashed = util.hash_videos_sharded(paths, workers, scheme, hash_workers)
+        else:
+            hashed = util.hash_videos(paths, hash_workers, scheme)
+        for i, vid in zip(indexes, hashed):
+            ids[i] = vid
+    return ids
+
+def identify_new_files(files, ids, in_library, library_schemes, id_scheme, workers, hash_workers):
+    """
+    Ids of files that are new to the library, hashed with id_scheme into ids. A file that was imported with another
+    scheme and then moved or renamed would otherwise come back as a second video, so files whose id isn't in the
+    library (in_library(video_id) is false) are hashed with each other scheme of library_schemes as well, and take
+    the id of the video they match. Returns a list of (id, scheme).
+    """
+    found = [(vid, id_scheme) for vid in ids]
+    unmatched = [i for i, vid in enumerate(ids) if vid and not in_library(vid)]
+    for scheme in sorted(set(library_schemes) - {id_scheme}):
+        if not unmatched:
+            break
+        rehashed = hash_files([(files[i], scheme) for i in unmatched], workers, hash_workers)
+        for i, vid in zip(unmatched, rehashed):
+            if vid and in_library(vid):
+                found[i] = (vid, scheme)
+        unmatched = [i for i in unmatched if found[i][1] == id_scheme]
+    return found
+
+def collect_library_root(root_path, scan_root, exclude_dirs, file_index, full, workers, hash_workers, id_scheme, settle_seconds=0,
+                         path_schemes=None, library_ids=None):
+    """
+    Walks one library root and hashes its new or changed files without touching the database, so that roots
+    on separate disks can be collected concurrently. file_index maps the root's relative paths to their FileIndex.
+
+    Files modified less than settle_seconds ago are left for a later scan instead of being hashed: a recording
+    that is still being written would get a different id on every scan.
+
+    Files already in the library are hashed with the scheme they were imported with, taken from their index entry
+    or from path_schemes (the root's video paths and their schemes). Only new files get id_scheme, or the scheme
+    of the video in library_ids (every video_id of the library and its scheme) they turn out to be.
+    """
+    path_schemes = path_schemes or {}
+    library_ids = library_ids or {}
+    s = time.time()
+    skipped = {}
+    if workers > 1:
+        walked = util.walk_video_files_sharded(scan_root, exclude_dirs, skipped, workers)
+    else:
+        walked = util.walk_video_files(scan_root, exclude_dirs, skipped)
+    video_files = [(vf, str(vf.relative_to(root_path)), st) for vf, st in walked]
+
+    scanned_paths = {path for _, path, _ in video_files}
+    # Index entries whose file is gone, keyed by file state, so a moved or renamed file keeps its id without a rehash
+    vacated = {(fi.size, fi.mtime_ns, fi.inode): fi for p, fi in file_index.items() if p not in scanned_paths}
+
+    video_ids = {}
+    id_schemes = {}
+    to_hash = []
+    moved = []
+    known_schemes = []
+    unsettled = 0
+    for vf, path, st in video_files:
+        indexed = file_index.get(path)
+        vacated_entry = vacated.get((st.st_size, st.st_mtime_ns, st.st_ino))
+        if indexed and not full and indexed.matches(st):
+            video_ids[path] = indexed.video_id
+            id_schemes[path] = indexed.id_scheme
+        elif vacated_entry and not full:
+            moved.append(((vf, path, st), vacated_entry.video_id, vacated_entry.id_scheme))
+        elif s - st.st_mtime < settle_seconds:
+            logger.debug(f"Skipping {str(vf)} until it stops changing")
+            unsettled += 1
+        else:
+            to_hash.append((vf, path, st))
+            known_schemes.append(indexed.id_scheme if indexed else path_schemes.get(path))
+
+    if unsettled:
+        logger.info(f"Skipping {unsettled:,} file(s) in {str(scan_root)} modified in the last {settle_seconds}s, they are picked up once they stop changing")
+    logger.info(f"Hashing {len(to_hash):,} new or changed file(s) in {str(scan_root)} with {hash_workers} thread(s) in {workers} process(es), {len(moved):,} moved, {len(video_files) - len(to_hash) - len(moved) - unsettled:,} unchanged")
+    schemes = [scheme or id_scheme for scheme in known_schemes]
+    hashed_ids = list(zip(hash_files([(vf, scheme) for (vf, _, _), scheme in zip(to_hash, schemes)], workers, hash_workers), schemes))
+    new = [i for i, scheme in enumerate(known_schemes) if scheme is None]
+    identified = identify_new_files([to_hash[i][0] for i in new], [hashed_ids[i][0] for i in new], library_ids.__contains__,
+                                    library_ids.values(), id_scheme, workers, hash_workers)
+    for i, found in zip(new, identified):
+        hashed_ids[i] = found
+    hashed = [(f, vid, scheme) for f, (vid, scheme) in zip(to_hash, hashed_ids) if vid] + moved
+    for (vf, path, st), video_id, scheme in hashed:
+        video_ids[path] = video_id
+        id_schemes[path] = scheme
+
+    return {
+        "video_files": video_files,
+        "scanned_paths": scanned_paths,
+        "video_ids": video_ids,
+        "id_schemes": id_schemes,
+        "hashed": hashed,
+        "skipped": skipped,
+        "seconds": time.time() - s,
+    }
+
 @click.group()
 def cli():
     pass
@@ -64,11 +272,14 @@ def add_user(username, password):
 
 @cli.command()
 @click.option("--root", "-r", help="root video path to scan", required=False)
-def scan_videos(root):
+@click.option("--root-id", "-i", help="Id of the library root to scan, every root is scanned by default", required=False)
+@click.option("--full", "-f", help="Rehash every file, ignoring the file index", is_flag=True)
+@click.option("--workers", "-w", help="Number of processes to walk and hash each library root with", type=int, default=1)
+def scan_videos(root, root_id, full, workers):
     with create_app().app_context():
         paths = current_app.config['PATHS']
         domain = current_app.config['DOMAIN']
-        videos_path = paths["video"]
+        library_roots = current_app.config['LIBRARY_ROOTS']
         video_links = paths["processed"] / "video_links"
 
         config_file = open(paths["data"] / "config.json")
@@ -80,66 +291,130 @@ def scan_videos(root):
         if not video_links.is_dir():
             video_links.mkdir()
 
-        logger.info(f"Scanning {str(videos_path)} for {', '.join(SUPPORTED_FILE_EXTENSIONS)} video files")
-        CHUNK_FILE_PATTERN = re.compile(r'\.part\d{4}$')
-        TRANSCODE_PATTERN = re.compile(r'-(?:720p|1080p)\.mp4$', re.IGNORECASE)
-
-        # Collect all video files and filter out transcoded versions
-        all_files = [f for f in (videos_path / root if root else videos_path).glob('**/*')
-                     if f.is_file() and f.suffix.lower() in SUPPORTED_FILE_EXTENSIONS]
-
-        video_files = []
-        skipped_count = 0
-        for f in all_files:
-            if CHUNK_FILE_PATTERN.search(f.name):
-                continue  # Skip chunk files silently
-            elif TRANSCODE_PATTERN.search(f.name):
-                logger.debug(f"Skipping transcoded file: {f.name}")
-                skipped_count += 1
+        # A root path is relative to the main root unless a root id is given
+        if root_id and root_id not in library_roots:
+            logger.error(f"Unknown library root {root_id}, configured roots are: {', '.join(library_roots)}")
+            return
+        scan_ids = [root_id or MAIN_LIBRARY_ROOT] if root or root_id else list(library_roots)
+        scan_roots = {}
+        for rid in scan_ids:
+            scan_root = library_roots[rid] / root if root else library_roots[rid]
+            if scan_root.is_dir():
+                scan_roots[rid] = scan_root
             else:
-                video_files.append(f)
+                # An unmounted disk shouldn't mark its videos unavailable or empty its part of the file index
+                logger.warning(f"Skipping library root {rid}, {str(scan_root)} is not a directory")
+        logger.info(f"Scanning {', '.join(str(r) for r in scan_roots.values())} for {', '.join(SUPPORTED_FILE_EXTENSIONS)} video files")
+
+        file_index = {rid: {} for rid in library_roots}
+        for fi in FileIndex.query.all():
+            file_index.setdefault(fi.root_id, {})[fi.path] = fi
+        id_scheme = util.VIDEO_ID_SCHEMES[current_app.config['VIDEO_ID_SCHEME']]
+        hash_workers = current_app.config['SCAN_HASH_WORKERS']
+        settle_seconds = current_app.config['WATCH_SETTLE_SECONDS']
+        # Videos keep the scheme they were imported with, also when their index entries are gone or ignored by --full
+        library_ids = {}
+        path_schemes = {rid: {} for rid in library_roots}
+        for vr in db.session.query(Video.video_id, Video.root_id, Video.path, Video.id_scheme):
+            scheme = vr.id_scheme or util.VIDEO_ID_SCHEME_HEADER
+            library_ids[vr.video_id] = scheme
+            path_schemes.setdefault(vr.root_id, {})[vr.path] = scheme
 
-        if skipped_count > 0:
-            logger.info(f"Skipped {skipped_count} transcoded video file(s)")
+        exclude_dirs = {}
+        for rid, root_path in library_roots.items():
+            # Roots nested inside this one are scanned on their own
+            exclude_dirs[rid] = [root_path / d for d in current_app.config['SCAN_EXCLUDE_DIRS']]
+            exclude_dirs[rid] += [p for other, p in library_roots.items() if other != rid and root_path.absolute() in p.absolute().parents]
 
-        video_rows = Video.query.all()
+        def collect(rid):
+            return collect_library_root(library_roots[rid], scan_roots[rid], exclude_dirs[rid], file_index[rid], full, workers, hash_workers, id_scheme,
+                                        settle_seconds, path_schemes[rid], library_ids)
+
+        # Collect every root concurrently, each root usually sits on its own disk. The database is only written below
+        with ThreadPoolExecutor(max_workers=max(len(scan_roots), 1)) as pool:
+            collected = dict(zip(scan_roots, pool.map(collect, scan_roots)))
+
+        stats = {}
+        for rid, result in collected.items():
+            files, seconds = len(result["video_files"]), result["seconds"]
+            stats[rid] = { "files": files, "hashed": len(result["hashed"]), "seconds": round(seconds, 2), "files_per_sec": round(files / seconds) if seconds else 0 }
+            logger.info(f"Collected {files:,} file(s) from library root {rid} in {seconds:.2f}s ({stats[rid]['files_per_sec']:,} files/s)")
+            if result["skipped"].get('transcoded'):
+                logger.info(f"Skipped {result['skipped']['transcoded']} transcoded video file(s) in library root {rid}")
+            for (vf, path, st), video_id, scheme in result["hashed"]:
+                indexed = file_index[rid].get(path)
+                if not indexed:
+                    indexed = FileIndex(root_id=rid, path=path)
+                    file_index[rid][path] = indexed
+                    db.session.add(indexed)
+                indexed.update_state(st, video_id, scheme)
+
+        # Only the columns needed to reconcile, keyed by video_id. Avoids joined-loading every VideoInfo and its ffprobe blob
+        video_rows = {vr.video_id: vr for vr in db.session.query(Video.video_id, Video.root_id, Video.path, Video.extension, Video.available, Video.created_at, Video.updated_at)}
+        scanned = {(rid, path) for rid, result in collected.items() for path in result["scanned_paths"]}
+        scan_prefix = f"{Path(root)}/" if root else ""
+
+        def vacated(location):
+            rid, path = location
+            if rid not in library_roots:
+                return True
+            if rid not in scan_roots:
+                # Not scanned this time, possibly because its disk isn't mounted
+                return False
+            if path.startswith(scan_prefix):
+                return location not in scanned
+            # Outside the scanned subtree of the root, so whether the file is gone has to be checked on disk
+            return not (library_roots[rid] / path).exists()
 
         new_videos = []
-        for vf in video_files:
-            path = str(vf.relative_to(videos_path))
-            video_id = util.video_id(vf)
-            existing = next((vr for vr in video_rows if vr.video_id == video_id), None)
-            duplicate = next((dvr for dvr in new_videos if dvr.video_id == video_id), None)
-            if duplicate:
-                logger.info(f"Found duplicate video {video_id} as {str(path)}, skipping...")
-            elif existing:
-                if not existing.available:
-                    logger.info(f"Updating Video {video_id}, available=True")
-                    db.session.query(Video).filter_by(video_id=existing.video_id).update({ "available": True })
-                if not existing.created_at:
-                    created_at = datetime.fromtimestamp(os.path.getctime(f"{videos_path}/{path}"))
-                    logger.info(f"Updating Video {video_id}, created_at={created_at}")
-                    db.session.query(Video).filter_by(video_id=existing.video_id).update({ "created_at": created_at })
-                if not existing.updated_at:
-                    updated_at = datetime.fromtimestamp(os.path.getmtime(f"{videos_path}/{path}"))
-                    logger.info(f"Updating Video {video_id}, updated_at={updated_at}")
-                    db.session.query(Video).filter_by(video_id=existing.video_id).update({ "updated_at": updated_at })
-            else:
-                created_at = datetime.fromtimestamp(os.path.getctime(f"{videos_path}/{path}"))
-                updated_at = datetime.fromtimestamp(os.path.getmtime(f"{videos_path}/{path}"))
-                v = Video(video_id=video_id, extension=vf.suffix, path=path, available=True, created_at=created_at, updated_at=updated_at)
-                logger.info(f"Adding new Video {video_id} at {str(path)} (created {created_at.isoformat()}, updated {updated_at.isoformat()})")
-                new_videos.append(v)
+        new_video_ids = set()
+        relocated = {}
+        for rid, result in collected.items():
+            for vf, path, st in result["video_files"]:
+                video_id = result["video_ids"].get(path)
+                if not video_id:
+                    continue
+                existing = video_rows.get(video_id)
+                if video_id in new_video_ids:
+                    logger.info(f"Found duplicate video {video_id} as {str(path)}, skipping...")
+                elif existing:
+                    current = relocated.get(video_id, (existing.root_id, existing.path))
+                    if current != (rid, path) and vacated(current):
+                        # Same content at a new location and nothing left at the old one, the file was moved or renamed
+                        relocate_video(video_id, current[1], path, existing.extension, vf.suffix, rid)
+                        relocated[video_id] = (rid, path)
+                    if not existing.created_at:
+                        created_at = datetime.fromtimestamp(st.st_ctime)
+                        logger.info(f"Updating Video {video_id}, created_at={created_at}")
+                        db.session.query(Video).filter_by(video_id=existing.video_id).update({ "created_at": created_at })
+                    if not existing.updated_at:
+                        updated_at = datetime.fromtimestamp(st.st_mtime)
+                        logger.info(f"Updating Video {video_id}, updated_at={updated_at}")
+                        db.session.query(Video).filter_by(video_id=existing.video_id).update({ "updated_at": updated_at })
+                else:
+                    created_at = datetime.fromtimestamp(st.st_ctime)
+                    updated_at = datetime.fromtimestamp(st.st_mtime)
+                    v = Video(video_id=video_id, extension=vf.suffix, path=path, available=True, created_at=created_at, updated_at=updated_at, id_scheme=result["id_schemes"][path], root_id=rid)
+                    logger.info(f"Adding new Video {video_id} at {rid}:{str(path)} (created {created_at.isoformat()}, updated {updated_at.isoformat()})")
+                    new_videos.append(v)
+                    new_video_ids.add(video_id)
+
+        # Forget index entries for files that are no longer in the scanned trees
+        for rid in scan_roots:
+            for indexed_path, indexed in file_index[rid].items():
+                if indexed_path.startswith(scan_prefix) and indexed_path not in collected[rid]["scanned_paths"]:
+                    logger.debug(f"Removing {rid}:{indexed_path} from the file index")
+                    db.session.delete(indexed)
 
         if new_videos:
             db.session.add_all(new_videos)
         else:
-            logger.info(f"No new videos found, checked {len(video_files)} files.")
+            logger.info(f"No new videos found, checked {len(scanned)} files.")
         db.session.commit()
 
         fd = os.open(str(video_links.absolute()), os.O_DIRECTORY)
         for nv in new_videos:
-            src = Path((paths["video"] / nv.path).absolute())
+            src = Path((library_roots[nv.root_id] / nv.path).absolute())
             dst = Path(paths["processed"] / "video_links" / (nv.video_id + nv.extension))
             common_root = Path(*os.path.commonprefix([src.parts, dst.parts]))
             num_up = len(dst.parts)-1 - len(common_root.parts)
@@ -160,24 +435,40 @@ def scan_videos(root):
                 video_url = get_public_watch_url(nv.video_id, config, domain)
                 send_discord_webhook(webhook_url=discord_webhook_url, video_url=video_url)
 
-        existing_videos = Video.query.filter_by(available=True).all()
-        logger.info(f"Verifying {len(existing_videos):,} video files still exist...")
-        for ev in existing_videos:
-            file_path = Path((paths["video"] / ev.path).absolute())
-            logger.debug(f"Verifying video {ev.video_id} at {file_path} is available")
-            if not file_path.exists():
-                logger.warning(f"Video {ev.video_id} at {file_path} was not found")
-                db.session.query(Video).filter_by(video_id=ev.video_id).update({ "available": False})
+        # Diff the files found on disk against the database instead of checking every video's path one at a time
+        video_rows = db.session.query(Video.id, Video.video_id, Video.root_id, Video.path, Video.available).filter(Video.root_id.in_(list(scan_roots)))
+        if scan_prefix:
+            video_rows = video_rows.filter(Video.path.startswith(scan_prefix, autoescape=True))
+        video_rows = video_rows.all()
+        logger.info(f"Verifying {len(video_rows):,} video files still exist...")
+        missing, restored = [], []
+        for vr in video_rows:
+            if vr.available and (vr.root_id, vr.path) not in scanned:
+                logger.warning(f"Video {vr.video_id} at {str(library_roots[vr.root_id] / vr.path)} was not found")
+                missing.append(vr.id)
+            elif not vr.available and (vr.root_id, vr.path) in scanned:
+                logger.info(f"Updating Video {vr.video_id}, available=True")
+                restored.append(vr.id)
+        for ids, available in ((missing, False), (restored, True)):
+            for chunk in util.chunks(ids):
+                db.session.query(Video).filter(Video.id.in_(chunk)).update({ "available": available }, synchronize_session=False)
         db.session.commit()
+        return stats
 
 @cli.command()
 @click.pass_context
 @click.option("--path", "-p", help="path to video to scan", required=False)
-def scan_video(ctx, path):
+@click.option("--root-id", "-i", help="Id of the library root a relative path is in, defaults to the main root", required=False)
+def scan_video(ctx, path, root_id):
     with create_app().app_context():
         paths = current_app.config['PATHS']
         domain = current_app.config['DOMAIN']
-        videos_path = paths["video"]
+        library_roots = current_app.config['LIBRARY_ROOTS']
+        if root_id and root_id not in library_roots:
+            logger.error(f"Unknown library root {root_id}, configured roots are: {', '.join(library_roots)}")
+            return
+        root_id, videos_path, video_path = resolve_library_file(path, root_id)
+        path = str(video_path.relative_to(videos_path))
         video_links = paths["processed"] / "video_links"
         thumbnail_skip = current_app.config['THUMBNAIL_VIDEO_LOCATION'] or 0
         if thumbnail_skip > 0 and thumbnail_skip <= 100:
@@ -195,9 +486,6 @@ def scan_video(ctx, path):
         if not video_links.is_dir():
             video_links.mkdir()
 
-        CHUNK_FILE_PATTERN = re.compile(r'\.part\d{4}$')
-        TRANSCODE_PATTERN = re.compile(r'-(?:720p|1080p)\.mp4$', re.IGNORECASE)
-
         # Check if the file is a transcoded version and skip it
         if (videos_path / path).is_file() and TRANSCODE_PATTERN.search((videos_path / path).name):
             logger.warning(f"Skipping transcoded file: {path}. Transcoded files should not be scanned.")
@@ -208,14 +496,36 @@ def scan_video(ctx, path):
                      and not CHUNK_FILE_PATTERN.search((videos_path / path).name)
                      and not TRANSCODE_PATTERN.search((videos_path / path).name) else None)
         if video_file:
-            video_rows = Video.query.all()
             logger.info(f"Scanning {str(video_file)}")
 
             path = str(video_file.relative_to(videos_path))
-            video_id = util.video_id(video_file)
-            existing = next((vr for vr in video_rows if vr.video_id == video_id), None)
+            st = video_file.stat()
+            indexed = FileIndex.query.filter_by(root_id=root_id, path=path).first()
+            if indexed and indexed.matches(st):
+                video_id = indexed.video_id
+                id_scheme = indexed.id_scheme
+            else:
+                # A file already in the library keeps the scheme it was imported with
+                imported = db.session.query(Video.id_scheme).filter_by(root_id=root_id, path=path).first()
+                if indexed or imported:
+                    id_scheme = (indexed.id_scheme if indexed else imported.id_scheme) or util.VIDEO_ID_SCHEME_HEADER
+                    video_id = util.compute_video_id(video_file, id_scheme)
+                else:
+                    id_scheme = util.VIDEO_ID_SCHEMES[current_app.config['VIDEO_ID_SCHEME']]
+                    in_library = lambda vid: db.session.query(Video.id).filter_by(video_id=vid).first() is not None
+                    library_schemes = [row.id_scheme or util.VIDEO_ID_SCHEME_HEADER for row in db.session.query(Video.id_scheme).distinct()]
+                    (video_id, id_scheme), = identify_new_files([video_file], [util.compute_video_id(video_file, id_scheme)],
+                                                                in_library, library_schemes, id_scheme, 1, 1)
+                if not indexed:
+                    indexed = FileIndex(root_id=root_id, path=path)
+                    db.session.add(indexed)
+                indexed.update_state(st, video_id, id_scheme)
+            existing = db.session.query(Video.video_id, Video.root_id, Video.path, Video.extension, Video.available, Video.created_at, Video.updated_at).filter_by(video_id=video_id).first()
             if existing:
-                if not existing.available:
+                old_root = library_roots.get(existing.root_id)
+                if (existing.root_id, existing.path) != (root_id, path) and not (old_root and (old_root / existing.path).exists()):
+                    relocate_video(video_id, existing.path, path, existing.extension, video_file.suffix, root_id)
+                elif not existing.available:
                     logger.info(f"Updating Video {video_id}, available=True")
                     db.session.query(Video).filter_by(video_id=existing.video_id).update({ "available": True })
                 if not existing.created_at:
@@ -226,14 +536,15 @@ def scan_video(ctx, path):
                     updated_at = datetime.fromtimestamp(os.path.getmtime(f"{videos_path}/{path}"))
                     logger.info(f"Updating Video {video_id}, updated_at={updated_at}")
                     db.session.query(Video).filter_by(video_id=existing.video_id).update({ "updated_at": updated_at })
+                db.session.commit()
             else:
                 created_at = datetime.fromtimestamp(os.path.getctime(f"{videos_path}/{path}"))
                 updated_at = datetime.fromtimestamp(os.path.getmtime(f"{videos_path}/{path}"))
-                v = Video(video_id=video_id, extension=video_file.suffix, path=path, available=True, created_at=created_at, updated_at=updated_at)
-                logger.info(f"Adding new Video {video_id} at {str(path)} (created {created_at.isoformat()}, updated {updated_at.isoformat()})")
+                v = Video(video_id=video_id, extension=video_file.suffix, path=path, available=True, created_at=created_at, updated_at=updated_at, id_scheme=id_scheme, root_id=root_id)
+                logger.info(f"Adding new Video {video_id} at {root_id}:{str(path)} (created {created_at.isoformat()}, updated {updated_at.isoformat()})")
                 db.session.add(v)
                 fd = os.open(str(video_links.absolute()), os.O_DIRECTORY)
-                src = Path((paths["video"] / v.path).absolute())
+                src = Path((videos_path / v.path).absolute())
                 dst = Path(paths["processed"] / "video_links" / (video_id + video_file.suffix))
                 common_root = Path(*os.path.commonprefix([src.parts, dst.parts]))
                 num_up = len(dst.parts)-1 - len(common_root.parts)
@@ -257,7 +568,10 @@ def scan_video(ctx, path):
                 logger.info(f"Checking for videos with missing posters...")
                 derived_path = Path(processed_root, "derived", info.video_id)
                 video_path = Path(processed_root, "video_links", info.video_id + video_file.suffix)
-                if video_path.exists():
+                if info.duration is None:
+                    # The file couldn't be read yet and is queued for a retry, the next scan creates its poster
+                    logger.info(f"Skipping creation of poster for video {info.video_id} until its metadata can be read")
+                elif video_path.exists():
 
                     poster_path = Path(derived_path, "poster.jpg")
                     should_create_poster = (not poster_path.exists() or regenerate)
@@ -265,9 +579,17 @@ def scan_video(ctx, path):
                         if not derived_path.exists():
                             derived_path.mkdir(parents=True)
                         poster_time = int(info.duration * thumbnail_skip)
-                        util.create_poster(video_path, derived_path / "poster.jpg", poster_time)
+                        if util.create_poster(video_path, derived_path / "poster.jpg", poster_time):
+                            util.create_poster_variants(derived_path / "poster.jpg")
                     else:
                         logger.debug(f"Skipping creation of poster for video {info.video_id} because it exists at {str(poster_path)}")
+                    if current_app.config['SEEK_PREVIEW_INTERVAL']:
+                        util.create_seek_preview(video_path, derived_path, info.duration,
+                                                 info.width / info.height if info.width and info.height else None,
+                                                 current_app.config['SEEK_PREVIEW_INTERVAL'])
+                    if current_app.config.get('ENABLE_TRANSCODING') and current_app.config['TRANSCODE_WORKERS'] and missing_renditions(info, derived_path, util.rendition_ladder(config)):
+                        # Ahead of the backlog of the library, so a new upload doesn't wait behind old re-encodes
+                        TranscodeJob.enqueue(info.video_id, TranscodeJob.PRIORITY_NEW)
                     db.session.commit()
 
                     if discord_webhook_url:
@@ -279,6 +601,55 @@ def scan_video(ctx, path):
         else:
             logger.info(f"Invalid video file, unable to scan: {str(videos_path / path)}")
 
+@cli.command()
+@click.pass_context
+@click.option("--settle", "-s", help="Seconds a file must stop changing before it is imported", type=int, default=None)
+def watch(ctx, settle):
+    """Watch every library root with inotify and import videos as soon as they finish writing"""
+    from .watcher import VideoWatcher
+    with create_app().app_context():
+        paths = current_app.config['PATHS']
+        roots = {p.absolute(): [p.absolute() / d for d in current_app.config['SCAN_EXCLUDE_DIRS']]
+                 for p in current_app.config['LIBRARY_ROOTS'].values() if p.is_dir()}
+        if settle is None:
+            settle = current_app.config['WATCH_SETTLE_SECONDS']
+
+        def on_ready(file_path):
+            if util.lock_exists(paths["data"]):
+                logger.debug(f"A scan process is currently active, delaying import of {str(file_path)}")
+                return False
+            ctx.invoke(scan_video, path=str(file_path))
+
+        def on_removed(file_path, is_dir):
+            root_id, root_path, file_path = resolve_library_file(str(file_path))
+            path = str(file_path.relative_to(root_path))
+            if is_dir:
+                match = Video.path.startswith(f"{path}/", autoescape=True)
+                index_match = FileIndex.path.startswith(f"{path}/", autoescape=True)
+            else:
+                match = Video.path == path
+                index_match = FileIndex.path == path
+            missing = db.session.query(Video).filter(Video.root_id == root_id, match, Video.available == True).update({ "available": False }, synchronize_session=False)
+            FileIndex.query.filter(FileIndex.root_id == root_id, index_match).delete(synchronize_session=False)
+            db.session.commit()
+            if missing:
+                logger.info(f"Marked {missing} video(s) at {path} unavailable")
+
+        def on_overflow():
+            ctx.invoke(bulk_import)
+
+        def rolling_back(callback):
+            # The watcher logs a failed callback and carries on, so leave the session usable for the next one
+            def wrapper(*args):
+                try:
+                    return callback(*args)
+                except Exception:
+                    db.session.rollback()
+                    raise
+            return wrapper
+
+        VideoWatcher(roots, settle, rolling_back(on_ready), rolling_back(on_removed), rolling_back(on_overflow)).run()
+
 @cli.command()
 def repair_symlinks():
     with create_app().app_context():
@@ -288,68 +659,159 @@ def repair_symlinks():
         if not video_links.is_dir():
             video_links.mkdir()
 
-        fd = os.open(str(video_links.absolute()), os.O_DIRECTORY)
-        all_videos = Video.query.all()
+        library_roots = current_app.config['LIBRARY_ROOTS']
+        all_videos = db.session.query(Video.video_id, Video.root_id, Video.path, Video.extension)
         for nv in all_videos:
-            src = Path((paths["video"] / nv.path).absolute())
+            if nv.root_id not in library_roots:
+                logger.warning(f"Skipping video {nv.video_id}, its library root {nv.root_id} is no longer configured")
+                continue
+            src = util.video_link_source(paths["processed"], nv.video_id, nv.extension, Path((library_roots[nv.root_id] / nv.path).absolute()))
             dst = Path(paths["processed"] / "video_links" / (nv.video_id + nv.extension))
-            common_root = Path(*os.path.commonprefix([src.parts, dst.parts]))
-            num_up = len(dst.parts)-1 - len(common_root.parts)
-            prefix = "../" * num_up
-            rel_src = Path(prefix + str(src).replace(str(common_root), ''))
-            if not dst.exists():
-                logger.info(f"Linking {str(rel_src)} --> {str(dst)}")
-                try:
-                    os.symlink(src, dst, dir_fd=fd)
-                except FileExistsError:
-                    logger.info(f"{dst} exists already")
+            # Also replaces links left dangling by videos that have been moved since they were linked
+            util.link_video(src, dst, replace=src.exists())
 
 @cli.command()
 @click.option("--video", "-v", help="The video to sync metadata from", default=None)
-def sync_metadata(video):
+@click.option("--jobs", "-j", help="Number of videos to probe at once, defaults to PROBE_WORKERS", type=int, default=None)
+def sync_metadata(video, jobs):
     with create_app().app_context():
         paths = current_app.config['PATHS']
-        videos = VideoInfo.query.filter(VideoInfo.video_id==video).all() if video else VideoInfo.query.filter(VideoInfo.info==None).all()
-        logger.info(f'Found {len(videos):,} videos without metadata')
-        for v in videos:
-            vpath = paths["processed"] / "video_links" / str(v.video_id + v.video.extension)
-            if Path(vpath).is_file():
-                info = None
-                while info == None:
-                    info = util.get_media_info(vpath)
-                    if info == None:
-                        corruptVideoWarning = "There may be a corrupt video in your video Directory. See your logs for more info!"
-                        if not corruptVideoWarning in current_app.config['WARNINGS']:
-                            current_app.config['WARNINGS'].append(corruptVideoWarning)
-                        logger.warning(f"[{v.video.path}] - There may be a corrupt file in your video directory. Or, you may be recording to the video directory and haven't finished yet.")
-                        logger.warning(f"For more info and to find the offending file, run this command in your container: \"stat {vpath}\"")
-                        logger.warning("I'll try to process this file again in 60 seconds...")
-                        time.sleep(60)
-
-                corruptVideoWarning = "There may be a corrupt video in your video Directory. See your logs for more info!"
-                if corruptVideoWarning in current_app.config['WARNINGS']:
-                    position = current_app.config['WARNINGS'].index(corruptVideoWarning)
-                    current_app.config['WARNINGS'].pop(position)
-
-                vcodec = [i for i in info if i['codec_type'] == 'video'][0]
-                duration = 0
-                if 'duration' in vcodec:
-                    duration = float(vcodec['duration'])
-                elif 'tags' in vcodec:
-                    if 'DURATION' in vcodec['tags']:
-                        duration = util.dur_string_to_seconds(vcodec['tags']['DURATION'])
-                    else:
-                        duration = 0
-                width, height = int(vcodec['width']), int(vcodec['height'])
-                logger.info(f'Scanned {v.video_id} duration={duration}s, resolution={width}x{height}: {v.video.path}')
-                v.info = json.dumps(info)
-                v.duration = duration
-                v.width = width
-                v.height = height
-                db.session.add(v)
-                db.session.commit()
+        jobs = max(jobs or current_app.config['PROBE_WORKERS'], 1)
+        timeout = current_app.config['PROBE_TIMEOUT']
+        max_attempts = current_app.config['PROBE_MAX_ATTEMPTS']
+        retry_delay = current_app.config['PROBE_RETRY_SECONDS']
+        query = db.session.query(VideoInfo.id, VideoInfo.video_id, Video.extension, Video.path).join(Video, VideoInfo.video_id == Video.video_id)
+        if video:
+            videos = query.filter(VideoInfo.video_id==video).all()
+        else:
+            # Files that failed before are only probed again once their backoff has passed, and never after max attempts
+            now = datetime.utcnow()
+            videos = (query.outerjoin(MetadataRetry, MetadataRetry.video_id == VideoInfo.video_id)
+                .filter(VideoInfo.info==None)
+                .filter(or_(MetadataRetry.id == None, and_(MetadataRetry.status == MetadataRetry.PENDING, MetadataRetry.next_attempt_at <= now)))
+                .all())
+            deferred = MetadataRetry.query.filter(MetadataRetry.status == MetadataRetry.PENDING, MetadataRetry.next_attempt_at > now).count()
+            if deferred:
+                logger.info(f"Deferring {deferred:,} video(s) that could not be read until their next retry")
+        logger.info(f'Found {len(videos):,} videos without metadata, probing with {jobs} worker(s)')
+
+        # Probes cached by the web server or an earlier run, loaded up front since the workers can't use the session
+        real_paths = [os.path.realpath(paths["processed"] / "video_links" / str(v.video_id + v.extension)) for v in videos]
+        cached = {}
+        for chunk in util.chunks(real_paths):
+            cached.update({pc.path: pc for pc in db.session.query(ProbeCache.path, ProbeCache.size, ProbeCache.mtime_ns, ProbeCache.data).filter(ProbeCache.path.in_(chunk))})
+
+        def probe(v):
+            # Runs in a worker thread, so nothing in here may touch the app or the database session
+            vpath = paths["processed"] / "video_links" / str(v.video_id + v.extension)
+            if not vpath.is_file():
+                logger.warning(f"Missing or invalid symlink at {vpath} to video {v.video_id} (original location: {v.path})")
+                return None, None
+            key = util.probe_key(vpath)
+            hit = cached.get(key[0])
+            if hit and (hit.size, hit.mtime_ns) == key[1:]:
+                data, fresh = json.loads(hit.data), False
             else:
-                logger.warning(f"Missing or invalid symlink at {vpath} to video {v.video_id} (original location: {v.video.path})")
+                data, fresh = util.run_probe(vpath, timeout), True
+            info = data['streams'] if data else None
+            vcodec = [i for i in info if i['codec_type'] == 'video'] if info else None
+            if not vcodec:
+                logger.warning(f"[{v.path}] - There may be a corrupt file in your video directory. Or, you may be recording to the video directory and haven't finished yet.")
+                logger.warning(f"For more info and to find the offending file, run this command in your container: \"stat {vpath}\"")
+                raise ValueError("ffprobe found no readable video stream" if info is not None else "ffprobe could not read the file")
+            vcodec = vcodec[0]
+            duration = 0
+            if 'duration' in vcodec:
+                duration = float(vcodec['duration'])
+            elif 'tags' in vcodec:
+                if 'DURATION' in vcodec['tags']:
+                    duration = util.dur_string_to_seconds(vcodec['tags']['DURATION'])
+                else:
+                    duration = 0
+            width, height = int(vcodec['width']), int(vcodec['height'])
+            logger.info(f'Scanned {v.video_id} duration={duration}s, resolution={width}x{height}: {v.path}')
+            probed = { "path": key[0], "size": key[1], "mtime_ns": key[2], "data": json.dumps(data), "probed_at": datetime.utcnow() } if fresh else None
+            result = { "id": v.id, "info": json.dumps(info), "duration": duration, "width": width, "height": height }
+            result["faststart"] = mp4.is_faststart(vpath) if v.extension.lower() in mp4.NATIVE_PROBE_EXTENSIONS else None
+            result.update(util.media_columns(info, data['format'], v.extension))
+            return result, probed
+
+        def safe_probe(v):
+            try:
+                return (v, *probe(v), None)
+            except Exception as ex:
+                return v, None, None, str(ex) or type(ex).__name__
+
+        def write(batch, video_ids, probes):
+            db.session.bulk_update_mappings(VideoInfo, batch)
+            MetadataRetry.query.filter(MetadataRetry.video_id.in_(video_ids)).delete(synchronize_session=False)
+            if probes:
+                db.session.execute(ProbeCache.__table__.delete().where(ProbeCache.path.in_([p["path"] for p in probes])))
+                db.session.execute(ProbeCache.__table__.insert(), probes)
+            db.session.commit()
+
+        # Results are written in batches, committing every row made the fsync the bottleneck on large imports
+        batch, batch_ids, probes, failed = [], [], {}, 0
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for v, result, probed, error in pool.map(safe_probe, videos):
+                if error:
+                    failed += 1
+                    entry = MetadataRetry.record_failure(v.video_id, error, max_attempts, retry_delay, PROBE_MAX_RETRY_DELAY)
+                    if entry.status == MetadataRetry.FAILED:
+                        logger.warning(f"Giving up on reading video {v.video_id} at {v.path} after {entry.attempts} attempts: {error}")
+                    else:
+                        logger.warning(f"Unable to read video {v.video_id} at {v.path} ({error}), attempt {entry.attempts}/{max_attempts}, retrying after {entry.next_attempt_at.isoformat()} UTC")
+                elif result:
+                    batch.append(result)
+                    batch_ids.append(v.video_id)
+                    if probed:
+                        probes[probed["path"]] = probed
+                if len(batch) >= METADATA_BATCH_SIZE:
+                    write(batch, batch_ids, list(probes.values()))
+                    batch, batch_ids, probes = [], [], {}
+        write(batch, batch_ids, list(probes.values()))
+
+        corruptVideoWarning = "There may be a corrupt video in your video Directory. See your logs for more info!"
+        if failed:
+            if not corruptVideoWarning in current_app.config['WARNINGS']:
+                current_app.config['WARNINGS'].append(corruptVideoWarning)
+        elif corruptVideoWarning in current_app.config['WARNINGS']:
+            current_app.config['WARNINGS'].remove(corruptVideoWarning)
+
+@cli.command()
+@click.option("--all", "-a", "all_videos", help="Recompute the columns of every video, not only the ones missing them", is_flag=True)
+def backfill_media_info(all_videos):
+    """Fill the codec, frame rate, bitrate, pixel format and container columns from each video's stored probe"""
+    with create_app().app_context():
+        paths = current_app.config['PATHS']
+        query = db.session.query(VideoInfo.id, VideoInfo.video_id, VideoInfo.info, Video.extension).join(Video, VideoInfo.video_id == Video.video_id).filter(VideoInfo.info != None)
+        if not all_videos:
+            query = query.filter(VideoInfo.video_codec == None)
+        rows = query.all()
+        if not rows:
+            logger.debug("No videos need their media columns filled in")
+            return
+        logger.info(f"Filling in media columns for {len(rows):,} video(s)")
+
+        # VideoInfo.info only holds the streams, the container comes from the probe cache when the file has an entry
+        real_paths = {row.video_id: os.path.realpath(paths["processed"] / "video_links" / str(row.video_id + row.extension)) for row in rows}
+        formats = {}
+        for chunk in util.chunks(list(real_paths.values())):
+            for pc in db.session.query(ProbeCache.path, ProbeCache.data).filter(ProbeCache.path.in_(chunk)):
+                formats[pc.path] = json.loads(pc.data).get('format')
+
+        batch = []
+        for row in rows:
+            try:
+                streams = json.loads(row.info)
+            except ValueError:
+                logger.warning(f"Skipping video {row.video_id}, its stored probe is not valid JSON")
+                continue
+            batch.append(dict(util.media_columns(streams, formats.get(real_paths[row.video_id]), row.extension), id=row.id))
+        for chunk in util.chunks(batch, METADATA_BATCH_SIZE * 5):
+            db.session.bulk_update_mappings(VideoInfo, chunk)
+            db.session.commit()
+        logger.info(f"Filled in media columns for {len(batch):,} video(s)")
 
 @cli.command()
 def create_web_videos():
@@ -389,26 +851,57 @@ def create_web_videos():
 @cli.command()
 @click.option("--regenerate", "-r", help="Overwrite existing posters", is_flag=True)
 @click.option("--skip", "-s", help="Amount to skip into the video before extracting a poster image, as a %, e.g. 0.05 for 5%", type=float, default=0)
-def create_posters(regenerate, skip):
+@click.option("--jobs", "-j", help="Number of posters to extract at once, defaults to POSTER_WORKERS", type=int, default=None)
+def create_posters(regenerate, skip, jobs):
     with create_app().app_context():
         processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        jobs = max(jobs or current_app.config['POSTER_WORKERS'], 1)
+        variant_formats = util.poster_variant_formats()
         vinfos = VideoInfo.query.all()
         logger.info(f"Checking for videos with missing posters...")
+        tasks = []
         for vi in vinfos:
             derived_path = Path(processed_root, "derived", vi.video_id)
             video_path = Path(processed_root, "video_links", vi.video_id + vi.video.extension)
             if not video_path.exists():
                 logger.warning(f"Skipping creation of poster for video {vi.video_id} because the video at {str(video_path)} does not exist or is not accessible")
                 continue
+            if vi.duration is None:
+                logger.debug(f"Skipping creation of poster for video {vi.video_id} because its metadata has not been read yet")
+                continue
             poster_path = Path(derived_path, "poster.jpg")
             should_create_poster = (not poster_path.exists() or regenerate)
             if should_create_poster:
                 if not derived_path.exists():
                     derived_path.mkdir(parents=True)
                 poster_time = int(vi.duration * skip)
-                util.create_poster(video_path, derived_path / "poster.jpg", poster_time)
+                tasks.append((video_path, poster_path, poster_time))
+            elif not all(util.poster_variant_path(poster_path, w, f).exists() for w in POSTER_WIDTHS for f in variant_formats):
+                # Posters created before the resized copies existed only need those
+                tasks.append((video_path, poster_path, None))
             else:
                 logger.debug(f"Skipping creation of poster for video {vi.video_id} because it exists at {str(poster_path)}")
+        if not tasks:
+            return
+
+        def create(task):
+            # Runs in a worker thread, each poster is its own ffmpeg process
+            video_path, poster_path, poster_time = task
+            s = time.time()
+            ok = poster_time is None or util.create_poster(video_path, poster_path, poster_time)
+            if ok and variant_formats:
+                util.create_poster_variants(poster_path)
+            return ok, time.time() - s
+
+        logger.info(f"Creating {len(tasks):,} poster(s) with {jobs} worker(s)")
+        s = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(create, tasks))
+        latencies = [elapsed for _, elapsed in results]
+        failed = sum(1 for ok, _ in results if not ok)
+        logger.info(f"Created {len(tasks) - failed:,} poster(s) in {time.time() - s:.2f}s ({failed:,} failed), per poster "
+                    f"p50={util.percentile(latencies, 50):.2f}s p90={util.percentile(latencies, 90):.2f}s "
+                    f"p99={util.percentile(latencies, 99):.2f}s max={max(latencies):.2f}s")
 
 @cli.command()
 @click.option("--regenerate", "-r", help="Overwrite existing posters", is_flag=True)
@@ -431,11 +924,150 @@ def create_boomerang_posters(regenerate):
             else:
                 logger.info(f"Skipping creation of boomerang poster for video {vi.video_id} because it exists at {str(poster_path)}")
 
+@cli.command()
+@click.option("--regenerate", "-r", help="Overwrite existing seek previews", is_flag=True)
+@click.option("--video", "-v", help="Only create the seek preview of a specific video by id", default=None)
+@click.option("--jobs", "-j", help="Number of seek previews to create at once, defaults to POSTER_WORKERS", type=int, default=None)
+def create_seek_previews(regenerate, video, jobs):
+    with create_app().app_context():
+        interval = current_app.config['SEEK_PREVIEW_INTERVAL']
+        if not interval:
+            logger.info("Seek previews are disabled. Set SEEK_PREVIEW_INTERVAL to enable.")
+            return
+        processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        jobs = max(jobs or current_app.config['POSTER_WORKERS'], 1)
+        query = VideoInfo.query.filter_by(video_id=video) if video else VideoInfo.query
+        tasks = []
+        for vi in query.all():
+            derived_path = Path(processed_root, "derived", vi.video_id)
+            video_path = Path(processed_root, "video_links", vi.video_id + vi.video.extension)
+            if not video_path.exists():
+                logger.warning(f"Skipping creation of seek preview for video {vi.video_id} because the video at {str(video_path)} does not exist or is not accessible")
+                continue
+            if not vi.duration:
+                logger.debug(f"Skipping creation of seek preview for video {vi.video_id} because its metadata has not been read yet")
+                continue
+            if not vi.width:
+                logger.debug(f"Skipping creation of seek preview for video {vi.video_id} because it has no video stream")
+                continue
+            vtt_path, _ = util.seek_preview_paths(derived_path)
+            if vtt_path.exists() and not regenerate:
+                logger.debug(f"Skipping creation of seek preview for video {vi.video_id} because it exists at {str(vtt_path)}")
+                continue
+            aspect = vi.width / vi.height if vi.width and vi.height else None
+            tasks.append((video_path, derived_path, vi.duration, aspect))
+        if not tasks:
+            return
+
+        def create(task):
+            # Runs in a worker thread, each seek preview is its own ffmpeg process
+            video_path, derived_path, duration, aspect = task
+            return util.create_seek_preview(video_path, derived_path, duration, aspect, interval)
+
+        logger.info(f"Creating {len(tasks):,} seek preview(s) with {jobs} worker(s)")
+        s = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            failed = sum(1 for ok in pool.map(create, tasks) if not ok)
+        logger.info(f"Created {len(tasks) - failed:,} seek preview(s) in {time.time() - s:.2f}s ({failed:,} failed)")
+
+@cli.command()
+@click.option("--regenerate", "-r", help="Overwrite existing faststart copies", is_flag=True)
+@click.option("--video", "-v", help="Only check a specific video by id", default=None)
+def faststart_videos(regenerate, video):
+    """Remux MP4/MOV videos that have their moov box at the end into faststart copies and link those in their place"""
+    with create_app().app_context():
+        if not current_app.config.get('ENABLE_FASTSTART'):
+            logger.info("Faststart copies are disabled. Set ENABLE_FASTSTART=true to enable.")
+            return
+
+        paths = current_app.config['PATHS']
+        library_roots = current_app.config['LIBRARY_ROOTS']
+        query = (db.session.query(VideoInfo.id, VideoInfo.video_id, VideoInfo.faststart, Video.root_id, Video.path, Video.extension)
+            .join(Video, VideoInfo.video_id == Video.video_id)
+            .filter(func.lower(Video.extension).in_(mp4.NATIVE_PROBE_EXTENSIONS)))
+        if video:
+            query = query.filter(VideoInfo.video_id == video)
+        elif not regenerate:
+            query = query.filter(or_(VideoInfo.faststart == None, VideoInfo.faststart == False))
+        videos = query.all()
+        logger.info(f"Checking {len(videos):,} video(s) for a moov box at the end of the file")
+
+        relinked = 0
+        for v in videos:
+            link = paths["processed"] / "video_links" / (v.video_id + v.extension)
+            if v.root_id not in library_roots or not link.exists():
+                logger.warning(f"Skipping faststart check of video {v.video_id} because the video at {str(link)} does not exist")
+                continue
+            src = Path((library_roots[v.root_id] / v.path).absolute())
+            faststart = v.faststart
+            if faststart is None or regenerate:
+                faststart = mp4.is_faststart(src)
+            copy = util.faststart_path(paths["processed"], v.video_id, v.extension)
+            if faststart is False:
+                if not copy.is_file() or regenerate:
+                    copy.parent.mkdir(parents=True, exist_ok=True)
+                    util.create_faststart_copy(src, copy, current_app.config.get('TRANSCODE_TIMEOUT'))
+                if copy.is_file():
+                    util.link_video(copy.absolute(), link, replace=True)
+                    relinked += 1
+                    faststart = True
+            db.session.query(VideoInfo).filter_by(id=v.id).update({ "faststart": faststart }, synchronize_session=False)
+            db.session.commit()
+        logger.info(f"Linked faststart copies for {relinked:,} video(s)")
+
+@cli.command()
+@click.option("--regenerate", "-r", help="Overwrite existing derived files", is_flag=True)
+@click.option("--video", "-v", help="Only derive files for a specific video by id", default=None)
+@click.option("--skip", "-s", help="Amount to skip into the video before extracting a poster image, as a %, e.g. 0.05 for 5%", type=float, default=0)
+@click.option("--boomerang", "-b", help="Also create the boomerang preview", is_flag=True)
+def derive_videos(regenerate, video, skip, boomerang):
+    """
+    Creates the missing transcoded renditions of videos together with their other missing derived files, decoding
+    each video once. Videos that need no rendition are left to create_posters and create_seek_previews, which only
+    decode keyframes and are much cheaper on their own.
+    """
+    with create_app().app_context():
+        if not current_app.config.get('ENABLE_TRANSCODING') and not boomerang:
+            logger.info("Transcoding is disabled, nothing needs a full decode of the videos")
+            return
+        processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        use_gpu = current_app.config.get('TRANSCODE_GPU', False)
+        interval = current_app.config['SEEK_PREVIEW_INTERVAL']
+        ladder = load_rendition_ladder()
+        vinfos = VideoInfo.query.filter(VideoInfo.video_id==video).all() if video else VideoInfo.query.all()
+        for vi in vinfos:
+            derived_path = Path(processed_root, "derived", vi.video_id)
+            video_path = Path(processed_root, "video_links", vi.video_id + vi.video.extension)
+            if not video_path.exists() or not vi.duration or not vi.width:
+                continue
+            # Long videos are left to transcode_videos, which encodes them in segments across every core
+            transcode = current_app.config.get('ENABLE_TRANSCODING') and not segmented_transcode(vi, use_gpu)
+            heights = missing_renditions(vi, derived_path, ladder, regenerate) if transcode else []
+            boomerang_missing = boomerang and (regenerate or not (derived_path / "boomerang-preview.webm").exists())
+            if not heights and not boomerang_missing:
+                continue
+            poster_path = derived_path / "poster.jpg"
+            vtt_path, _ = util.seek_preview_paths(derived_path)
+            derived_path.mkdir(parents=True, exist_ok=True)
+            written = util.derive_video(
+                video_path, derived_path, vi.video_id, vi.duration, heights,
+                poster_second=int(vi.duration * skip) if regenerate or not poster_path.exists() else None,
+                seek_preview_interval=interval if regenerate or not vtt_path.exists() else None,
+                aspect=vi.width / vi.height if vi.height else None,
+                boomerang=boomerang_missing, use_gpu=use_gpu)
+            if 'poster' in written:
+                util.create_poster_variants(poster_path)
+            for height in heights:
+                if height in written:
+                    record_rendition(vi.video_id, height, processed_root)
+            db.session.commit()
+
 @cli.command()
 @click.option("--regenerate", "-r", help="Overwrite existing transcoded videos", is_flag=True)
 @click.option("--video", "-v", help="Transcode a specific video by id", default=None)
-def transcode_videos(regenerate, video):
-    """Transcode videos to 1080p and 720p variants"""
+@click.option("--one-pass/--per-quality", default=True, help="Encode every missing quality of a video from one decode of it (default), or run one ffmpeg per quality")
+def transcode_videos(regenerate, video, one_pass):
+    """Transcode videos to the renditions of the ladder in config.json"""
     with create_app().app_context():
         if not current_app.config.get('ENABLE_TRANSCODING'):
             logger.info("Transcoding is disabled. Set ENABLE_TRANSCODING=true to enable.")
@@ -444,6 +1076,10 @@ def transcode_videos(regenerate, video):
         processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
         use_gpu = current_app.config.get('TRANSCODE_GPU', False)
         base_timeout = current_app.config.get('TRANSCODE_TIMEOUT', 7200)
+        segment_seconds = current_app.config['TRANSCODE_SEGMENT_SECONDS']
+        segment_workers = current_app.config['TRANSCODE_SEGMENT_WORKERS']
+        ladder = load_rendition_ladder()
+        logger.info(f"Rendition ladder: {', '.join(f'{h}p' for h, _ in ladder) or 'empty'}")
 
         # Get videos to transcode
         vinfos = VideoInfo.query.filter(VideoInfo.video_id==video).all() if video else VideoInfo.query.all()
@@ -456,57 +1092,181 @@ def transcode_videos(regenerate, video):
             if not video_path.exists():
                 logger.warning(f"Skipping transcoding for video {vi.video_id} because the video at {str(video_path)} does not exist")
                 continue
+            if vi.duration is None:
+                logger.debug(f"Skipping transcoding for video {vi.video_id} because its metadata has not been read yet")
+                continue
 
             if not derived_path.exists():
                 derived_path.mkdir(parents=True)
 
-            # Determine which qualities to transcode
-            original_height = vi.height or 0
-
-            # Transcode to 1080p if original is higher and 1080p doesn't exist
-            transcode_1080p_path = derived_path / f"{vi.video_id}-1080p.mp4"
-            if original_height > 1080 and (not transcode_1080p_path.exists() or regenerate):
-                logger.info(f"Transcoding {vi.video_id} to 1080p")
-                # Pass None for timeout to use smart calculation, or pass base_timeout if needed
-                timeout = None  # Uses smart calculation based on video duration
-                success = util.transcode_video_quality(video_path, transcode_1080p_path, 1080, use_gpu, timeout)
-                if success:
-                    vi.has_1080p = True
-                    db.session.add(vi)
-                    db.session.commit()
-                else:
-                    logger.warning(f"Skipping video {vi.video_id} 1080p transcode - all encoders failed")
-            elif transcode_1080p_path.exists():
-                logger.debug(f"Skipping 1080p transcode for {vi.video_id} (already exists)")
-                vi.has_1080p = True
-                db.session.add(vi)
+            # Picks up transcodes made outside this command and drops rows of deleted files
+            sync_renditions(vi, processed_root)
+            heights = missing_renditions(vi, derived_path, ladder, regenerate)
+            if not heights:
                 db.session.commit()
+                continue
 
-            # Transcode to 720p if original is higher than 720p and 720p doesn't exist
-            transcode_720p_path = derived_path / f"{vi.video_id}-720p.mp4"
-            if original_height > 720 and (not transcode_720p_path.exists() or regenerate):
-                logger.info(f"Transcoding {vi.video_id} to 720p")
-                # Pass None for timeout to use smart calculation, or pass base_timeout if needed
-                timeout = None  # Uses smart calculation based on video duration
-                success = util.transcode_video_quality(video_path, transcode_720p_path, 720, use_gpu, timeout)
-                if success:
-                    vi.has_720p = True
-                    db.session.add(vi)
-                    db.session.commit()
+            # Parallel segments make better use of many cores than sharing one decode between the qualities
+            segmented = segmented_transcode(vi, use_gpu)
+            segment_args = dict(segment_seconds=segment_seconds, workers=segment_workers) if segmented else {}
+
+            if one_pass and not segmented:
+                logger.info(f"Transcoding {vi.video_id} to {', '.join(f'{h}p' for h in heights)} in one pass")
+                written = util.derive_video(video_path, derived_path, vi.video_id, vi.duration, heights, use_gpu=use_gpu)
+            else:
+                written = set()
+                for height in heights:
+                    logger.info(f"Transcoding {vi.video_id} to {height}p")
+                    # Pass None for timeout to use smart calculation based on video duration
+                    if util.transcode_video_quality(video_path, util.rendition_path(derived_path, vi.video_id, height), height, use_gpu, None, **segment_args):
+                        written.add(height)
+
+            for height in heights:
+                if height in written:
+                    record_rendition(vi.video_id, height, processed_root)
                 else:
-                    logger.warning(f"Skipping video {vi.video_id} 720p transcode - all encoders failed")
-            elif transcode_720p_path.exists():
-                logger.debug(f"Skipping 720p transcode for {vi.video_id} (already exists)")
-                vi.has_720p = True
-                db.session.add(vi)
-                db.session.commit()
+                    # An earlier transcode of this quality, if there is one, keeps its row and is still served
+                    logger.warning(f"Skipping video {vi.video_id} {height}p transcode - all encoders failed")
+            db.session.commit()
 
         logger.info("Transcoding complete")
 
+@cli.command()
+def backfill_renditions():
+    """Probe the transcoded files whose rendition rows were created from the old 720p/1080p flags"""
+    with create_app().app_context():
+        processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        video_ids = [row.video_id for row in db.session.query(Rendition.video_id).filter(Rendition.size == None).distinct()]
+        if not video_ids:
+            logger.debug("No renditions need their size, codec and bitrate filled in")
+            return
+        logger.info(f"Filling in the renditions of {len(video_ids):,} video(s)")
+        for chunk in util.chunks(video_ids, METADATA_BATCH_SIZE):
+            for vi in VideoInfo.query.filter(VideoInfo.video_id.in_(chunk)):
+                sync_renditions(vi, processed_root)
+            db.session.commit()
+
+@cli.command()
+@click.option("--video", "-v", help="Queue a specific video by id", default=None)
+@click.option("--regenerate", "-r", help="Overwrite existing transcoded videos", is_flag=True)
+@click.option("--priority", "-p", help="Priority of the queued jobs, higher runs first", type=int, default=TranscodeJob.PRIORITY_BACKLOG)
+@click.option("--retry", help="Also queue videos whose last job failed or was cancelled", is_flag=True)
+def queue_transcodes(video, regenerate, priority, retry):
+    """Queue the videos missing a transcoded variant for `fireshare worker`"""
+    with create_app().app_context():
+        if not current_app.config.get('ENABLE_TRANSCODING'):
+            logger.info("Transcoding is disabled. Set ENABLE_TRANSCODING=true to enable.")
+            return
+        processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        ladder = load_rendition_ladder()
+        vinfos = VideoInfo.query.filter(VideoInfo.video_id==video).all() if video else VideoInfo.query.all()
+        queued = 0
+        for vi in vinfos:
+            if vi.duration is None or not missing_renditions(vi, Path(processed_root, "derived", vi.video_id), ladder, regenerate):
+                continue
+            if TranscodeJob.enqueue(vi.video_id, priority, regenerate, retry or bool(video)):
+                queued += 1
+        db.session.commit()
+        logger.info(f"Queued {queued:,} video(s) for transcoding")
+
+def finish_transcode_job(job, returncode, processed_root):
+    """
+    Records the outcome of a job's transcode process, which exits cleanly even when no encoder could create a variant
+    """
+    if returncode != 0:
+        job.finish(TranscodeJob.FAILED, f"fireshare transcode-videos exited with status {returncode}")
+        return
+    vi = VideoInfo.query.filter_by(video_id=job.video_id).first()
+    if not vi:
+        job.finish(TranscodeJob.FAILED, "The video no longer exists")
+        return
+    missing = missing_renditions(vi, Path(processed_root, "derived", vi.video_id), load_rendition_ladder())
+    if missing:
+        job.finish(TranscodeJob.FAILED, f"No encoder could create {', '.join(f'{h}p' for h in missing)}")
+    else:
+        job.finish(TranscodeJob.DONE)
+
+def stop_process_group(proc):
+    # SIGKILL, as ffmpeg handles SIGTERM by flushing its encoders, which can take minutes. Its output is a temporary
+    # file the next attempt overwrites
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+@cli.command()
+@click.option("--concurrency", "-c", help="Number of videos transcoded at once, defaults to TRANSCODE_WORKERS", type=int, default=None)
+@click.option("--poll", help="Seconds between checks of the queue", type=float, default=5)
+def worker(concurrency, poll):
+    """
+    Transcode the videos queued by queue-transcodes and scan-video, highest priority first, until stopped. Each job runs
+    `fireshare transcode-videos` in its own process, which is killed if the job is cancelled. The queue is in the
+    database, so jobs that were running when a worker stopped are picked up again by the next one.
+    """
+    with create_app().app_context():
+        processed_root = Path(current_app.config['PROCESSED_DIRECTORY'])
+        concurrency = max(concurrency or current_app.config['TRANSCODE_WORKERS'], 1)
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        running = {}
+        stopping = []
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: stopping.append(signum))
+        logger.info(f"Transcode worker {name} started with a concurrency of {concurrency}")
+
+        while not stopping:
+            try:
+                for job in TranscodeJob.requeue_stale(TRANSCODE_JOB_STALE_SECONDS, TRANSCODE_JOB_MAX_ATTEMPTS):
+                    logger.warning(f"Transcode job of {job.video_id} was left running by {job.worker or 'a stopped worker'}, it is now {job.status}")
+                for job_id, proc in list(running.items()):
+                    job = TranscodeJob.query.get(job_id)
+                    returncode = proc.poll()
+                    if job is None or job.status != TranscodeJob.RUNNING or job.worker != name:
+                        # Cancelled, deleted with its video, or given to another worker after this one missed its heartbeats
+                        if returncode is None:
+                            logger.info(f"Stopping transcode job {job_id}, it is {job.status if job else 'gone'}")
+                            stop_process_group(proc)
+                        del running[job_id]
+                    elif returncode is not None:
+                        finish_transcode_job(job, returncode, processed_root)
+                        logger.info(f"Transcode job of {job.video_id} {job.status}{f': {job.last_error}' if job.last_error else ''}")
+                        del running[job_id]
+                    else:
+                        job.heartbeat_at = datetime.utcnow()
+                db.session.commit()
+
+                while len(running) < concurrency:
+                    job = TranscodeJob.claim(name)
+                    if not job:
+                        break
+                    logger.info(f"Transcoding {job.video_id} (priority {job.priority}, attempt {job.attempts})")
+                    cmd = ["fireshare", "transcode-videos", f"--video={job.video_id}"] + (["--regenerate"] if job.regenerate else [])
+                    # In its own session so cancelling a job also stops the ffmpeg processes it started
+                    running[job.id] = sp.Popen(cmd, start_new_session=True)
+            except Exception:
+                # E.g. the database being locked by a scan. The running jobs are left alone and checked again next time
+                db.session.rollback()
+                logger.exception(f"Transcode worker {name} failed to update its jobs, retrying in {poll}s")
+            time.sleep(poll)
+
+        # Stopped jobs go back to the front of their priority, so a restart picks them up again
+        logger.info(f"Transcode worker {name} stopping, requeueing {len(running)} running job(s)")
+        for job_id, proc in running.items():
+            stop_process_group(proc)
+            job = TranscodeJob.query.get(job_id)
+            if job.status == TranscodeJob.RUNNING and job.worker == name:
+                job.status = TranscodeJob.QUEUED
+                job.worker = None
+                job.attempts -= 1
+        db.session.commit()
+
 @cli.command()
 @click.pass_context
 @click.option("--root", "-r", help="root video path to scan", required=False)
-def bulk_import(ctx, root):
+@click.option("--root-id", "-i", help="Id of the library root to scan, every root is scanned by default", required=False)
+@click.option("--full", "-f", help="Rehash every file, ignoring the file index", is_flag=True)
+@click.option("--workers", "-w", help="Number of processes to walk and hash each library root with", type=int, default=1)
+def bulk_import(ctx, root, root_id, full, workers):
     with create_app().app_context():
         paths = current_app.config['PATHS']
         if util.lock_exists(paths["data"]):
@@ -522,20 +1282,44 @@ def bulk_import(ctx, root):
 
         timing = {}
         s = time.time()
-        ctx.invoke(scan_videos, root=root)
+        root_stats = ctx.invoke(scan_videos, root=root, root_id=root_id, full=full, workers=workers)
         timing['scan_videos'] = time.time() - s
+        # Per-root collection time and throughput, a slow disk shows up as a low files_per_sec
+        timing['scan_roots'] = root_stats or {}
         s = time.time()
         ctx.invoke(sync_metadata)
+        # Only does work once, for videos probed before the media columns existed
+        ctx.invoke(backfill_media_info)
+        # Likewise for renditions transcoded before the rendition table existed
+        ctx.invoke(backfill_renditions)
         timing['sync_metadata'] = time.time() - s
+        # With transcode workers the renditions are created by `fireshare worker`, otherwise during the import
+        transcode_inline = current_app.config.get('ENABLE_TRANSCODING') and not current_app.config['TRANSCODE_WORKERS']
+        if transcode_inline:
+            # Videos that will be transcoded get their poster and seek preview from the same decode,
+            # the steps below then only fill in what it couldn't create
+            s = time.time()
+            ctx.invoke(derive_videos, skip=thumbnail_skip)
+            timing['derive_videos'] = time.time() - s
         s = time.time()
         ctx.invoke(create_posters, skip=thumbnail_skip)
         timing['create_posters'] = time.time() - s
+        s = time.time()
+        ctx.invoke(create_seek_previews)
+        timing['create_seek_previews'] = time.time() - s
+
+        if current_app.config.get('ENABLE_FASTSTART'):
+            s = time.time()
+            ctx.invoke(faststart_videos)
+            timing['faststart_videos'] = time.time() - s
 
         # Transcode videos if transcoding is enabled
-        if current_app.config.get('ENABLE_TRANSCODING'):
+        if transcode_inline:
             s = time.time()
             ctx.invoke(transcode_videos)
             timing['transcode_videos'] = time.time() - s
+        elif current_app.config.get('ENABLE_TRANSCODING'):
+            ctx.invoke(queue_transcodes)
 
         logger.info(f"Finished bulk import. Timing info: {json.dumps(timing)}")
 
@@ -1,3 +1,5 @@
+import re
+
 DEFAULT_CONFIG = {
   "app_config": {
     "video_defaults": {
@@ -14,8 +16,38 @@ DEFAULT_CONFIG = {
   },
   "integrations": {
     "discord_webhook_url": "",
+  },
+  "transcoding": {
+    # Keyed by name rather than a list, so a rung can be switched off: the saved config is merged into this one
+    # and lists would be concatenated. Videos get the enabled rungs lower than their own height and at least
+    # min_duration seconds long
+    "renditions": {
+      "1080p": {"enabled": True, "height": 1080, "min_duration": 0},
+      "720p": {"enabled": True, "height": 720, "min_duration": 0},
+      "480p": {"enabled": False, "height": 480, "min_duration": 0},
+      "360p": {"enabled": False, "height": 360, "min_duration": 0},
+    }
   }
 }
 
 SUPPORTED_FILE_TYPES = ['mp4', 'mov', 'webm']
-SUPPORTED_FILE_EXTENSIONS = ['.mp4', '.mov', '.webm']
\ No newline at end of file
+SUPPORTED_FILE_EXTENSIONS = ['.mp4', '.mov', '.webm']
+
+# Id of the library root at VIDEO_DIRECTORY, extra roots are configured with VIDEO_LIBRARY_ROOTS
+MAIN_LIBRARY_ROOT = 'main'
+
+# Partial uploads and our own transcoded variants that live next to source videos and must never be imported
+CHUNK_FILE_PATTERN = re.compile(r'\.part\d{4}$')
+TRANSCODE_PATTERN = re.compile(r'-(?:720p|1080p)\.mp4$', re.IGNORECASE)
+
+# Widths of the downscaled copies of poster.jpg served to video cards, and their formats in order of preference
+POSTER_WIDTHS = (320, 640, 1280)
+POSTER_FORMATS = {
+  'avif': 'image/avif',
+  'webp': 'image/webp',
+}
+
+# Seek preview sprite sheets: the width of each thumbnail and how many thumbnails a sheet holds
+SEEK_PREVIEW_WIDTH = 160
+SEEK_PREVIEW_COLUMNS = 10
+SEEK_PREVIEW_ROWS = 10
@@ -1,6 +1,26 @@
 import json
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import or_
 from flask_login import UserMixin
-from . import db
+from . import db, logger
+
+class CompressedText(db.TypeDecorator):
+    """
+    Text stored zlib-compressed as a blob. Rows written before compression was introduced are plain text and are read back as-is.
+    """
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(value.encode('utf-8'), 9)
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return zlib.decompress(value).decode('utf-8')
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -19,6 +39,8 @@ class Video(db.Model):
     available = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime())
     updated_at = db.Column(db.DateTime())
+    id_scheme = db.Column(db.Integer, default=1, server_default='1')
+    root_id   = db.Column(db.String(64), index=True, nullable=False, default='main', server_default='main')
 
     info      = db.relationship("VideoInfo", back_populates="video", uselist=False, lazy="joined")
 
@@ -42,35 +64,42 @@ class VideoInfo(db.Model):
     video_id    = db.Column(db.String(32), db.ForeignKey("video.video_id"), nullable=False)
     title       = db.Column(db.String(256), index=True)
     description = db.Column(db.String(2048))
-    info        = db.Column(db.Text)
+    # The raw ffprobe streams, only loaded when accessed. Listings use the columns below instead
+    info        = db.deferred(db.Column(CompressedText))
     duration    = db.Column(db.Float)
     width       = db.Column(db.Integer)
     height      = db.Column(db.Integer)
     private     = db.Column(db.Boolean, default=True)
-    has_720p    = db.Column(db.Boolean, default=False)
-    has_1080p   = db.Column(db.Boolean, default=False)
+    # Copied out of info when a video is probed, so listings never have to parse it
+    video_codec  = db.Column(db.String(32))
+    audio_codec  = db.Column(db.String(32))
+    frame_rate   = db.Column(db.Float)
+    bitrate      = db.Column(db.Integer)
+    pixel_format = db.Column(db.String(32))
+    container    = db.Column(db.String(32))
+    # Whether an MP4/MOV has its moov box ahead of the media data, None for other containers or when not yet checked
+    faststart    = db.Column(db.Boolean)
 
     video       = db.relationship("Video", back_populates="info", uselist=False, lazy="joined")
+    # Loaded for a whole listing in one extra query, tallest first
+    renditions  = db.relationship("Rendition", primaryjoin="VideoInfo.video_id == foreign(Rendition.video_id)",
+                                  lazy="selectin", order_by="Rendition.height.desc()", viewonly=True)
 
     @property
     def vcodec(self):
         info = json.loads(self.info) if self.info else None
-        vcodec = [i for i in info if i["codec_type"] == "video"][0] if info else None
+        vcodec = next((i for i in info if i["codec_type"] == "video"), None) if info else None
         return vcodec
 
     @property
     def acodec(self):
         info = json.loads(self.info) if self.info else None
-        acodec = [i for i in info if i["codec_type"] == "video"][0] if info else None
+        acodec = next((i for i in info if i["codec_type"] == "audio"), None) if info else None
         return acodec
 
     @property
     def framerate(self):
-        if self.vcodec:
-            frn, frd = self.vcodec.get("r_frame_rate", "").split("/")
-            return round(float(frn)/float(frd))
-        else:
-            return None
+        return round(self.frame_rate) if self.frame_rate else None
 
     def json(self):
         return {
@@ -81,13 +110,64 @@ class VideoInfo(db.Model):
             "height": self.height,
             "duration": round(self.duration) if self.duration else 0,
             "framerate": self.framerate,
-            "has_720p": self.has_720p,
-            "has_1080p": self.has_1080p
+            "renditions": [r.json() for r in self.renditions],
+            # Kept for clients from before the rendition ladder
+            "has_720p": any(r.height == 720 for r in self.renditions),
+            "has_1080p": any(r.height == 1080 for r in self.renditions),
         }
 
     def __repr__(self):
         return "<VideoInfo {} {}>".format(self.video_id, self.title)
 
+class Rendition(db.Model):
+    __tablename__ = "rendition"
+    __table_args__ = (
+        db.UniqueConstraint('video_id', 'height'),
+    )
+
+    id          = db.Column(db.Integer, primary_key=True)
+    video_id    = db.Column(db.String(32), db.ForeignKey("video.video_id"), index=True, nullable=False)
+    height      = db.Column(db.Integer, nullable=False)
+    # Of the transcoded file as written, None until it has been probed
+    codec       = db.Column(db.String(32))
+    bitrate     = db.Column(db.Integer)
+    # Relative to the processed directory
+    path        = db.Column(db.String(2048), nullable=False)
+    size        = db.Column(db.BigInteger)
+    created_at  = db.Column(db.DateTime())
+
+    @property
+    def quality(self):
+        return f"{self.height}p"
+
+    def json(self):
+        return {
+            "quality": self.quality,
+            "height": self.height,
+            "codec": self.codec,
+            "bitrate": self.bitrate,
+            "size": self.size,
+        }
+
+    @classmethod
+    def put(cls, video_id, height, path, size=None, codec=None, bitrate=None):
+        """
+        Records the transcoded file of a video at a height, replacing what was known about an earlier one
+        """
+        rendition = cls.query.filter_by(video_id=video_id, height=height).first()
+        if not rendition:
+            rendition = cls(video_id=video_id, height=height)
+            db.session.add(rendition)
+        rendition.path = path
+        rendition.size = size
+        rendition.codec = codec
+        rendition.bitrate = bitrate
+        rendition.created_at = datetime.utcnow()
+        return rendition
+
+    def __repr__(self):
+        return "<Rendition {} {}>".format(self.video_id, self.quality)
+
 class VideoView(db.Model):
     __tablename__ = "video_view"
     __table_args__ = (
@@ -117,4 +197,249 @@ class VideoView(db.Model):
 
     def __repr__(self):
         return "<VideoViews {} {}>".format(self.video_id, self.ip_address)
-    
+
+class FileIndex(db.Model):
+    __tablename__ = "file_index"
+    __table_args__ = (
+        db.UniqueConstraint('root_id', 'path'),
+    )
+
+    id          = db.Column(db.Integer, primary_key=True)
+    root_id     = db.Column(db.String(64), nullable=False, default='main', server_default='main')
+    path        = db.Column(db.String(2048), nullable=False)
+    size        = db.Column(db.BigInteger, nullable=False)
+    mtime_ns    = db.Column(db.BigInteger, nullable=False)
+    inode       = db.Column(db.BigInteger, nullable=False)
+    video_id    = db.Column(db.String(32), index=True, nullable=False)
+    id_scheme   = db.Column(db.Integer, default=1, server_default='1')
+
+    def matches(self, st):
+        """
+        True if the stat result describes the same file version that was hashed into this entry
+        """
+        return (self.size, self.mtime_ns, self.inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def update_state(self, st, video_id, id_scheme):
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.video_id = video_id
+        self.id_scheme = id_scheme
+
+    def __repr__(self):
+        return "<FileIndex {} {}:{}>".format(self.video_id, self.root_id, self.path)
+
+class MetadataRetry(db.Model):
+    __tablename__ = "metadata_retry"
+
+    PENDING = "pending"
+    FAILED  = "failed"
+
+    id              = db.Column(db.Integer, primary_key=True)
+    video_id        = db.Column(db.String(32), unique=True, index=True, nullable=False)
+    status          = db.Column(db.String(16), index=True, nullable=False, default="pending")
+    attempts        = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime())
+    last_attempt_at = db.Column(db.DateTime())
+    last_error      = db.Column(db.String(1024))
+
+    def json(self):
+        return {
+            "video_id": self.video_id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "next_attempt_at": self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            "last_attempt_at": self.last_attempt_at.isoformat() if self.last_attempt_at else None,
+            "last_error": self.last_error,
+        }
+
+    @classmethod
+    def record_failure(cls, video_id, error, max_attempts, base_delay, max_delay):
+        """
+        Counts a failed attempt, scheduling the next one with exponential backoff or giving up after max_attempts
+        """
+        entry = cls.query.filter_by(video_id=video_id).first()
+        if not entry:
+            entry = cls(video_id=video_id, attempts=0)
+            db.session.add(entry)
+        now = datetime.utcnow()
+        entry.attempts += 1
+        entry.last_attempt_at = now
+        entry.last_error = (error or "")[:1024]
+        if entry.attempts >= max_attempts:
+            entry.status = cls.FAILED
+            entry.next_attempt_at = None
+        else:
+            entry.status = cls.PENDING
+            entry.next_attempt_at = now + timedelta(seconds=min(base_delay * 2 ** (entry.attempts - 1), max_delay))
+        return entry
+
+    def __repr__(self):
+        return "<MetadataRetry {} {} {}>".format(self.video_id, self.status, self.attempts)
+
+class TranscodeJob(db.Model):
+    __tablename__ = "transcode_job"
+
+    QUEUED    = "queued"
+    RUNNING   = "running"
+    DONE      = "done"
+    FAILED    = "failed"
+    CANCELLED = "cancelled"
+
+    # Newly imported and uploaded videos are transcoded ahead of the backlog of the existing library
+    PRIORITY_BACKLOG = 0
+    PRIORITY_NEW     = 10
+
+    id           = db.Column(db.Integer, primary_key=True)
+    video_id     = db.Column(db.String(32), unique=True, index=True, nullable=False)
+    status       = db.Column(db.String(16), index=True, nullable=False, default="queued")
+    priority     = db.Column(db.Integer, nullable=False, default=0)
+    regenerate   = db.Column(db.Boolean, nullable=False, default=False)
+    attempts     = db.Column(db.Integer, nullable=False, default=0)
+    worker       = db.Column(db.String(128))
+    queued_at    = db.Column(db.DateTime())
+    started_at   = db.Column(db.DateTime())
+    heartbeat_at = db.Column(db.DateTime())
+    finished_at  = db.Column(db.DateTime())
+    last_error   = db.Column(db.String(1024))
+
+    def json(self):
+        return {
+            "id": self.id,
+            "video_id": self.video_id,
+            "status": self.status,
+            "priority": self.priority,
+            "regenerate": self.regenerate,
+            "attempts": self.attempts,
+            "worker": self.worker,
+            "queued_at": self.queued_at.isoformat() if self.queued_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "last_error": self.last_error,
+        }
+
+    @classmethod
+    def enqueue(cls, video_id, priority=PRIORITY_BACKLOG, regenerate=False, retry=False):
+        """
+        Queues a video, or raises the priority of its queued job. Each video has one job row: a finished job is queued
+        again, while running ones are left alone and failed or cancelled ones are only queued again with retry, so the
+        scheduled scan doesn't keep requeueing a video that can't be transcoded. Returns the job, or None if it was left alone.
+        """
+        job = cls.query.filter_by(video_id=video_id).first()
+        if job and job.status == cls.QUEUED:
+            job.priority = max(job.priority, priority)
+            job.regenerate = job.regenerate or regenerate
+            return job
+        if job and (job.status == cls.RUNNING or (job.status in (cls.FAILED, cls.CANCELLED) and not retry)):
+            return None
+        if not job:
+            job = cls(video_id=video_id)
+            db.session.add(job)
+        job.status = cls.QUEUED
+        job.priority = priority
+        job.regenerate = regenerate
+        job.attempts = 0
+        job.worker = None
+        job.queued_at = datetime.utcnow()
+        job.started_at = job.heartbeat_at = job.finished_at = None
+        job.last_error = None
+        return job
+
+    @classmethod
+    def claim(cls, worker):
+        """
+        Marks the highest priority queued job as running on this worker and returns it, or None if nothing is queued.
+        The status is checked again in the update so two workers can never take the same job.
+        """
+        while True:
+            job = cls.query.filter_by(status=cls.QUEUED).order_by(cls.priority.desc(), cls.queued_at, cls.id).first()
+            if not job:
+                return None
+            now = datetime.utcnow()
+            claimed = cls.query.filter_by(id=job.id, status=cls.QUEUED).update(
+                {"status": cls.RUNNING, "worker": worker, "started_at": now, "heartbeat_at": now, "attempts": cls.attempts + 1},
+                synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                db.session.refresh(job)
+                return job
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.finished_at = datetime.utcnow()
+        self.last_error = (error or "")[:1024] or None
+
+    @classmethod
+    def requeue_stale(cls, stale_after, max_attempts):
+        """
+        Puts running jobs whose worker stopped sending heartbeats (it was killed or the container restarted) back in
+        the queue, or fails them once they have been started max_attempts times. Returns the jobs that were requeued or failed.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        stale = cls.query.filter(cls.status == cls.RUNNING, or_(cls.heartbeat_at == None, cls.heartbeat_at < cutoff)).all()
+        for job in stale:
+            if job.attempts >= max_attempts:
+                job.finish(cls.FAILED, f"Worker {job.worker} stopped while transcoding, gave up after {job.attempts} attempts")
+            else:
+                job.status = cls.QUEUED
+                job.worker = None
+        return stale
+
+    def __repr__(self):
+        return "<TranscodeJob {} {} {}>".format(self.video_id, self.status, self.priority)
+
+class ProbeCache(db.Model):
+    __tablename__ = "probe_cache"
+
+    id          = db.Column(db.Integer, primary_key=True)
+    path        = db.Column(db.String(2048), unique=True, nullable=False)
+    size        = db.Column(db.BigInteger, nullable=False)
+    mtime_ns    = db.Column(db.BigInteger, nullable=False)
+    data        = db.Column(CompressedText, nullable=False)
+    probed_at   = db.Column(db.DateTime())
+
+    @classmethod
+    def get(cls, key):
+        """
+        The cached probe for a (real path, size, mtime_ns) file version, or None if that version hasn't been probed
+        """
+        path, size, mtime_ns = key
+        row = db.session.query(cls.data).filter_by(path=path, size=size, mtime_ns=mtime_ns).first()
+        return json.loads(row.data) if row else None
+
+    @classmethod
+    def put(cls, key, data):
+        """
+        Stores a probe, replacing the one of any older version of the file. Best-effort: losing a cache entry only
+        costs another probe later.
+
+        Written on its own connection so the caller's session is left alone, unless that session has already written
+        and so holds SQLite's write lock. A second connection would then wait out the busy timeout and fail, so the
+        row goes through the session instead and is committed with the caller's changes. The own connection doesn't
+        wait for a lock held by anyone else either, e.g. a scan, so a request that probed a file isn't held up by
+        caching it: the write is skipped and the next probe of the file tries again.
+        """
+        path, size, mtime_ns = key
+        delete = cls.__table__.delete().where(cls.path == path)
+        insert = cls.__table__.insert().values(path=path, size=size, mtime_ns=mtime_ns, data=json.dumps(data), probed_at=datetime.utcnow())
+        try:
+            # pysqlite only opens a transaction before the first write, so an open one means the lock is held
+            if db.session.connection().connection.in_transaction:
+                db.session.execute(delete)
+                db.session.execute(insert)
+                return
+            with db.engine.connect() as conn:
+                busy_timeout = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+                conn.exec_driver_sql("PRAGMA busy_timeout = 0")
+                try:
+                    with conn.begin():
+                        conn.execute(delete)
+                        conn.execute(insert)
+                finally:
+                    # The connection goes back to the pool
+                    conn.exec_driver_sql(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        except Exception as ex:
+            logger.debug(f"Unable to cache the probe of {path}: {ex}")
+
+    def __repr__(self):
+        return "<ProbeCache {}>".format(self.path)
@@ -0,0 +1,425 @@
+"""
+Reads the stream metadata of MP4 and MOV files straight from their box structure.
+
+Only the moov box is read, so probing a file costs a few small reads instead of starting an ffprobe process.
+probe() returns the same shape as ffprobe's -show_streams -show_format output, limited to the fields
+the rest of fireshare reads, and returns None for anything it doesn't fully understand (fragmented, encrypted or
+rotated files, unknown codecs, ...) so the caller can fall back to ffprobe.
+"""
+import os
+import struct
+import sys
+from array import array
+from collections import Counter
+from math import gcd
+
+from fireshare import logger
+
+NATIVE_PROBE_EXTENSIONS = ('.mp4', '.mov', '.m4v')
+# ffprobe's name for the demuxer that reads these files
+FORMAT_NAME = 'mov,mp4,m4a,3gp,3g2,mj2'
+# A moov this large means sample tables for hours of video, ffprobe copes with those better
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# Sample entry fourcc -> ffprobe codec_name. mp4v and mp4a are resolved from their esds descriptor instead.
+VIDEO_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1',
+    'vp09': 'vp9', 'vp08': 'vp8',
+    'apco': 'prores', 'apcs': 'prores', 'apcn': 'prores', 'apch': 'prores', 'ap4h': 'prores', 'ap4x': 'prores',
+    'jpeg': 'mjpeg', 'mjpa': 'mjpeg',
+}
+AUDIO_CODECS = {
+    'Opus': 'opus', 'fLaC': 'flac', 'alac': 'alac',
+    'ac-3': 'ac3', 'ec-3': 'eac3', '.mp3': 'mp3',
+    'sowt': 'pcm_s16le', 'twos': 'pcm_s16be',
+}
+# MPEG-4 objectTypeIndication (esds) -> codec_name
+OBJECT_TYPES = {
+    0x20: 'mpeg4', 0x21: 'h264', 0x23: 'hevc',
+    0x60: 'mpeg2video', 0x61: 'mpeg2video', 0x62: 'mpeg2video', 0x63: 'mpeg2video', 0x64: 'mpeg2video', 0x65: 'mpeg2video',
+    0x6A: 'mpeg1video', 0x6C: 'mjpeg',
+    0x40: 'aac', 0x66: 'aac', 0x67: 'aac', 0x68: 'aac',
+    0x69: 'mp3', 0x6B: 'mp3', 0xA5: 'ac3', 0xA6: 'eac3', 0xAD: 'opus',
+}
+# tkhd matrix of an untransformed track, a, b, u, c, d, v and w in 16.16, 16.16 and 2.30 fixed point
+IDENTITY_MATRIX = (0x10000, 0, 0, 0, 0x10000, 0, 0x40000000)
+# Tracks that aren't audio or video are listed the way ffprobe lists them, but never make the probe fail
+SUBTITLE_HANDLERS = ('text', 'sbtl', 'subt', 'clcp')
+
+class Unsupported(Exception):
+    """The file is valid as far as we can tell, but needs ffprobe to be read correctly"""
+
+def _boxes(buf, start=0, end=None):
+    """Yields (type, payload start, payload end) for each box in buf[start:end]"""
+    end = len(buf) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise ValueError('truncated box header')
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f'box {kind!r} overruns its parent')
+        yield kind.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def _child(buf, start, end, *path):
+    """Payload bounds of the first box along path below buf[start:end], or None"""
+    for name in path:
+        for kind, s, e in _boxes(buf, start, end):
+            if kind == name:
+                start, end = s, e
+                break
+        else:
+            return None
+    return start, end
+
+def _top_level(f, file_size):
+    """Yields (type, offset, header size, box size) for each top-level box, reading only the box headers"""
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        head = f.read(16)
+        size, kind = struct.unpack_from('>I4s', head)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', head, 8)[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header or pos + size > file_size:
+            # Most likely a recording that is still being written
+            raise ValueError(f'box {kind!r} at {pos} overruns the file')
+        yield kind, pos, header, size
+        pos += size
+
+def _read_top_level(f, file_size):
+    """Returns (ftyp payload, moov payload)"""
+    ftyp = None
+    for kind, pos, header, size in _top_level(f, file_size):
+        if kind == b'ftyp':
+            f.seek(pos + header)
+            ftyp = f.read(min(size - header, 4096))
+        elif kind == b'moov':
+            if size > MAX_MOOV_SIZE:
+                raise Unsupported(f'moov box of {size:,} bytes')
+            f.seek(pos + header)
+            return ftyp, f.read(size - header)
+        elif kind == b'moof':
+            raise Unsupported('fragmented file')
+    raise ValueError('no moov box')
+
+def _descriptor(buf, pos, end):
+    """Reads an MPEG-4 descriptor header in an esds box, returns (tag, payload start, payload end)"""
+    tag = buf[pos]
+    pos += 1
+    length = 0
+    for _ in range(4):
+        b = buf[pos]
+        pos += 1
+        length = (length << 7) | (b & 0x7F)
+        if not b & 0x80:
+            break
+    return tag, pos, min(pos + length, end)
+
+def _esds_object_type(buf, start, end):
+    """objectTypeIndication from the DecoderConfigDescriptor of an esds box"""
+    tag, pos, desc_end = _descriptor(buf, start + 4, end)
+    if tag != 0x03:
+        return None
+    flags = buf[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + buf[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, _ = _descriptor(buf, pos, desc_end)
+    return buf[pos] if tag == 0x04 else None
+
+def _find_esds(buf, start, end):
+    for kind, s, e in _boxes(buf, start, end):
+        if kind == 'esds':
+            return s, e
+        if kind == 'wave':
+            # QuickTime nests the esds of its audio inside a wave box
+            found = _find_esds(buf, s, e)
+            if found:
+                return found
+    return None
+
+def _pix_fmt(chroma, depth):
+    """ffprobe's pix_fmt for a chroma_format_idc (0 mono, 1 4:2:0, 2 4:2:2, 3 4:4:4) and bit depth"""
+    if chroma == 0:
+        return 'gray' if depth == 8 else f'gray{depth}le'
+    name = {1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}.get(chroma)
+    if name is None or depth not in (8, 10, 12):
+        return None
+    return name if depth == 8 else f'{name}{depth}le'
+
+def _video_pix_fmt(fourcc, buf, start, end):
+    """Pixel format stated by the codec configuration box of a visual sample entry, None when it doesn't say"""
+    if fourcc in ('avc1', 'avc3'):
+        found = _child(buf, start, end, 'avcC')
+        if not found:
+            return None
+        s, e = found
+        profile = buf[s + 1]
+        pos = s + 6
+        for _ in range(buf[s + 5] & 0x1F):
+            pos += 2 + struct.unpack_from('>H', buf, pos)[0]
+        pps = buf[pos]
+        pos += 1
+        for _ in range(pps):
+            pos += 2 + struct.unpack_from('>H', buf, pos)[0]
+        if profile in (100, 110, 122, 144, 244) and pos + 2 <= e:
+            return _pix_fmt(buf[pos] & 0x03, (buf[pos + 1] & 0x07) + 8)
+        # Baseline, main, extended and high profile streams are always 8 bit 4:2:0
+        return 'yuv420p' if profile in (66, 77, 88, 100) else None
+    if fourcc in ('hvc1', 'hev1'):
+        found = _child(buf, start, end, 'hvcC')
+        if not found or found[1] - found[0] < 18:
+            return None
+        s, _ = found
+        return _pix_fmt(buf[s + 16] & 0x03, (buf[s + 17] & 0x07) + 8)
+    if fourcc == 'av01':
+        found = _child(buf, start, end, 'av1C')
+        if not found or found[1] - found[0] < 3:
+            return None
+        flags = buf[found[0] + 2]
+        depth = 12 if flags & 0x20 else 10 if flags & 0x40 else 8
+        if flags & 0x10:
+            return _pix_fmt(0, depth)
+        sub_x, sub_y = flags & 0x08, flags & 0x04
+        return _pix_fmt(1 if sub_x and sub_y else 2 if sub_x else 3, depth)
+    if fourcc == 'vp09':
+        found = _child(buf, start, end, 'vpcC')
+        if not found or found[1] - found[0] < 7:
+            return None
+        packed = buf[found[0] + 6]
+        chroma = (packed >> 1) & 0x07
+        return _pix_fmt(1 if chroma in (0, 1) else chroma, packed >> 4)
+    if fourcc in ('apco', 'apcs', 'apcn', 'apch'):
+        return 'yuv422p10le'
+    return None
+
+def _matrix_coefficients(fourcc, buf, start, end):
+    """Colour matrix of a visual sample entry, from vpcC or a colr box, None when it isn't signalled"""
+    found = _child(buf, start, end, 'vpcC') if fourcc == 'vp09' else None
+    if found and found[1] - found[0] >= 10:
+        return buf[found[0] + 9]
+    found = _child(buf, start, end, 'colr')
+    if found and found[1] - found[0] >= 10 and buf[found[0]:found[0] + 4] in (b'nclx', b'nclc'):
+        return struct.unpack_from('>H', buf, found[0] + 8)[0]
+    return None
+
+def _sample_entry(buf, start, end, handler):
+    """Codec fields of the first entry of an stsd box"""
+    entries = list(_boxes(buf, start + 8, end))
+    if not entries:
+        raise ValueError('empty sample description')
+    fourcc, s, e = entries[0]
+    stream = {
+        "codec_tag_string": fourcc,
+        "codec_tag": "0x%08x" % struct.unpack('<I', fourcc.encode('latin-1'))[0],
+    }
+    if fourcc in ('encv', 'enca'):
+        raise Unsupported('encrypted track')
+    if handler == 'vide':
+        width, height = struct.unpack_from('>HH', buf, s + 24)
+        children = s + 78
+        codec = VIDEO_CODECS.get(fourcc)
+        if fourcc == 'mp4v':
+            esds = _find_esds(buf, children, e)
+            codec = OBJECT_TYPES.get(_esds_object_type(buf, *esds)) if esds else None
+        if codec is None:
+            raise Unsupported(f'video codec {fourcc}')
+        stream.update({"codec_name": codec, "codec_type": "video", "width": width, "height": height})
+        pix_fmt = _video_pix_fmt(fourcc, buf, children, e)
+        if pix_fmt and pix_fmt.startswith('yuv444p') and _matrix_coefficients(fourcc, buf, children, e) == 0:
+            # 4:4:4 with the identity matrix is RGB, which ffprobe reports as planar GBR
+            pix_fmt = 'gbrp' + pix_fmt[len('yuv444p'):]
+        if pix_fmt:
+            stream["pix_fmt"] = pix_fmt
+    elif handler == 'soun':
+        version, = struct.unpack_from('>H', buf, s + 8)
+        channels, = struct.unpack_from('>H', buf, s + 16)
+        sample_rate = struct.unpack_from('>I', buf, s + 24)[0] >> 16
+        if version == 0:
+            children = s + 28
+        elif version == 1:
+            children = s + 44
+        elif version == 2:
+            sample_rate = round(struct.unpack_from('>d', buf, s + 32)[0])
+            channels, = struct.unpack_from('>I', buf, s + 40)
+            children = s + 64
+        else:
+            raise Unsupported(f'sound sample description version {version}')
+        codec = AUDIO_CODECS.get(fourcc)
+        if fourcc == 'mp4a':
+            esds = _find_esds(buf, children, e)
+            codec = OBJECT_TYPES.get(_esds_object_type(buf, *esds)) if esds else None
+        if codec is None:
+            raise Unsupported(f'audio codec {fourcc}')
+        stream.update({"codec_name": codec, "codec_type": "audio", "sample_rate": str(sample_rate), "channels": channels})
+    else:
+        stream["codec_type"] = "subtitle" if handler in SUBTITLE_HANDLERS else "data"
+        if fourcc == 'tx3g':
+            stream["codec_name"] = "mov_text"
+    return stream
+
+def _rate(num, den):
+    if not num or not den:
+        return "0/0"
+    d = gcd(num, den)
+    return f"{num // d}/{den // d}"
+
+def _sum_sample_sizes(buf, start, end):
+    sample_size, count = struct.unpack_from('>II', buf, start + 4)
+    if sample_size:
+        return sample_size * count
+    table = array('I')
+    if table.itemsize != 4:
+        return sum(struct.unpack_from(f'>{count}I', buf, start + 12))
+    table.frombytes(buf[start + 12:start + 12 + count * 4])
+    if sys.byteorder == 'little':
+        table.byteswap()
+    return sum(table)
+
+def _display(buf, start, end):
+    """Transformation matrix (without its translation) and display width and height of a tkhd box"""
+    offset = start + (52 if buf[start] == 1 else 40)
+    if offset + 44 > end:
+        raise ValueError('truncated track header')
+    a, b, u, c, d, v, _, _, w = struct.unpack_from('>9i', buf, offset)
+    width, height = struct.unpack_from('>II', buf, offset + 36)
+    return (a, b, u, c, d, v, w), width / 65536, height / 65536
+
+def _track(buf, start, end, index):
+    tkhd = _child(buf, start, end, 'tkhd')
+    if not tkhd:
+        raise ValueError('track without header')
+    mdia = _child(buf, start, end, 'mdia')
+    if not mdia:
+        raise ValueError('track without media')
+    mdhd, hdlr = _child(buf, *mdia, 'mdhd'), _child(buf, *mdia, 'hdlr')
+    stbl = _child(buf, *mdia, 'minf', 'stbl')
+    if not mdhd or not hdlr or not stbl:
+        raise ValueError('incomplete track')
+    if buf[mdhd[0]] == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, mdhd[0] + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, mdhd[0] + 12)
+    handler = buf[hdlr[0] + 8:hdlr[0] + 12].decode('latin-1')
+
+    stsd = _child(buf, *stbl, 'stsd')
+    if not stsd:
+        raise ValueError('track without sample description')
+    stream = {"index": index}
+    stream.update(_sample_entry(buf, *stsd, handler))
+    if stream["codec_type"] == "video":
+        matrix, display_width, display_height = _display(buf, *tkhd)
+        # ffprobe reports these as a display matrix side data and a sample aspect ratio, which aren't built here
+        if matrix != IDENTITY_MATRIX:
+            raise Unsupported('rotated or transformed video track')
+        if display_width and display_height and (round(display_width), round(display_height)) != (stream["width"], stream["height"]):
+            raise Unsupported('video track displayed at a different size than it is coded')
+
+    # Sample durations, the most common one gives the frame rate like ffprobe's r_frame_rate does for constant rate video
+    stts = _child(buf, *stbl, 'stts')
+    nb_frames, deltas = 0, Counter()
+    if stts:
+        entries, = struct.unpack_from('>I', buf, stts[0] + 4)
+        for i in range(entries):
+            count, delta = struct.unpack_from('>II', buf, stts[0] + 8 + i * 8)
+            nb_frames += count
+            deltas[delta] += count
+    if not duration:
+        duration = sum(delta * count for delta, count in deltas.items())
+    stream["time_base"] = f"1/{timescale}"
+    stream["duration_ts"] = duration
+    seconds = duration / timescale if timescale else 0
+    stream["duration"] = "%.6f" % seconds
+    if stream["codec_type"] == "video":
+        stream["r_frame_rate"] = _rate(timescale, deltas.most_common(1)[0][0]) if deltas else "0/0"
+        stream["avg_frame_rate"] = _rate(nb_frames * timescale, duration)
+    if nb_frames:
+        stream["nb_frames"] = str(nb_frames)
+    stsz = _child(buf, *stbl, 'stsz')
+    if stsz and seconds:
+        stream["bit_rate"] = str(int(_sum_sample_sizes(buf, *stsz) * 8 / seconds))
+    return stream
+
+def probe(path):
+    """
+    Streams and format of the MP4/MOV file at path in ffprobe's layout, i.e. {"streams": [...], "format": {...}}.
+
+    Returns None when the file can't be read natively, either because it's damaged or incomplete or because it
+    uses something this parser doesn't cover. Callers should then run ffprobe, which may still manage.
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            ftyp, moov = _read_top_level(f, file_size)
+        if _child(moov, 0, len(moov), 'mvex'):
+            raise Unsupported('fragmented file')
+        mvhd = _child(moov, 0, len(moov), 'mvhd')
+        if not mvhd:
+            raise ValueError('no mvhd box')
+        if moov[mvhd[0]] == 1:
+            timescale, duration = struct.unpack_from('>IQ', moov, mvhd[0] + 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', moov, mvhd[0] + 12)
+        traks = [(s, e) for kind, s, e in _boxes(moov) if kind == 'trak']
+        streams = [_track(moov, s, e, i) for i, (s, e) in enumerate(traks)]
+    except Unsupported as ex:
+        logger.debug(f'Not probing {str(path)} natively: {ex}')
+        return None
+    except (OSError, ValueError, IndexError, struct.error) as ex:
+        logger.debug(f'Native probe of {str(path)} failed: {ex}')
+        return None
+    if not any(st["codec_type"] in ("video", "audio") for st in streams):
+        return None
+
+    seconds = duration / timescale if timescale else max((float(st["duration"]) for st in streams), default=0)
+    fmt = {
+        "filename": str(path),
+        "nb_streams": len(streams),
+        "format_name": FORMAT_NAME,
+        "duration": "%.6f" % seconds,
+        "size": str(file_size),
+        "probe_score": 100,
+    }
+    if seconds:
+        fmt["bit_rate"] = str(int(file_size * 8 / seconds))
+    if ftyp and len(ftyp) >= 8:
+        fmt["tags"] = {
+            "major_brand": ftyp[:4].decode('latin-1'),
+            "minor_version": str(struct.unpack_from('>I', ftyp, 4)[0]),
+            "compatible_brands": ftyp[8:].decode('latin-1'),
+        }
+    return { "streams": streams, "format": fmt }
+
+def is_faststart(path):
+    """
+    Whether the moov box of the MP4/MOV file at path comes before its media data, so players can start without
+    first fetching the end of the file. None when path isn't an MP4/MOV file or its structure can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            for kind, *_ in _top_level(f, os.fstat(f.fileno()).st_size):
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+    except (OSError, ValueError, struct.error) as ex:
+        logger.debug(f'Unable to read the box layout of {str(path)}: {ex}')
+    return None
@@ -12,7 +12,19 @@ def fireshare_scan():
     logger.info('Starting scheduled scan...')
     Popen(["fireshare", "bulk-import"], shell=False)
 
-def init_schedule(dburl, mins_between_scan=5):
+def fireshare_watch():
+    logger.info('Starting video directory watcher...')
+    Popen(["fireshare", "watch"], shell=False)
+
+def fireshare_worker(concurrency):
+    logger.info(f'Starting transcode worker... concurrency={concurrency}')
+    Popen(["fireshare", "worker", f"--concurrency={concurrency}"], shell=False)
+
+def init_schedule(dburl, mins_between_scan=5, watch=False, transcode_workers=0):
+    if watch:
+        fireshare_watch()
+    if transcode_workers > 0:
+        fireshare_worker(transcode_workers)
     if mins_between_scan > 0:
         logger.info(f'Initializing scheduled video scan. minutes={mins_between_scan}')
         scheduler = BackgroundScheduler(jobstores={'default': SQLAlchemyJobStore(url=dburl)})
@@ -4,10 +4,21 @@ import json
 import subprocess as sp
 import xxhash
 from fireshare import logger
+from .constants import SUPPORTED_FILE_EXTENSIONS, CHUNK_FILE_PATTERN, TRANSCODE_PATTERN, POSTER_WIDTHS, POSTER_FORMATS, \
+    SEEK_PREVIEW_WIDTH, SEEK_PREVIEW_COLUMNS, SEEK_PREVIEW_ROWS
+from . import mp4
 import time
 import glob
 import re
+import threading
+import zlib
+import shutil
+import math
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import Optional, Set
+from collections import OrderedDict
+from flask import has_app_context
 
 def lock_exists(path: Path):
     """
@@ -35,23 +46,286 @@ def remove_lock(path: Path):
         logger.debug(f"A lockfile has been removed at {str(lockfile)}")
         os.remove(lockfile)
 
+def walk_video_files(root: Path, exclude_dirs=(), skipped=None, recursive=True):
+    """
+    Walks root with os.scandir and yields (path, stat) for every importable video file.
+
+    Names are filtered before anything is stat'ed: unsupported suffixes, chunked upload parts and our own
+    transcoded variants are pruned during the walk, and each remaining file is stat'ed exactly once. Directories
+    in exclude_dirs are not descended into and, like glob('**'), symlinked directories are not followed.
+    If a skipped dict is given it is filled with counts of what was pruned.
+    """
+    exclude_dirs = {os.path.normpath(str(d)) for d in exclude_dirs}
+    if skipped is None:
+        skipped = {}
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as ex:
+            logger.warning(f"Unable to scan directory {directory}: {ex}")
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path in exclude_dirs:
+                        logger.debug(f"Skipping excluded directory {entry.path}")
+                        skipped['excluded'] = skipped.get('excluded', 0) + 1
+                    elif recursive:
+                        stack.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1].lower() not in SUPPORTED_FILE_EXTENSIONS:
+                    continue
+                if CHUNK_FILE_PATTERN.search(entry.name):
+                    continue
+                if TRANSCODE_PATTERN.search(entry.name):
+                    logger.debug(f"Skipping transcoded file: {entry.name}")
+                    skipped['transcoded'] = skipped.get('transcoded', 0) + 1
+                    continue
+                if not entry.is_file():
+                    continue
+                yield Path(entry.path), entry.stat()
+            except OSError as ex:
+                logger.warning(f"Unable to stat {entry.path}: {ex}")
+
+def _process_pool(workers):
+    # Library roots are scanned from several threads at once, and forking a threaded process can leave the child
+    # holding a lock (e.g. a logging handler's) that no thread will ever release, so workers come from a forkserver
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+def _walk_shard(args):
+    root, exclude_dirs = args
+    skipped = {}
+    return list(walk_video_files(root, exclude_dirs, skipped)), skipped
+
+def walk_video_files_sharded(root: Path, exclude_dirs=(), skipped=None, workers=2):
+    """
+    Same as walk_video_files, but each top-level directory under root is walked by one of a pool of worker processes.
+
+    Returns a list of (path, stat) instead of a generator.
+    """
+    if skipped is None:
+        skipped = {}
+    files = list(walk_video_files(root, exclude_dirs, skipped, recursive=False))
+    excluded = {os.path.normpath(str(d)) for d in exclude_dirs}
+    with os.scandir(root) as it:
+        shards = [Path(e.path) for e in it if e.is_dir(follow_symlinks=False) and e.path not in excluded]
+    with _process_pool(workers) as pool:
+        for shard_files, shard_skipped in pool.map(_walk_shard, [(shard, exclude_dirs) for shard in shards]):
+            files += shard_files
+            for k, v in shard_skipped.items():
+                skipped[k] = skipped.get(k, 0) + v
+    return files
+
+def link_video(src: Path, dst: Path, replace=False):
+    """
+    Symlinks dst to src. With replace, an existing link at dst is atomically swapped to point at src
+    """
+    if os.path.lexists(dst):
+        if not replace or os.readlink(dst) == str(src):
+            return
+        tmp = dst.with_name(f".{dst.name}.tmp")
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(src, tmp)
+        os.replace(tmp, dst)
+        logger.info(f"Relinked {str(dst)} --> {str(src)}")
+    else:
+        os.symlink(src, dst)
+        logger.info(f"Linked {str(dst)} --> {str(src)}")
+
+def chunks(items, size=10000):
+    """
+    Yields successive slices of items, keeping IN (...) clauses under SQLite's bound parameter limit
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Versions of the video_id fingerprint. The scheme an id was made with is stored with it, never change what one computes
+VIDEO_ID_SCHEME_HEADER = 1   # xxh3_128 of the first 16mb
+VIDEO_ID_SCHEME_SAMPLED = 2  # xxh3_128 of the file size plus 1mb blocks from the head, middle and tail
+VIDEO_ID_SCHEMES = {'header': VIDEO_ID_SCHEME_HEADER, 'sampled': VIDEO_ID_SCHEME_SAMPLED}
+
+_SAMPLE_BLOCK_SIZE = 1024*1024
+
+# Per-thread read buffer for video_id, so hashing in parallel doesn't hold a full header per worker
+_HASH_BUFFER_SIZE = 1024*1024
+_hash_buffers = threading.local()
+
+def _hash_buffer():
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = memoryview(bytearray(_HASH_BUFFER_SIZE))
+    return buf
+
+def _hash_range(f, hasher, offset, length):
+    buf = _hash_buffer()
+    f.seek(offset)
+    while length > 0:
+        n = f.readinto(buf[:min(length, _HASH_BUFFER_SIZE)])
+        if not n:
+            break
+        hasher.update(buf[:n])
+        length -= n
+
 def video_id(path: Path, mb=16):
     """
     Calculates the id of a video by using xxhash on the first 16mb (or the whole file if it's less than that)
+
+    The header is streamed through a small reusable buffer, the digest is identical to hashing it in one read.
+    """
+    hasher = xxhash.xxh3_128()
+    with path.open('rb', 0) as f:
+        _hash_range(f, hasher, 0, int(1024*1024*mb))
+    return hasher.hexdigest()
+
+def sampled_video_id(path: Path):
+    """
+    Calculates the id of a video by using xxhash on its size and three 1mb blocks taken from the start, middle and end.
+
+    Only 3mb is read no matter how large the file is, and unlike the header alone it tells apart recordings that
+    start out identical. Files of 3mb or less are hashed whole.
     """
+    hasher = xxhash.xxh3_128()
     with path.open('rb', 0) as f:
-        file_header = f.read(int(1024*1024*mb))
-    return xxhash.xxh3_128_hexdigest(file_header)
+        size = os.fstat(f.fileno()).st_size
+        hasher.update(size.to_bytes(8, 'little'))
+        if size <= 3 * _SAMPLE_BLOCK_SIZE:
+            _hash_range(f, hasher, 0, size)
+        else:
+            for offset in (0, size // 2 - _SAMPLE_BLOCK_SIZE // 2, size - _SAMPLE_BLOCK_SIZE):
+                _hash_range(f, hasher, offset, _SAMPLE_BLOCK_SIZE)
+    return hasher.hexdigest()
+
+def compute_video_id(path: Path, scheme=VIDEO_ID_SCHEME_HEADER):
+    if scheme == VIDEO_ID_SCHEME_SAMPLED:
+        return sampled_video_id(path)
+    return video_id(path)
+
+def hash_videos(paths, workers=1, scheme=VIDEO_ID_SCHEME_HEADER):
+    """
+    Calculates the video_id of each path with the given scheme using a pool of worker threads.
+
+    Returns a list of ids in the same order as paths, with None for any file that could not be read.
+    """
+    def _hash(path):
+        try:
+            return compute_video_id(path, scheme)
+        except OSError as ex:
+            logger.warning(f"Could not hash {str(path)}: {ex}")
+            return None
+
+    if workers <= 1 or len(paths) <= 1:
+        return [_hash(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_hash, paths))
+
+def _hash_shard(args):
+    paths, scheme, threads = args
+    return hash_videos(paths, threads, scheme)
+
+def hash_videos_sharded(paths, workers=2, scheme=VIDEO_ID_SCHEME_HEADER, threads=1):
+    """
+    Same as hash_videos, but paths are sharded by a hash of the path over a pool of worker processes,
+    each of which hashes its shard with the given number of threads.
+    """
+    shards = [[] for _ in range(workers)]
+    for i, path in enumerate(paths):
+        shards[zlib.crc32(os.fsencode(str(path))) % workers].append(i)
+    shards = [shard for shard in shards if shard]
+    ids = [None] * len(paths)
+    with _process_pool(workers) as pool:
+        results = pool.map(_hash_shard, [([paths[i] for i in shard], scheme, threads) for shard in shards])
+        for shard, shard_ids in zip(shards, results):
+            for i, vid in zip(shard, shard_ids):
+                ids[i] = vid
+    return ids
+
+# Recently used probes by file version, so repeated lookups (e.g. every /api/stream request) don't hit the database
+_PROBE_MEMO: "OrderedDict[tuple, dict]" = OrderedDict()
+_PROBE_MEMO_SIZE = 1024
+_probe_memo_lock = threading.Lock()
+
+def probe_key(path):
+    """
+    (real path, size, mtime_ns) identifying the version of the file at path. Symlinks are resolved so a video's
+    link and its original share one cache entry. Raises OSError if the file can't be stat'ed.
+    """
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    return real, st.st_size, st.st_mtime_ns
 
-def get_media_info(path):
+def run_probe(path, timeout=None):
+    """
+    Probes path once and returns {"streams": [...], "format": {...}}, or None if it could not be read.
+    MP4 and MOV files are read in-process, ffprobe is only started for other containers and for files the native parser can't handle.
+    """
+    if Path(path).suffix.lower() in mp4.NATIVE_PROBE_EXTENSIONS:
+        data = mp4.probe(path)
+        if data is not None:
+            return data
+    return run_ffprobe(path, timeout)
+
+def run_ffprobe(path, timeout=None):
+    """
+    Runs a single full ffprobe of path and returns {"streams": [...], "format": {...}}, or None if it could not be read
+    """
     try:
-        cmd = f'ffprobe -v quiet -print_format json -show_entries stream {path}'
-        logger.debug(f"$ {cmd}")
-        data = json.loads(sp.check_output(cmd.split()).decode('utf-8'))
-        return data['streams']
+        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', str(path)]
+        logger.debug(f"$ {' '.join(cmd)}")
+        data = json.loads(sp.check_output(cmd, timeout=timeout).decode('utf-8'))
+        return { "streams": data.get('streams', []), "format": data.get('format', {}) }
     except Exception as ex:
+        logger.debug(f'Probe of {str(path)} failed: {ex}')
+        return None
+
+def _memoize_probe(key, data):
+    with _probe_memo_lock:
+        _PROBE_MEMO[key] = data
+        _PROBE_MEMO.move_to_end(key)
+        while len(_PROBE_MEMO) > _PROBE_MEMO_SIZE:
+            _PROBE_MEMO.popitem(last=False)
+
+def probe_media(path, timeout=None):
+    """
+    Full probe result for path in ffprobe's layout, probing each version of a file at most once.
+
+    Results are kept in memory and, when called inside an app context, in the probe_cache table so they
+    survive restarts and are shared between the scanner, the transcoder and the web server. A file that
+    can't be read is not cached, it may still be being written.
+    """
+    try:
+        key = probe_key(path)
+    except OSError as ex:
+        logger.debug(f'Unable to probe {str(path)}: {ex}')
+        return None
+    with _probe_memo_lock:
+        data = _PROBE_MEMO.get(key)
+        if data is not None:
+            _PROBE_MEMO.move_to_end(key)
+            return data
+
+    use_db = has_app_context()
+    if use_db:
+        from .models import ProbeCache
+        data = ProbeCache.get(key)
+    if data is None:
+        data = run_probe(path, timeout)
+        if data is None:
+            return None
+        if use_db:
+            ProbeCache.put(key, data)
+    _memoize_probe(key, data)
+    return data
+
+def get_media_info(path, timeout=None):
+    data = probe_media(path, timeout)
+    if data is None:
         logger.warning('Could not extract video info')
         return None
+    return data['streams']
 
 def get_video_duration(path):
     """
@@ -63,11 +337,9 @@ def get_video_duration(path):
     Returns:
         float: Duration in seconds, or None if unable to determine
     """
+    data = probe_media(path)
     try:
-        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_entries', 'format=duration', str(path)]
-        logger.debug(f"$ {' '.join(cmd)}")
-        data = json.loads(sp.check_output(cmd).decode('utf-8'))
-        if 'format' in data and 'duration' in data['format']:
+        if data and 'duration' in data['format']:
             return float(data['format']['duration'])
     except Exception as ex:
         logger.debug(f'Could not extract video duration: {ex}')
@@ -76,21 +348,51 @@ def get_video_duration(path):
 # --- Streaming/transcoding helpers (re-introduced for Firefox progressive support) ---
 def _probe_codecs(src_path: Path):
     """Return (vcodec, acodec) for first video/audio streams using ffprobe."""
-    try:
-        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', str(src_path)]
-        logger.debug(f"$ {' '.join(cmd)}")
-        data = json.loads(sp.check_output(cmd).decode('utf-8'))
-        vcodec = None
-        acodec = None
-        for s in data.get('streams', []):
-            if s.get('codec_type') == 'video' and not vcodec:
-                vcodec = s.get('codec_name')
-            if s.get('codec_type') == 'audio' and not acodec:
-                acodec = s.get('codec_name')
-        return vcodec, acodec
-    except Exception as ex:
-        logger.debug(f'Codec probe failed: {ex}')
+    data = probe_media(src_path)
+    if data is None:
+        logger.debug(f'Codec probe failed for {str(src_path)}')
         return None, None
+    vcodec = None
+    acodec = None
+    for s in data['streams']:
+        if s.get('codec_type') == 'video' and not vcodec:
+            vcodec = s.get('codec_name')
+        if s.get('codec_type') == 'audio' and not acodec:
+            acodec = s.get('codec_name')
+    return vcodec, acodec
+
+def _parse_rate(rate):
+    try:
+        num, den = str(rate).split('/')
+        return float(num) / float(den) if float(den) else None
+    except (ValueError, TypeError):
+        return None
+
+def media_columns(streams, fmt=None, extension=None):
+    """
+    The VideoInfo columns derived from a probe: codecs, frame rate, bitrate, pixel format and container.
+
+    fmt is ffprobe's format section, when it is not known the container is taken from the file extension
+    and the bitrate from the video stream alone.
+    """
+    vstream = next((st for st in streams or [] if st.get('codec_type') == 'video'), {})
+    astream = next((st for st in streams or [] if st.get('codec_type') == 'audio'), {})
+    names = [n for n in (fmt or {}).get('format_name', '').split(',') if n]
+    ext = (extension or '').lstrip('.').lower()
+    bitrate = vstream.get('bit_rate') or (fmt or {}).get('bit_rate')
+    try:
+        bitrate = int(bitrate) if bitrate else None
+    except ValueError:
+        bitrate = None
+    return {
+        "video_codec": vstream.get('codec_name'),
+        "audio_codec": astream.get('codec_name'),
+        "frame_rate": _parse_rate(vstream.get('r_frame_rate')),
+        "bitrate": bitrate,
+        "pixel_format": vstream.get('pix_fmt'),
+        # ffprobe names demuxers by family (e.g. "mov,mp4,m4a,3gp,3g2,mj2"), so prefer the member matching the extension
+        "container": ext if ext in names else (names[0] if names else ext or None),
+    }
 
 # Cache of available encoders to avoid expensive ffmpeg probing per request
 _ENCODERS_CACHE: Optional[Set[str]] = None
@@ -109,8 +411,8 @@ def _load_encoders_cache() -> Set[str]:
             # Skip headers and empty lines
             if not line or line.lstrip().startswith(('Encoders', '------')):
                 continue
-            # Match patterns with capability flags, whitespace, then the encoder name
-            m = re.match(r"\s*[AVFS.]+\s+([0-9A-Za-z_\-]+)\b", line)
+            # Match the six capability flags (e.g. "V....D", newer ffmpeg versions add X, B and D), whitespace, then the encoder name
+            m = re.match(r"\s*[A-Z.]{6}\s+([0-9A-Za-z_\-]+)\b", line)
             if m:
                 encoders.add(m.group(1))
     except Exception as ex:
@@ -226,13 +528,208 @@ def calculate_transcode_timeout(video_path, base_timeout=7200):
         logger.debug(f"Could not determine video duration, using base timeout: {base_timeout}s")
         return base_timeout
 
-def create_poster(video_path, out_path, second=0):
+def faststart_path(processed: Path, video_id, extension):
+    """Where the faststart copy of a video is kept"""
+    return processed / "derived" / video_id / f"{video_id}-faststart{extension}"
+
+def video_link_source(processed: Path, video_id, extension, src: Path):
+    """
+    What a video's link in video_links should point at: its faststart copy once one has been made, otherwise src
+    """
+    copy = faststart_path(processed, video_id, extension)
+    return copy.absolute() if copy.is_file() else src
+
+def create_faststart_copy(video_path, out_path, timeout=None):
+    """
+    Remuxes video_path into out_path with the moov box moved to the front. Streams are copied, never re-encoded.
+    Returns True once out_path exists and is verified to be faststart.
+    """
     s = time.time()
-    cmd = ['ffmpeg', '-v', 'quiet', '-y', '-i', str(video_path), '-ss', str(second), '-vframes', '1', '-vf', 'scale=iw:ih:force_original_aspect_ratio=decrease', str(out_path)]
+    tmp_path = out_path.with_name(f".{out_path.name}.tmp")
+    # Data tracks such as QuickTime timecodes can't always be remuxed, and players ignore them anyway
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', str(video_path), '-map', '0', '-map', '-0:d', '-c', 'copy',
+           '-map_metadata', '0', '-movflags', '+faststart', '-f', 'mov' if out_path.suffix.lower() == '.mov' else 'mp4', str(tmp_path)]
     logger.debug(f"$ {' '.join(cmd)}")
-    sp.call(cmd)
+    try:
+        sp.run(cmd, check=True, timeout=timeout, stdout=sp.DEVNULL, stderr=sp.PIPE)
+        if not mp4.is_faststart(tmp_path):
+            raise ValueError("the remuxed file still has its moov box after the media data")
+        os.replace(tmp_path, out_path)
+    except (sp.CalledProcessError, sp.TimeoutExpired, ValueError, OSError) as ex:
+        detail = ex.stderr.decode('utf-8', 'replace').strip() if isinstance(ex, sp.CalledProcessError) and ex.stderr else ex
+        logger.warning(f"Could not create a faststart copy of {str(video_path)}: {detail}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    logger.info(f'Created faststart copy {str(out_path)} in {time.time()-s:.2f}s')
+    return True
+
+def _extract_poster(video_path, out_path, second, timeout):
+    # Seeking on the input jumps straight to the keyframe before `second` instead of decoding everything up to it,
+    # and skipping non-keyframes means that keyframe is the only frame decoded
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-skip_frame', 'nokey', '-ss', str(second), '-noaccurate_seek', '-i', str(video_path),
+           '-frames:v', '1', '-vf', 'scale=iw:ih:force_original_aspect_ratio=decrease', '-update', '1', str(out_path)]
+    logger.debug(f"$ {' '.join(cmd)}")
+    try:
+        sp.run(cmd, timeout=timeout, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    except sp.TimeoutExpired:
+        logger.warning(f"Timed out after {timeout}s extracting a poster from {str(video_path)}")
+    return out_path.exists() and out_path.stat().st_size > 0
+
+def create_poster(video_path, out_path, second=0, timeout=None):
+    """
+    Writes the keyframe at or before `second` of video_path to out_path, returns whether a poster was written.
+    Falls back to the first keyframe when there is none to seek to, e.g. when `second` is the very end of the video.
+    """
+    s = time.time()
+    out_path = Path(out_path)
+    # Written next to the poster first, so a failed run never replaces a good poster with a broken one
+    tmp_path = out_path.with_name(f".{out_path.stem}.tmp{out_path.suffix}")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    ok = _extract_poster(video_path, tmp_path, second, timeout) or (second > 0 and _extract_poster(video_path, tmp_path, 0, timeout))
     e = time.time()
-    logger.info(f'Generated poster {str(out_path)} in {e-s}s')
+    if ok:
+        os.replace(tmp_path, out_path)
+        logger.info(f'Generated poster {str(out_path)} in {e-s:.2f}s')
+    else:
+        logger.warning(f'Could not generate a poster for {str(video_path)}')
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return ok
+
+# Encoder settings per poster format, the encoder a format needs is the value following '-c:v'
+POSTER_ENCODERS = {
+    'avif': ['-c:v', 'libaom-av1', '-still-picture', '1', '-crf', '32', '-cpu-used', '6', '-f', 'avif'],
+    'webp': ['-c:v', 'libwebp', '-quality', '80', '-f', 'webp'],
+}
+
+def poster_variant_path(poster_path: Path, width, fmt):
+    return poster_path.with_name(f"{poster_path.stem}-{width}.{fmt}")
+
+def poster_variant_formats():
+    """The poster formats the installed ffmpeg can encode"""
+    return [fmt for fmt in POSTER_FORMATS if _encoder_available(POSTER_ENCODERS[fmt][1])]
+
+def create_poster_variants(poster_path: Path, timeout=None):
+    """
+    Writes a copy of the poster at every POSTER_WIDTHS width in every supported POSTER_FORMATS format, in a single ffmpeg run.
+    Posters narrower than a width are not upscaled. Returns whether all copies were written.
+    """
+    formats = poster_variant_formats()
+    if not formats:
+        logger.debug("ffmpeg has no AVIF or WebP encoder, not creating poster variants")
+        return False
+    s = time.time()
+    graph, outputs = [f"[0:v]format=yuv420p,split={len(POSTER_WIDTHS)}" + "".join(f"[s{i}]" for i in range(len(POSTER_WIDTHS)))], []
+    for i, width in enumerate(POSTER_WIDTHS):
+        labels = [f"[v{i}{fmt}]" for fmt in formats]
+        graph.append(f"[s{i}]scale=w='trunc(min({width},iw)/2)*2':h=-2,split={len(formats)}" + "".join(labels))
+        for fmt, label in zip(formats, labels):
+            out_path = poster_variant_path(poster_path, width, fmt)
+            outputs.append((out_path, out_path.with_name(f".{out_path.name}.tmp"), label, fmt))
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', str(poster_path), '-filter_complex', ";".join(graph)]
+    for _, tmp_path, label, fmt in outputs:
+        cmd += ['-map', label, '-frames:v', '1', *POSTER_ENCODERS[fmt], str(tmp_path)]
+    logger.debug(f"$ {' '.join(cmd)}")
+    try:
+        sp.run(cmd, check=True, timeout=timeout, stdout=sp.DEVNULL, stderr=sp.PIPE)
+        for out_path, tmp_path, _, _ in outputs:
+            os.replace(tmp_path, out_path)
+    except (sp.CalledProcessError, sp.TimeoutExpired, OSError) as ex:
+        detail = ex.stderr.decode('utf-8', 'replace').strip() if isinstance(ex, sp.CalledProcessError) and ex.stderr else ex
+        logger.warning(f"Could not create the resized copies of {str(poster_path)}: {detail}")
+        for _, tmp_path, _, _ in outputs:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return False
+    logger.info(f"Generated {len(outputs)} resized copies of {str(poster_path)} in {time.time()-s:.2f}s")
+    return True
+
+# Encoder settings per seek preview sheet format, WebP when ffmpeg has libwebp
+SEEK_PREVIEW_ENCODERS = {
+    'webp': ['-c:v', 'libwebp', '-quality', '70'],
+    'jpg': ['-c:v', 'mjpeg', '-q:v', '5'],
+}
+
+def seek_preview_paths(derived_path: Path):
+    """The WebVTT index and the folder of sprite sheets of a video's seek preview"""
+    return derived_path / "seek-preview.vtt", derived_path / "seek-preview"
+
+def _vtt_timestamp(sec):
+    ms = int(round(sec * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+def _seek_preview_layout(duration, aspect, interval):
+    """Thumbnail width, height and count of a seek preview, and the ffmpeg filters picking the thumbnails and tiling them"""
+    width = SEEK_PREVIEW_WIDTH
+    height = max(int(round(width / (aspect or 16/9) / 2)) * 2, 2)
+    count = max(math.ceil(duration / interval), 1)
+    # Short videos get sheets only as tall as their thumbnails need
+    rows = min(SEEK_PREVIEW_ROWS, math.ceil(count / SEEK_PREVIEW_COLUMNS))
+    # Letterboxed into a fixed size box, so the cue coordinates hold whatever the stored dimensions or rotation say
+    # start_time and rounding up keep a video shorter than one interval, or with a single keyframe, from getting no thumbnail
+    thumbnails = (f"fps=1/{interval}:start_time=0:round=up,scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                  f"pad={width}:{height}:-1:-1")
+    return width, height, count, thumbnails, f"tile={SEEK_PREVIEW_COLUMNS}x{rows}"
+
+def _finish_seek_preview(tmp_path: Path, derived_path: Path, fmt, duration, aspect, interval):
+    """Writes the WebVTT index of the sheets ffmpeg wrote to tmp_path and moves them into place"""
+    vtt_path, sheets_path = seek_preview_paths(derived_path)
+    width, height, count, _, _ = _seek_preview_layout(duration, aspect, interval)
+    sheets = sorted(tmp_path.glob(f"*.{fmt}"))
+    if not sheets:
+        raise OSError("ffmpeg wrote no sprite sheets")
+    per_sheet = SEEK_PREVIEW_COLUMNS * SEEK_PREVIEW_ROWS
+    # Cues for thumbnails past the last sheet ffmpeg wrote would point at nothing
+    count = min(count, len(sheets) * per_sheet)
+    cues = ["WEBVTT", ""]
+    for i in range(count):
+        sheet, tile = divmod(i, per_sheet)
+        x, y = tile % SEEK_PREVIEW_COLUMNS * width, tile // SEEK_PREVIEW_COLUMNS * height
+        cues += [f"{_vtt_timestamp(i * interval)} --> {_vtt_timestamp(min((i + 1) * interval, duration))}",
+                 f"{sheets_path.name}/{sheets[sheet].name}#xywh={x},{y},{width},{height}", ""]
+    tmp_vtt_path = vtt_path.with_name(f".{vtt_path.name}.tmp")
+    tmp_vtt_path.write_text("\n".join(cues))
+    shutil.rmtree(sheets_path, ignore_errors=True)
+    os.replace(tmp_path, sheets_path)
+    os.replace(tmp_vtt_path, vtt_path)
+    return count, len(sheets)
+
+def create_seek_preview(video_path, derived_path: Path, duration, aspect=None, interval=5, timeout=None):
+    """
+    Writes a thumbnail of every `interval` seconds of video_path to tiled sprite sheets, and a WebVTT file with a cue
+    per thumbnail pointing at its region of a sheet (`seek-preview/001.webp#xywh=x,y,w,h`), in a single ffmpeg run.
+    Only keyframes are decoded, so each thumbnail is the last keyframe up to its time. Returns whether it was written.
+    """
+    if not duration or duration <= 0:
+        return False
+    s = time.time()
+    fmt = 'webp' if _encoder_available('libwebp') else 'jpg'
+    _, _, _, thumbnails, tile = _seek_preview_layout(duration, aspect, interval)
+    tmp_path = derived_path / ".seek-preview.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-skip_frame', 'nokey', '-i', str(video_path), '-map', '0:v:0', '-an', '-sn', '-dn',
+           '-vf', f"{thumbnails},{tile}", '-fps_mode', 'passthrough', *SEEK_PREVIEW_ENCODERS[fmt], str(tmp_path / f"%03d.{fmt}")]
+    logger.debug(f"$ {' '.join(cmd)}")
+    try:
+        sp.run(cmd, check=True, timeout=timeout, stdout=sp.DEVNULL, stderr=sp.PIPE)
+        count, sheets = _finish_seek_preview(tmp_path, derived_path, fmt, duration, aspect, interval)
+    except (sp.CalledProcessError, sp.TimeoutExpired, OSError) as ex:
+        detail = ex.stderr.decode('utf-8', 'replace').strip() if isinstance(ex, sp.CalledProcessError) and ex.stderr else ex
+        logger.warning(f"Could not create a seek preview for {str(video_path)}: {detail}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return False
+    logger.info(f"Generated a seek preview of {count:,} thumbnails in {sheets} sheet(s) for {str(video_path)} in {time.time()-s:.2f}s")
+    return True
+
+def percentile(values, p):
+    """Nearest-rank p-th percentile of values, None when there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
 
 # Cache for NVENC availability check to avoid repeated subprocess calls
 _nvenc_availability_cache = {}
@@ -440,7 +937,75 @@ def _build_transcode_command(video_path, out_path, height, encoder):
 
     return cmd
 
-def transcode_video_quality(video_path, out_path, height, use_gpu=False, timeout_seconds=None):
+def _segmented_transcode(video_path, out_path: Path, height, encoder, timeout_seconds, segment_seconds, workers):
+    """
+    Transcodes a video in parallel: the video stream is cut at keyframes into segments of about `segment_seconds`
+    without re-encoding, the segments are encoded by up to `workers` ffmpeg processes at once while the audio is
+    encoded once next to them, and the results are joined with the concat demuxer.
+
+    Returns a CompletedProcess like sp.run, with the return code of the first step that failed, and raises
+    sp.TimeoutExpired once the whole transcode has taken timeout_seconds.
+    """
+    deadline = time.time() + timeout_seconds
+    tmp_path = out_path.parent / f".{out_path.stem}.segments.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    def run(cmd):
+        logger.debug(f"$: {' '.join(cmd)}")
+        return sp.run(cmd, timeout=max(deadline - time.time(), 1))
+
+    try:
+        # Matroska for the intermediate files, it takes any codec and keeps the timestamps of a cut as they are
+        split = run(['ffmpeg', '-v', 'error', '-y', '-i', str(video_path), '-map', '0:v:0', '-c', 'copy',
+                     '-f', 'segment', '-segment_time', str(segment_seconds), '-segment_format', 'matroska',
+                     '-reset_timestamps', '1', str(tmp_path / "src-%05d.mkv")])
+        segments = sorted(tmp_path.glob("src-*.mkv"))
+        if split.returncode != 0 or not segments:
+            return sp.CompletedProcess(split.args, split.returncode or 1)
+
+        # Each encoder would otherwise start a thread per core, which only adds contention once every core has a segment
+        threads = max((os.cpu_count() or 1) // workers, 1)
+        cmds = [['ffmpeg', '-v', 'error', '-y', '-i', str(segment), '-map', '0:v:0', '-c:v', encoder['video_codec'],
+                 *encoder.get('extra_args', []), '-threads', str(threads), '-vf', f'scale=-2:{height}',
+                 str(segment.with_name(segment.name.replace("src-", "enc-")))] for segment in segments]
+        streams = get_media_info(video_path) or []
+        has_audio = any(st.get('codec_type') == 'audio' for st in streams)
+        audio_path = tmp_path / "audio.mka"
+        if has_audio:
+            cmds.append(['ffmpeg', '-v', 'error', '-y', '-i', str(video_path), '-map', '0:a:0', '-vn',
+                         '-c:a', encoder['audio_codec'], '-b:a', encoder.get('audio_bitrate', '128k'), str(audio_path)])
+        logger.info(f"Encoding {len(segments)} segment(s) of {str(video_path)} with {workers} worker(s)")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run, cmd) for cmd in cmds]
+            try:
+                results = [f.result() for f in futures]
+            except sp.TimeoutExpired:
+                for f in futures:
+                    f.cancel()
+                raise
+        failed = next((r for r in results if r.returncode != 0), None)
+        if failed:
+            return failed
+
+        concat_list = tmp_path / "segments.txt"
+        concat_list.write_text("".join(f"file '{s.name.replace('src-', 'enc-')}'\n" for s in segments))
+        cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', str(concat_list)]
+        if has_audio:
+            cmd += ['-i', str(audio_path), '-map', '0:v:0', '-map', '1:a:0']
+        return run(cmd + ['-c', 'copy', str(out_path)])
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def _run_transcode(video_path, out_path, height, encoder, timeout_seconds, segment_seconds=None, workers=None):
+    # Hardware encoders have a handful of sessions and are fast enough on their own, segments are for CPU encoders
+    if segment_seconds and workers and workers > 1 and 'nvenc' not in encoder['video_codec']:
+        return _segmented_transcode(video_path, Path(out_path), height, encoder, timeout_seconds, segment_seconds, workers)
+    cmd = _build_transcode_command(video_path, out_path, height, encoder)
+    logger.debug(f"$: {' '.join(cmd)}")
+    return sp.run(cmd, timeout=timeout_seconds)
+
+def transcode_video_quality(video_path, out_path, height, use_gpu=False, timeout_seconds=None, segment_seconds=None, workers=None):
     """
     Transcode a video to a specific height (e.g., 720, 1080) while maintaining aspect ratio.
 
@@ -459,6 +1024,9 @@ def transcode_video_quality(video_path, out_path, height, use_gpu=False, timeout
         height: Target height in pixels (e.g., 720, 1080)
         use_gpu: Whether to use GPU acceleration (NVENC if available)
         timeout_seconds: Maximum time allowed for encoding (default: calculated based on video duration)
+        segment_seconds: Encode segments of about this many seconds in parallel instead of the whole video in one
+            ffmpeg process (CPU encoders only, see _segmented_transcode)
+        workers: Number of segments encoded at once
 
     Returns:
         bool: True if transcoding succeeded, False if all encoders failed
@@ -484,12 +1052,9 @@ def transcode_video_quality(video_path, out_path, height, use_gpu=False, timeout
 
         # Build ffmpeg command using the cached encoder
         logger.info(f"Transcoding video to {height}p using {encoder['name']}")
-        cmd = _build_transcode_command(video_path, out_path, height, encoder)
-
-        logger.debug(f"$: {' '.join(cmd)}")
 
         try:
-            result = sp.run(cmd, timeout=timeout_seconds)
+            result = _run_transcode(video_path, out_path, height, encoder, timeout_seconds, segment_seconds, workers)
             if result.returncode == 0:
                 e = time.time()
                 logger.info(f'Transcoded {str(out_path)} to {height}p in {e-s:.2f}s')
@@ -610,13 +1175,8 @@ def transcode_video_quality(video_path, out_path, height, use_gpu=False, timeout
     for encoder in encoders:
         logger.info(f"Trying {encoder['name']}...")
 
-        # Build ffmpeg command
-        cmd = _build_transcode_command(video_path, out_path, height, encoder)
-
-        logger.debug(f"$: {' '.join(cmd)}")
-
         try:
-            result = sp.run(cmd, timeout=timeout_seconds)
+            result = _run_transcode(video_path, out_path, height, encoder, timeout_seconds, segment_seconds, workers)
             if result.returncode == 0:
                 # Success! Cache this encoder and return
                 logger.info(f"✓ {encoder['name']} works! Using it for all transcodes this session.")
@@ -682,6 +1242,187 @@ def create_boomerang_preview(video_path, out_path, clip_duration=1.5):
     e = time.time()
     logger.info(f'Generated boomerang preview {str(out_path)} in {e-s}s')
 
+def _tmp_output_path(out_path: Path):
+    # Keeps the extension, ffmpeg picks the muxer from it
+    return out_path.with_name(f".{out_path.stem}.tmp{out_path.suffix}")
+
+def _tile_seek_preview(thumbs_path: Path, derived_path: Path, fmt, tile, duration, aspect, interval):
+    """Tiles the single thumbnails derive_video wrote into seek preview sheets and writes their index"""
+    sheets_tmp_path = derived_path / ".seek-preview.tmp"
+    shutil.rmtree(sheets_tmp_path, ignore_errors=True)
+    sheets_tmp_path.mkdir(parents=True)
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-framerate', '1', '-i', str(thumbs_path / "%05d.bmp"), '-vf', tile,
+           '-fps_mode', 'passthrough', *SEEK_PREVIEW_ENCODERS[fmt], str(sheets_tmp_path / f"%03d.{fmt}")]
+    logger.debug(f"$ {' '.join(cmd)}")
+    try:
+        sp.run(cmd, check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        _finish_seek_preview(sheets_tmp_path, derived_path, fmt, duration, aspect, interval)
+        return True
+    except (sp.CalledProcessError, OSError):
+        shutil.rmtree(sheets_tmp_path, ignore_errors=True)
+        return False
+    finally:
+        shutil.rmtree(thumbs_path, ignore_errors=True)
+
+def _valid_rendition(path: Path, duration):
+    """Whether a transcoded file has a video stream and (nearly) the source's duration, i.e. wasn't cut short"""
+    if not path.exists() or path.stat().st_size == 0:
+        return False
+    data = run_probe(path, timeout=60)
+    if not data or not any(st.get('codec_type') == 'video' for st in data.get('streams', [])):
+        return False
+    try:
+        out_duration = float(data.get('format', {}).get('duration') or 0)
+    except ValueError:
+        return False
+    return not duration or out_duration >= duration * 0.95 - 1
+
+def rendition_ladder(config):
+    """
+    The enabled rungs of the transcoding.renditions ladder of a loaded config.json as (height, min_duration), tallest first
+    """
+    ladder = {}
+    for name, rung in config.get("transcoding", {}).get("renditions", {}).items():
+        if not isinstance(rung, dict) or not rung.get("enabled"):
+            continue
+        try:
+            height = int(rung.get("height") or str(name).lower().rstrip("p"))
+            min_duration = float(rung.get("min_duration") or 0)
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring rendition {name} of the transcoding ladder, its height or min_duration is not a number")
+            continue
+        # Served by quality labels like "480p", which the API and the player only accept for 3 and 4 digit heights
+        if not 100 <= height <= 9999 or height % 2:
+            logger.warning(f"Ignoring rendition {name} of the transcoding ladder, {height} is not an even height from 100 to 9999")
+            continue
+        ladder[height] = min(min_duration, ladder.get(height, min_duration))
+    return sorted(ladder.items(), reverse=True)
+
+def rendition_heights(ladder, height, duration):
+    """The heights of the ladder a video gets: lower than its own, and only the rungs its duration reaches"""
+    return [h for h, min_duration in ladder if (height or 0) > h and (duration or 0) >= min_duration]
+
+def rendition_path(derived_path: Path, video_id, height):
+    return derived_path / f"{video_id}-{height}p.mp4"
+
+def derive_video(video_path, derived_path: Path, video_id, duration, heights=(), poster_second=None,
+                 seek_preview_interval=None, aspect=None, boomerang=False, use_gpu=False, timeout_seconds=None):
+    """
+    Creates several derived files of a video from a single decode of it: the transcoded renditions at `heights`,
+    poster.jpg at `poster_second`, the seek preview every `seek_preview_interval` seconds and the boomerang preview.
+    Pass None (or an empty/false value) for any of them to leave it out.
+
+    The decoded frames are split once per output in one ffmpeg filter graph, instead of every output decoding the
+    source again. Every output is checked on its own and moved into place when it is complete, even if others
+    failed. Renditions that failed are retried in one run with the next encoder of the transcode_video_quality
+    fallback chain, the other outputs are not retried. Returns the outputs written: the heights, 'poster',
+    'seek_preview' and 'boomerang'.
+    """
+    global _working_encoder_cache
+    s = time.time()
+    # ffmpeg keeps pulling frames for whichever output of the graph is furthest behind, or has no frame yet, and queues
+    # the decoded frames every other output receives meanwhile. Outputs that only want a frame now and then have to
+    # emit one right away and be stamped ahead of the others, or the queue grows to seconds of raw frames
+    # (name, final path, filter branch, output arguments)
+    outputs, thumbs_path = [], None
+    if poster_second is not None:
+        if poster_second > 0:
+            # The first frame, stamped just before poster_second, stands in until the poster frame overwrites it.
+            # The branch ends a second later, so a video without frames after poster_second keeps the first one
+            branch = (f"trim=end={poster_second + 1},"
+                      f"select='eq(n,0)+gte(t,{poster_second})*lt(prev_selected_t,{poster_second})',"
+                      f"setpts='if(eq(N,0),{poster_second}/TB-1,PTS)'")
+        else:
+            branch = "trim=end_frame=1"
+        outputs.append(('poster', derived_path / "poster.jpg", branch, ['-fps_mode', 'passthrough', '-update', '1']))
+    if seek_preview_interval and duration:
+        # Single thumbnails, stamped one interval ahead, tiled into sheets by a second cheap ffmpeg run afterwards
+        fmt = 'webp' if _encoder_available('libwebp') else 'jpg'
+        _, _, _, thumbnails, tile = _seek_preview_layout(duration, aspect, seek_preview_interval)
+        thumbs_path = derived_path / ".seek-preview-thumbs.tmp"
+        outputs.append(('seek_preview', thumbs_path / "%05d.bmp", f"{thumbnails},setpts=PTS+1", ['-fps_mode', 'passthrough']))
+    if boomerang:
+        outputs.append(('boomerang', derived_path / "boomerang-preview.webm",
+                        "trim=end=1.5,setpts=PTS-STARTPTS,split[ba][bb];[bb]reverse[br];[ba][br]concat,scale=-1:480", ['-an']))
+    for height in heights:
+        outputs.append((height, rendition_path(derived_path, video_id, height), f"scale=-2:{height}", ['-map', '0:a:0?']))
+    if not outputs:
+        return set()
+
+    mode = 'gpu' if use_gpu else 'cpu'
+    encoders = [None]
+    if heights:
+        if timeout_seconds is None:
+            timeout_seconds = calculate_transcode_timeout(video_path)
+        cached = _working_encoder_cache[mode]
+        encoders = ([cached] if cached else []) + [e for e in _get_encoder_candidates(use_gpu) if e != cached]
+
+    written, pending = set(), outputs
+    try:
+        for encoder in encoders:
+            graph = [f"[0:v:0]split={len(pending)}" + "".join(f"[d{i}]" for i in range(len(pending)))]
+            output_args = []
+            for i, (name, out_path, branch, args) in enumerate(pending):
+                graph.append(f"[d{i}]{branch}[o{i}]")
+                output_args += ['-map', f'[o{i}]', *args]
+                if isinstance(name, int):
+                    output_args += ['-c:v', encoder['video_codec'], *encoder.get('extra_args', []),
+                                    '-c:a', encoder['audio_codec'], '-b:a', encoder.get('audio_bitrate', '128k')]
+                output_args.append(str(out_path if name == 'seek_preview' else _tmp_output_path(out_path)))
+            cmd = ['ffmpeg', '-v', 'error', '-y', '-i', str(video_path), '-filter_complex', ";".join(graph), *output_args]
+            if any(name == 'seek_preview' for name, _, _, _ in pending):
+                shutil.rmtree(thumbs_path, ignore_errors=True)
+                thumbs_path.mkdir(parents=True)
+            names = ", ".join(str(name) + ("p" if isinstance(name, int) else "") for name, _, _, _ in pending)
+            logger.info(f"Deriving {names} from {str(video_path)} in one pass" + (f" using {encoder['name']}" if encoder else ""))
+            logger.debug(f"$ {' '.join(cmd)}")
+            try:
+                sp.run(cmd, check=True, timeout=timeout_seconds, stdout=sp.DEVNULL, stderr=sp.PIPE)
+            except (sp.CalledProcessError, sp.TimeoutExpired) as ex:
+                # Outputs that were complete before the failure are still checked and kept below
+                detail = ex.stderr.decode('utf-8', 'replace').strip() if isinstance(ex, sp.CalledProcessError) and ex.stderr else ex
+                logger.warning(f"Could not derive all of {names} from {str(video_path)}" + (f" with {encoder['name']}" if encoder else "") + f": {detail}")
+
+            failed_heights = []
+            for name, out_path, branch, args in pending:
+                if name == 'seek_preview':
+                    if _tile_seek_preview(out_path.parent, derived_path, fmt, tile, duration, aspect, seek_preview_interval):
+                        written.add(name)
+                    else:
+                        logger.warning(f"Could not create a seek preview for {str(video_path)}")
+                    continue
+                tmp_path = _tmp_output_path(out_path)
+                # e.g. no poster when poster_second is past the last frame, or a rendition cut short by a crashed encoder
+                complete = _valid_rendition(tmp_path, duration) if isinstance(name, int) else tmp_path.exists() and tmp_path.stat().st_size > 0
+                if complete:
+                    os.replace(tmp_path, out_path)
+                    written.add(name)
+                    continue
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                if isinstance(name, int):
+                    failed_heights.append((name, out_path, branch, args))
+
+            if encoder:
+                if len(failed_heights) < len(heights):
+                    _working_encoder_cache[mode] = encoder
+                elif encoder is _working_encoder_cache[mode]:
+                    _working_encoder_cache[mode] = None
+            if not failed_heights:
+                break
+            # Only the renditions depend on the encoder, nothing else is worth another decode
+            pending, heights = failed_heights, [h for h, _, _, _ in failed_heights]
+            logger.warning(f"Retrying {', '.join(f'{h}p' for h in heights)} of {str(video_path)} with the next encoder")
+        else:
+            if encoder:
+                logger.error(f"No working {mode.upper()} encoder found for {', '.join(f'{h}p' for h in heights)} of {str(video_path)}")
+    finally:
+        # Tiling removes the thumbnails, this covers the runs that stopped before it
+        if thumbs_path:
+            shutil.rmtree(thumbs_path, ignore_errors=True)
+    logger.info(f"Derived {len(written)} of {len(outputs)} outputs from {str(video_path)} in {time.time()-s:.2f}s")
+    return written
+
 def dur_string_to_seconds(dur: str) -> float:
     if type(dur) == int: return float(dur)
     num_parts = len(dur.split(':'))
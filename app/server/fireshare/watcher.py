@@ -0,0 +1,213 @@
+import os
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+from fireshare import logger
+from .constants import SUPPORTED_FILE_EXTENSIONS, CHUNK_FILE_PATTERN, TRANSCODE_PATTERN
+
+# inotify event flags, see inotify(7)
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC  = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """
+    Minimal ctypes wrapper around the Linux inotify API, keeping track of which directory each watch belongs to.
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self.watches = {}
+
+    def add_watch(self, path: Path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed for {str(path)}: {os.strerror(errno)}")
+        self.watches[wd] = path
+        return wd
+
+    def remove_watches_under(self, path: Path):
+        for wd, watched in list(self.watches.items()):
+            if watched == path or path in watched.parents:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd, None)
+
+    def read_events(self, timeout):
+        """
+        Waits up to timeout seconds and returns a list of (path, mask, cookie) for every event read
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None and not mask & IN_Q_OVERFLOW:
+                    continue
+                path = directory / os.fsdecode(name) if directory and name else directory
+                events.append((path, mask, cookie))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def is_video_candidate(path: Path):
+    return (path.suffix.lower() in SUPPORTED_FILE_EXTENSIONS
+            and not CHUNK_FILE_PATTERN.search(path.name)
+            and not TRANSCODE_PATTERN.search(path.name))
+
+class VideoWatcher:
+    """
+    Watches one or more video directory trees and reports video files once they have stopped growing.
+
+    roots maps each watched directory to the directories inside it that are excluded from scans, those are
+    neither watched nor reported.
+
+    on_ready(path) is called once a file's size and mtime have been stable for settle_seconds. It may return
+    False to have the file retried on a later tick, as does raising. on_removed(path, is_dir) is called when a
+    file or directory is deleted or moved out of its location. on_overflow() is called if the kernel dropped
+    events, after which a full scan is the only way to catch up. Errors raised by the callbacks are logged and
+    the watcher carries on.
+    """
+    def __init__(self, roots, settle_seconds, on_ready, on_removed, on_overflow):
+        self.roots = {root: [Path(d) for d in exclude_dirs] for root, exclude_dirs in roots.items()}
+        self.settle_seconds = settle_seconds
+        self.on_ready = on_ready
+        self.on_removed = on_removed
+        self.on_overflow = on_overflow
+        self.inotify = Inotify()
+        self.pending = {}
+
+    def _excluded(self, path: Path):
+        # Nested roots are watched on their own, so only the excludes of the innermost root containing path apply
+        roots = [r for r in self.roots if r == path or r in path.parents]
+        if not roots:
+            return False
+        root = max(roots, key=lambda r: len(r.parts))
+        return any(d == path or d in path.parents for d in self.roots[root])
+
+    def _watch_tree(self, directory: Path, queue_files=False):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if not self._excluded(Path(dirpath, d))]
+            try:
+                self.inotify.add_watch(Path(dirpath))
+            except OSError as ex:
+                logger.warning(f"Unable to watch {dirpath}: {ex}")
+                continue
+            if queue_files:
+                for f in filenames:
+                    self._queue(Path(dirpath, f))
+
+    def _queue(self, path: Path):
+        if is_video_candidate(path) and not self._excluded(path):
+            if path not in self.pending:
+                logger.debug(f"Waiting for {str(path)} to finish writing")
+            self.pending[path] = (None, time.time())
+
+    def _handle(self, path: Path, mask):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("The inotify event queue overflowed, falling back to a full scan")
+            try:
+                self.on_overflow()
+            except Exception:
+                logger.exception("The full scan after the inotify event queue overflowed failed")
+            return
+        if path is None or self._excluded(path):
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if path in self.roots:
+                logger.warning(f"The watched video directory {str(path)} was removed or moved")
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files can land in a new directory before its watch exists, so pick up anything already inside
+                self._watch_tree(path, queue_files=True)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.inotify.remove_watches_under(path)
+                self.pending = {p: v for p, v in self.pending.items() if path not in p.parents}
+                self._removed(path, True)
+            return
+        if mask & (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._queue(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+            if is_video_candidate(path):
+                self._removed(path, False)
+
+    def _removed(self, path: Path, is_dir):
+        try:
+            self.on_removed(path, is_dir)
+        except Exception:
+            logger.exception(f"Failed to handle the removal of {str(path)}")
+
+    def _settle(self):
+        now = time.time()
+        for path, (state, last_change) in list(self.pending.items()):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                self.pending.pop(path, None)
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != state:
+                self.pending[path] = (current, now)
+            elif now - last_change >= self.settle_seconds:
+                try:
+                    ready = self.on_ready(path) is not False
+                except Exception:
+                    logger.exception(f"Failed to import {str(path)}, it will be retried")
+                    ready = False
+                if ready:
+                    self.pending.pop(path, None)
+                else:
+                    self.pending[path] = (current, now)
+
+    def run(self):
+        for root in self.roots:
+            logger.info(f"Watching {str(root)} for new videos (settle time {self.settle_seconds}s)")
+            self._watch_tree(root)
+        try:
+            while True:
+                for path, mask, cookie in self.inotify.read_events(timeout=1.0):
+                    self._handle(path, mask)
+                self._settle()
+        finally:
+            self.inotify.close()
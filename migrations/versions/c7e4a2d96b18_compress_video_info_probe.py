@@ -0,0 +1,69 @@
+"""compress video info probe
+
+Revision ID: c7e4a2d96b18
+Revises: b5d1f0c7e294
+Create Date: 2026-10-18 08:20:00.000000
+
+"""
+import logging
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e4a2d96b18'
+down_revision = 'b5d1f0c7e294'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+
+# Every column holding a copy of a probe, as (table, column)
+PROBE_COLUMNS = (('video_info', 'info'), ('probe_cache', 'data'))
+
+
+def _sizes():
+    bind = op.get_bind()
+    page_size = bind.execute(sa.text("PRAGMA page_size")).scalar()
+    page_count = bind.execute(sa.text("PRAGMA page_count")).scalar()
+    probe_bytes = sum(bind.execute(sa.text(f"SELECT COALESCE(SUM(LENGTH(CAST({column} AS BLOB))), 0) FROM {table}")).scalar()
+                      for table, column in PROBE_COLUMNS)
+    return page_size * page_count, probe_bytes
+
+
+def _rewrite(table, column, kind, convert):
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(f"SELECT id, {column} AS value FROM {table} WHERE typeof({column}) = '{kind}'")).fetchall()
+    for i in range(0, len(rows), 1000):
+        bind.execute(sa.text(f"UPDATE {table} SET {column} = :value WHERE id = :id"),
+                     [{"id": row.id, "value": convert(row.value)} for row in rows[i:i + 1000]])
+    return len(rows)
+
+
+def _vacuum_and_report(before, direction):
+    # VACUUM can't run inside a transaction, and without it the freed pages would stay in the file
+    with op.get_context().autocommit_block():
+        op.execute("VACUUM")
+    after = _sizes()
+    logger.info(f"{direction} video_info.info and probe_cache.data: probe data {before[1]:,} -> {after[1]:,} bytes, "
+                f"database file {before[0]:,} -> {after[0]:,} bytes")
+
+
+def upgrade():
+    before = _sizes()
+    # Rows from before this revision are plain JSON text, the ones already compressed are blobs
+    for table, column in PROBE_COLUMNS:
+        count = _rewrite(table, column, 'text', lambda value: zlib.compress(value.encode('utf-8'), 9))
+        logger.info(f"Compressed {count:,} stored probe(s) in {table}.{column}")
+    _vacuum_and_report(before, "Compressed")
+
+
+def downgrade():
+    before = _sizes()
+    for table, column in PROBE_COLUMNS:
+        count = _rewrite(table, column, 'blob', lambda value: zlib.decompress(value).decode('utf-8'))
+        logger.info(f"Decompressed {count:,} stored probe(s) in {table}.{column}")
+    _vacuum_and_report(before, "Decompressed")